@@ -14,6 +14,9 @@
 
 from __future__ import absolute_import
 
-from . import create, creategpu, connect, list, stop, delete, utils
+from . import (
+    apply, cache, computeapi, create, creategpu, connect, list, stop, delete,
+    inventory, localstate, utils, wait)
 
-__all__ = [create, creategpu, connect, list, stop, delete, utils]
+__all__ = [apply, cache, computeapi, create, creategpu, connect, list, stop,
+           delete, inventory, localstate, utils, wait]
@@ -0,0 +1,175 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Catalog of the GPU accelerators that Datalab instances can use.
+
+The accelerator types offered in each zone are looked up once and then
+cached on disk, so that an unavailable accelerator can be reported (and
+a nearby zone suggested) before an instance creation is attempted.
+"""
+
+from __future__ import absolute_import
+
+import os
+import subprocess
+
+from . import cache, inventory, localstate, utils
+
+
+# The accelerators supported by Datalab, mapped to the version of the
+# NVIDIA driver to install for them.
+SUPPORTED_ACCELERATORS = {
+    'nvidia-tesla-k80': '390.46',
+    'nvidia-tesla-p100': '396.26',
+    'nvidia-tesla-v100': '396.26',
+    'nvidia-tesla-t4': '410.79',
+}
+
+# The numbers of accelerators that can be attached to an instance.
+VALID_ACCELERATOR_COUNTS = [1, 2, 4, 8]
+
+_CATALOG_FILE = 'accelerator-types.json'
+_CATALOG_FORMAT_VERSION = 1
+_CATALOG_TTL_SECONDS = 24 * 60 * 60
+
+# The maximum number of other zones to suggest.
+_MAX_SUGGESTED_ZONES = 3
+
+
+class UnavailableAcceleratorException(Exception):
+
+    _MESSAGE = (
+        'The zone {} does not offer {} accelerators of type {}.')
+
+    _SUGGESTION = ' They are available in the nearby zones: {}.'
+
+    def __init__(self, zone, accelerator_type, count, suggested_zones):
+        message = UnavailableAcceleratorException._MESSAGE.format(
+            zone, count, accelerator_type)
+        if suggested_zones:
+            message += UnavailableAcceleratorException._SUGGESTION.format(
+                ', '.join(suggested_zones))
+        super(UnavailableAcceleratorException, self).__init__(message)
+
+
+def driver_version(accelerator_type):
+    """Get the version of the NVIDIA driver to use for an accelerator.
+
+    Args:
+      accelerator_type: The name of the accelerator type
+    Returns:
+      The driver version, as a string.
+    """
+    return SUPPORTED_ACCELERATORS[accelerator_type]
+
+
+def _catalog_cache():
+    try:
+        path = os.path.join(localstate.datalab_config_dir(), _CATALOG_FILE)
+    except (IOError, OSError):
+        path = None
+    return cache.SessionCache(path, {'version': _CATALOG_FORMAT_VERSION})
+
+
+def accelerator_catalog(args, gcloud_compute):
+    """Get the accelerator types offered in each zone.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Returns:
+      A dictionary mapping each zone to a dictionary from the names of
+      the accelerator types offered there to the maximum number of them
+      that can be attached to an instance.
+    Raises:
+      subprocess.CalledProcessError: If the catalog had to be fetched,
+        and the `gcloud` call failed.
+    """
+    def fetch():
+        catalog = {}
+        for accelerator in utils.list_resources(
+                args, gcloud_compute, 'accelerator-types'):
+            zone = accelerator.get('zone', '').rsplit('/', 1)[-1]
+            catalog.setdefault(zone, {})[accelerator.get('name')] = int(
+                accelerator.get('maximumCardsPerInstance', 0))
+        return catalog
+
+    catalog_cache = _catalog_cache()
+    catalog = catalog_cache.get_or_compute(
+        inventory.project_key(args), _CATALOG_TTL_SECONDS, fetch)
+    catalog_cache.save()
+    return catalog
+
+
+def _zone_distance(zone, other_zone):
+    # Zones are named `<area>-<location><n>-<letter>`, e.g.
+    # `us-central1-a`, so zones sharing more of their names are nearer.
+    region = zone.rsplit('-', 1)[0]
+    if other_zone.rsplit('-', 1)[0] == region:
+        return 0
+    if other_zone.split('-', 1)[0] == region.split('-', 1)[0]:
+        return 1
+    return 2
+
+
+def nearest_zones(catalog, zone, accelerator_type, count):
+    """Find the zones nearest to the given one that offer an accelerator.
+
+    Args:
+      catalog: The catalog returned by `accelerator_catalog`
+      zone: The zone from which to measure the distance
+      accelerator_type: The name of the accelerator type
+      count: The number of accelerators needed by one instance
+    Returns:
+      The names of up to three zones, nearest first.
+    """
+    candidates = [
+        other_zone for other_zone, accelerators in catalog.items()
+        if other_zone != zone and
+        accelerators.get(accelerator_type, 0) >= count]
+    candidates.sort(key=lambda other_zone: (
+        _zone_distance(zone or '', other_zone), other_zone))
+    return candidates[:_MAX_SUGGESTED_ZONES]
+
+
+def check_availability(args, gcloud_compute, accelerator_type, count):
+    """Check that the zone of the args offers the requested accelerators.
+
+    The check is skipped if the catalog cannot be fetched, or does not
+    include the zone, so that an incomplete catalog does not prevent an
+    instance from being created.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      accelerator_type: The name of the accelerator type
+      count: The number of accelerators to attach to the instance
+    Raises:
+      UnavailableAcceleratorException: If the zone does not offer the
+        requested accelerators.
+    """
+    try:
+        catalog = accelerator_catalog(args, gcloud_compute)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        if utils.print_debug_messages(args):
+            print('Could not look up the available accelerators: {}'.format(
+                e))
+        return
+    if not args.zone or args.zone not in catalog:
+        return
+    if catalog[args.zone].get(accelerator_type, 0) >= count:
+        return
+    raise UnavailableAcceleratorException(
+        args.zone, accelerator_type, count,
+        nearest_zones(catalog, args.zone, accelerator_type, count))
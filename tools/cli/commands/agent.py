@@ -0,0 +1,608 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A background agent that keeps tunnels open to many Datalab instances.
+
+The agent is a long-lived local process that owns the SSH tunnels to
+any number of instances. It assigns each tunnel a free local port,
+re-establishes tunnels that drop, and checks that Datalab is reachable
+through each of them. The checks for every tunnel are run by a single
+scheduler thread.
+
+Other invocations of the CLI talk to the agent over a Unix socket in
+the per-user config directory. Each request and each response is a
+single line holding a JSON object; requests name a `command` and
+responses hold either a `result` or an `error`.
+"""
+
+from __future__ import absolute_import
+
+import copy
+import heapq
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+try:
+    from socketserver import StreamRequestHandler, ThreadingMixIn
+    from socketserver import UnixStreamServer
+    from urllib.request import urlopen
+except ImportError:
+    from SocketServer import StreamRequestHandler, ThreadingMixIn
+    from SocketServer import UnixStreamServer
+    from urllib2 import urlopen
+
+from . import inventory, localstate, tunnel
+
+
+_SOCKET_FILE = 'agent.sock'
+_LOG_FILE = 'agent.log'
+
+# The range of local ports that are assigned to tunnels.
+_FIRST_LOCAL_PORT = 8081
+_LOCAL_PORT_COUNT = 100
+
+# How long, in seconds, to wait for a newly started agent to respond.
+_START_TIMEOUT_SECONDS = 10
+
+# How long, in seconds, to wait for a response to a request.
+_REQUEST_TIMEOUT_SECONDS = 120
+
+# How often, in seconds, to check a tunnel through which Datalab is
+# reachable, and the bounds for the back-off while it is not.
+_HEALTHY_CHECK_INTERVAL_SECONDS = 10
+_UNHEALTHY_CHECK_INITIAL_DELAY_SECONDS = 1
+_UNHEALTHY_CHECK_MAX_DELAY_SECONDS = 30
+
+# How long, in seconds, each check waits for Datalab to respond. Since
+# the checks of every tunnel share a thread, this is kept short.
+_HEALTH_CHECK_TIMEOUT_SECONDS = 3
+
+# The states of a tunnel, as reported by `list`.
+STATUS_CONNECTING = 'CONNECTING'
+STATUS_HEALTHY = 'HEALTHY'
+STATUS_UNREACHABLE = 'UNREACHABLE'
+STATUS_RECONNECTING = 'RECONNECTING'
+
+
+class AgentNotSupportedException(Exception):
+
+    _MESSAGE = 'The tunnel agent requires OpenSSH, which is not available.'
+
+    def __init__(self):
+        super(AgentNotSupportedException, self).__init__(
+            AgentNotSupportedException._MESSAGE)
+
+
+class AgentNotRunningException(Exception):
+
+    _MESSAGE = 'The tunnel agent is not running.'
+
+    def __init__(self):
+        super(AgentNotRunningException, self).__init__(
+            AgentNotRunningException._MESSAGE)
+
+
+class AgentRequestException(Exception):
+
+    _MESSAGE = 'The tunnel agent could not {}: {}'
+
+    def __init__(self, command, error):
+        super(AgentRequestException, self).__init__(
+            AgentRequestException._MESSAGE.format(command, error))
+
+
+class NoFreePortException(Exception):
+
+    _MESSAGE = 'None of the local ports {} to {} is free.'
+
+    def __init__(self):
+        super(NoFreePortException, self).__init__(
+            NoFreePortException._MESSAGE.format(
+                _FIRST_LOCAL_PORT, _FIRST_LOCAL_PORT + _LOCAL_PORT_COUNT - 1))
+
+
+def socket_path():
+    """Get the path of the Unix socket on which the agent listens."""
+    return os.path.join(localstate.datalab_config_dir(), _SOCKET_FILE)
+
+
+def log_path():
+    """Get the path of the file to which the agent logs."""
+    return os.path.join(localstate.datalab_config_dir(), _LOG_FILE)
+
+
+def tunnel_key(project, zone, instance):
+    """Get the key that identifies the tunnel to an instance.
+
+    Args:
+      project: The project of the instance, as resolved by the client
+      zone: The zone of the instance
+      instance: The name of the instance
+    """
+    return '{}/{}/{}'.format(project, zone or '', instance)
+
+
+def port_is_free(port):
+    """Check whether the given local port can be listened on."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('localhost', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def _free_port(used_ports):
+    for port in range(_FIRST_LOCAL_PORT,
+                      _FIRST_LOCAL_PORT + _LOCAL_PORT_COUNT):
+        if port not in used_ports and port_is_free(port):
+            return port
+    raise NoFreePortException()
+
+
+class HealthScheduler(object):
+    """Runs periodic checks for many keys on a single thread.
+
+    Args:
+      check: A function that takes a key, checks it, and returns the
+        number of seconds until it should be checked again, or None if
+        it should not be checked any more.
+    """
+
+    def __init__(self, check):
+        self._check = check
+        self._queue = []
+        self._scheduled = {}
+        self._sequence = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def schedule(self, key, delay=0):
+        """Check the given key after the given number of seconds.
+
+        This replaces any check of the key that was already scheduled.
+        """
+        with self._condition:
+            self._sequence += 1
+            self._scheduled[key] = self._sequence
+            heapq.heappush(
+                self._queue, (time.time() + delay, self._sequence, key))
+            self._condition.notify()
+
+    def cancel(self, key):
+        """Stop checking the given key."""
+        with self._condition:
+            self._scheduled.pop(key, None)
+
+    def stop(self):
+        """Make `run` return once the current check has finished."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _next_due(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                due, sequence, key = self._queue[0]
+                if self._scheduled.get(key) != sequence:
+                    # The check was rescheduled or cancelled since.
+                    heapq.heappop(self._queue)
+                    continue
+                now = time.time()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._queue)
+                del self._scheduled[key]
+                return key
+            return None
+
+    def run(self):
+        """Run the scheduled checks until `stop` is called."""
+        while True:
+            key = self._next_due()
+            if key is None:
+                return
+            delay = self._check(key)
+            if delay is None:
+                continue
+            with self._condition:
+                if key in self._scheduled:
+                    # The key was rescheduled while it was being checked.
+                    continue
+            self.schedule(key, delay)
+
+
+class Agent(object):
+    """The tunnels that the agent manages, and the requests it serves.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    """
+
+    def __init__(self, args, gcloud_compute):
+        self._args = copy.copy(args)
+        # Nobody can answer a prompt from the agent.
+        self._args.quiet = True
+        self._gcloud_compute = gcloud_compute
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._tunnels = {}
+        self.scheduler = HealthScheduler(self._check)
+        self._server = None
+
+    def log(self, message):
+        print('{} {}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), message))
+        sys.stdout.flush()
+
+    def _describe(self, record):
+        return {
+            'instance': record['instance'],
+            'project': record['project'],
+            'zone': record['zone'],
+            'port': record['port'],
+            'status': record['status'],
+            'via': record['via'],
+            'profile': record['tunnel'].profile,
+            'forwards': record['tunnel'].forwards,
+        }
+
+    def _check(self, key):
+        with self._lock:
+            record = self._tunnels.get(key)
+        if record is None:
+            return None
+        if record['status'] == STATUS_RECONNECTING:
+            return _HEALTHY_CHECK_INTERVAL_SECONDS
+        if not record['tunnel'].master_alive():
+            self.log('The tunnel to {} dropped'.format(key))
+            record['status'] = STATUS_RECONNECTING
+            record['dropped'] = time.time()
+            reconnect_thread = threading.Thread(
+                target=self._reconnect, args=[key, record])
+            reconnect_thread.daemon = True
+            reconnect_thread.start()
+            return None
+        health_url = 'http://localhost:{}/_info/'.format(record['port'])
+        try:
+            healthy = urlopen(
+                health_url,
+                timeout=_HEALTH_CHECK_TIMEOUT_SECONDS).getcode() == 200
+        except Exception:
+            healthy = False
+        if healthy:
+            if record.get('dropped'):
+                self.log('Datalab on {} is reachable again via {}, {:.1f} '
+                         'seconds after the tunnel dropped'.format(
+                             key, record['via'],
+                             time.time() - record.pop('dropped')))
+            record['status'] = STATUS_HEALTHY
+            record['delay'] = _UNHEALTHY_CHECK_INITIAL_DELAY_SECONDS
+            return _HEALTHY_CHECK_INTERVAL_SECONDS
+        record['status'] = STATUS_UNREACHABLE
+        delay = record['delay']
+        record['delay'] = min(delay * 2, _UNHEALTHY_CHECK_MAX_DELAY_SECONDS)
+        return delay
+
+    def _reconnect(self, key, record):
+        try:
+            record['via'] = record['tunnel'].open()
+            self.log('Reopened the tunnel to {} via {}'.format(
+                key, record['via']))
+        except Exception as e:
+            self.log('Failed to reopen the tunnel to {}: {}'.format(key, e))
+        record['status'] = STATUS_CONNECTING
+        record['delay'] = _UNHEALTHY_CHECK_INITIAL_DELAY_SECONDS
+        with self._lock:
+            if self._tunnels.get(key) is record:
+                self.scheduler.schedule(key)
+
+    def open(self, instance, project=None, zone=None, port=None,
+             forwards=None, profile=None, use_gcloud=False):
+        """Open a tunnel to the given instance, unless one is already open.
+
+        Args:
+          instance: The name of the instance
+          project: The project of the instance, as resolved by the
+            client, since the agent's own default project may be stale
+          zone: The zone of the instance
+          port: The local port to use, or None to pick a free one
+          forwards: A list of additional (local port, remote port) pairs
+            to forward. For a tunnel that is already open, these are
+            added to it.
+          profile: The name of the tunnel profile to use
+          use_gcloud: Whether the tunnel may be opened with gcloud
+        Returns:
+          A dictionary describing the tunnel. Its 'via' entry is None if
+          the tunnel could not be opened without gcloud.
+        """
+        key = tunnel_key(project, zone, instance)
+        with self._open_lock:
+            with self._lock:
+                record = self._tunnels.get(key)
+                if record is None:
+                    used_ports = [r['port'] for r in self._tunnels.values()]
+                    if port is None or port in used_ports:
+                        port = _free_port(used_ports)
+                    args = copy.copy(self._args)
+                    args.project = project or None
+                    args.zone = zone
+                    args.tunnel_profile = (
+                        profile or tunnel.DEFAULT_TUNNEL_PROFILE)
+                    record = {
+                        'instance': instance,
+                        'project': project,
+                        'zone': zone,
+                        'port': port,
+                        'status': STATUS_CONNECTING,
+                        'via': None,
+                        'delay': _UNHEALTHY_CHECK_INITIAL_DELAY_SECONDS,
+                        'tunnel': tunnel.Tunnel(
+                            args, self._gcloud_compute, instance,
+                            [(port, tunnel.DATALAB_PORT)] + (forwards or []),
+                            owns_master=True),
+                    }
+                    self._tunnels[key] = record
+                    forwards = []
+            if record['via'] is not None:
+                for local_port, remote_port in forwards or []:
+                    if not record['tunnel'].add_forward(
+                            local_port, remote_port):
+                        raise tunnel.ForwardFailedException(
+                            instance, local_port, remote_port)
+            else:
+                record['via'] = record['tunnel'].open(use_gcloud=use_gcloud)
+                if record['via']:
+                    self.log('Opened the tunnel to {} on port {} via '
+                             '{}'.format(key, record['port'], record['via']))
+                    self.scheduler.schedule(key)
+            return self._describe(record)
+
+    def close(self, instance, project=None, zone=None):
+        """Close the tunnel to the given instance.
+
+        Returns:
+          A dictionary describing the closed tunnel, or None if there
+          was no tunnel to the instance.
+        """
+        key = tunnel_key(project, zone, instance)
+        with self._lock:
+            record = self._tunnels.pop(key, None)
+        if record is None:
+            return None
+        self.scheduler.cancel(key)
+        record['tunnel'].close()
+        self.log('Closed the tunnel to {}'.format(key))
+        return self._describe(record)
+
+    def list(self):
+        """List the tunnels, ordered by local port."""
+        with self._lock:
+            records = sorted(self._tunnels.values(), key=lambda r: r['port'])
+        return [self._describe(record) for record in records]
+
+    def shutdown(self):
+        """Close every tunnel and stop serving requests."""
+        with self._lock:
+            records = list(self._tunnels.values())
+        for record in records:
+            self.close(record['instance'], project=record['project'],
+                       zone=record['zone'])
+        self.scheduler.stop()
+        if self._server is not None:
+            stop_thread = threading.Thread(target=self._server.shutdown)
+            stop_thread.daemon = True
+            stop_thread.start()
+        return {'closed': len(records)}
+
+    def handle(self, request):
+        """Serve a decoded request, and return the response to send."""
+        commands = {
+            'open': self.open,
+            'close': self.close,
+            'list': self.list,
+            'shutdown': self.shutdown,
+        }
+        command = request.pop('command', None)
+        if command not in commands:
+            return {'error': 'unknown command {}'.format(command)}
+        try:
+            return {'result': commands[command](**request)}
+        except Exception as e:
+            self.log(traceback.format_exc())
+            return {'error': str(e)}
+
+    def serve(self, path):
+        """Serve requests on the given Unix socket until shut down."""
+        agent = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode(
+                        'utf-8'))
+                except ValueError:
+                    response = {'error': 'malformed request'}
+                else:
+                    response = agent.handle(request)
+                self.wfile.write(
+                    (json.dumps(response) + '\n').encode('utf-8'))
+
+        class Server(ThreadingMixIn, UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = Server(path, Handler)
+        os.chmod(path, 0o600)
+        scheduler_thread = threading.Thread(target=self.scheduler.run)
+        scheduler_thread.daemon = True
+        scheduler_thread.start()
+        self.log('Listening on {}'.format(path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(path):
+                os.remove(path)
+            self.log('Stopped')
+
+
+def call(command, **params):
+    """Send a request to the running agent.
+
+    Args:
+      command: The name of the command to run
+      **params: The parameters of the command
+    Returns:
+      The result of the command.
+    Raises:
+      AgentNotRunningException: If the agent is not running
+      AgentRequestException: If the agent failed to run the command
+    """
+    if not tunnel.multiplexing_supported():
+        raise AgentNotRunningException()
+    request = dict(params, command=command)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(_REQUEST_TIMEOUT_SECONDS)
+        response = b''
+        try:
+            sock.connect(socket_path())
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            while not response.endswith(b'\n'):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+        except socket.timeout:
+            raise AgentRequestException(command, 'timed out')
+        except socket.error:
+            # This includes the agent shutting down mid-request.
+            raise AgentNotRunningException()
+    finally:
+        sock.close()
+    try:
+        response = json.loads(response.decode('utf-8'))
+    except ValueError:
+        raise AgentRequestException(command, 'malformed response')
+    if 'error' in response:
+        raise AgentRequestException(command, response['error'])
+    return response.get('result')
+
+
+def is_running():
+    """Check whether the agent is running and responding to requests."""
+    try:
+        call('list')
+        return True
+    except (AgentNotRunningException, AgentRequestException):
+        return False
+
+
+def start(args, gcloud_compute):
+    """Start the agent in the background, unless it is already running.
+
+    The agent is a daemonized fork of the current process, so that it
+    shares its configuration, and logs to a file in the config directory.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Raises:
+      AgentNotSupportedException: If the platform does not support it
+      AgentNotRunningException: If the agent did not start responding
+    """
+    if not tunnel.multiplexing_supported():
+        raise AgentNotSupportedException()
+    if is_running():
+        return
+    path = socket_path()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                with open(os.devnull, 'r') as devnull:
+                    os.dup2(devnull.fileno(), 0)
+                with open(log_path(), 'a') as log_file:
+                    os.dup2(log_file.fileno(), 1)
+                    os.dup2(log_file.fileno(), 2)
+                # Connections inherited from the parent must not be
+                # shared with it.
+                if hasattr(gcloud_compute, 'close'):
+                    gcloud_compute.close()
+                Agent(args, gcloud_compute).serve(path)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    deadline = time.time() + _START_TIMEOUT_SECONDS
+    while not is_running():
+        if time.time() > deadline:
+            raise AgentNotRunningException()
+        time.sleep(0.1)
+
+
+def open_tunnel(args, gcloud_compute, instance, port=None, forwards=None):
+    """Have the agent open a tunnel to an instance, starting it if needed.
+
+    The agent first tries to open the tunnel on its own, which it can
+    if a master connection to the instance is already running. If that
+    needs gcloud, which may prompt the user (e.g. to create an SSH key),
+    then the master is opened from this process instead, and handed over
+    to the agent, which reopens it directly if it is later lost.
+
+    Args:
+      args: The Namespace instance returned by argparse; its zone must
+        already have been resolved
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      instance: The name of the instance
+      port: The local port to use, or None to pick a free one
+      forwards: A list of additional (local port, remote port) tuples
+        to forward
+    Returns:
+      A dictionary describing the tunnel.
+    Raises:
+      subprocess.CalledProcessError: If gcloud failed to connect
+      AgentNotSupportedException: If the platform does not support it
+      AgentNotRunningException: If the agent could not be started
+      AgentRequestException: If the agent failed to open the tunnel
+    """
+    start(args, gcloud_compute)
+    # The project is resolved here, so that the agent looks the instance
+    # up in, and names its master after, the same project as this process.
+    params = {'instance': instance, 'project': inventory.project_key(args),
+              'zone': args.zone, 'port': port, 'forwards': forwards,
+              'profile': args.tunnel_profile}
+    result = call('open', **params)
+    if result['via'] is None:
+        tunnel.Tunnel(args, gcloud_compute, instance,
+                      result['forwards']).open()
+        params['forwards'] = None
+        result = call('open', **params)
+    return result
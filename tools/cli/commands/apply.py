@@ -0,0 +1,490 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab apply` command."""
+
+from __future__ import absolute_import
+
+import argparse
+import copy
+import json
+
+from . import create, utils
+
+try:
+    import yaml
+except ImportError:
+    # PyYAML is optional, as fleet files can also be written in JSON.
+    yaml = None
+
+
+description = ("""`{0} {1}` makes the Datalab instances in a project match
+the ones described in a fleet file.
+
+The live instances, disks and networks are fetched with one list call
+per resource type, and compared with the desired ones. Only the
+differences are then acted on: missing networks and instances are
+created, notebooks disks are grown, machine types are changed, and
+instances are started or stopped. Instances that are not in the file
+are only deleted if pruning is enabled.
+
+The fleet file is written in YAML (if PyYAML is installed) or JSON. Its
+`instances` entry lists the desired instances, each of which has a
+`name` and, optionally, any of the following `{0} create` settings:
+
+    zone, machine-type, disk-name, disk-size-gb, disk-type, disk-profile,
+    from-snapshot, network-name, image-name, image-registry-region,
+    registry-mirror, idle-timeout, for-user, service-account, log-level,
+    no-swap, swap-mode, swap-size, local-ssd-count, tmp-storage,
+    shm-size, memory-limit, memory-swap-limit, cpuset, ulimit,
+    no-image-cache, from-baked-image, no-backups, no-create-repository
+
+as well as a `status` of either RUNNING (the default) or TERMINATED.
+The `ulimit` setting takes a list of limits, and `from-baked-image`
+takes either an image family or `true` for the default one.
+Settings that apply to every instance can be given under `defaults`,
+and `prune: true` enables pruning.
+
+Settings other than the zone, machine type, disk size and status only
+take effect when an instance is created. The machine type and disk size
+of an existing instance are only changed when they are set explicitly.""")
+
+
+examples = ("""
+Given the file 'fleet.yaml':
+
+    defaults:
+      zone: us-central1-a
+      machine-type: n1-standard-4
+    instances:
+    - name: alice-datalab
+      for-user: alice@example.com
+      disk-size-gb: 500
+    - name: bob-datalab
+      for-user: bob@example.com
+      status: TERMINATED
+
+To see what would be changed:
+
+    $ {0} {1} -f fleet.yaml --dry-run
+
+To make the changes:
+
+    $ {0} {1} -f fleet.yaml
+""")
+
+
+_FILE_HELP = """The path of the fleet file to apply."""
+
+_DRY_RUN_HELP = """Only print the changes that would be made."""
+
+_PRUNE_HELP = ("""Delete the Datalab instances that are not in the fleet
+file. This can also be enabled with `prune: true` in the file.""")
+
+_MAX_CONCURRENCY_HELP = ("""The maximum number of instances to change at
+once.""")
+
+_DEFAULT_MAX_CONCURRENCY = 4
+
+_STATUS_RUNNING = 'RUNNING'
+_STATUS_TERMINATED = 'TERMINATED'
+
+# The `datalab create` settings that can be given in a fleet file.
+_CREATE_SETTINGS = [
+    'zone', 'machine-type', 'disk-name', 'disk-size-gb', 'disk-type',
+    'disk-profile', 'from-snapshot', 'network-name', 'image-name',
+    'image-registry-region', 'registry-mirror', 'idle-timeout', 'for-user',
+    'service-account', 'log-level', 'no-swap', 'swap-mode', 'swap-size',
+    'local-ssd-count', 'tmp-storage', 'shm-size', 'memory-limit',
+    'memory-swap-limit', 'cpuset', 'ulimit', 'no-image-cache',
+    'from-baked-image', 'no-backups', 'no-create-repository',
+]
+
+_PLAN_PROMPT = ("""The following changes will be made:
+{}
+""")
+
+
+class InvalidFleetFileException(Exception):
+
+    _MESSAGE = 'The fleet file {} is not valid: {}'
+
+    def __init__(self, path, reason):
+        super(InvalidFleetFileException, self).__init__(
+            InvalidFleetFileException._MESSAGE.format(path, reason))
+
+
+def flags(parser):
+    """Add command line flags for the `apply` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        '-f', '--file',
+        dest='file',
+        required=True,
+        help=_FILE_HELP)
+    parser.add_argument(
+        '--dry-run',
+        dest='dry_run',
+        action='store_true',
+        default=False,
+        help=_DRY_RUN_HELP)
+    parser.add_argument(
+        '--prune',
+        dest='prune',
+        action='store_true',
+        default=False,
+        help=_PRUNE_HELP)
+    parser.add_argument(
+        '--max-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=_DEFAULT_MAX_CONCURRENCY,
+        help=_MAX_CONCURRENCY_HELP)
+    return
+
+
+def load_fleet(path):
+    """Read and validate a fleet file.
+
+    Args:
+      path: The path of the fleet file
+    Returns:
+      A tuple of the dictionary mapping each desired instance's name to
+      its settings (with the defaults applied), and whether pruning was
+      requested.
+    Raises:
+      InvalidFleetFileException: If the file is malformed.
+    """
+    with open(path, 'r') as f:
+        text = f.read()
+    try:
+        if yaml is not None:
+            fleet = yaml.safe_load(text)
+        else:
+            fleet = json.loads(text)
+    except ValueError as e:
+        raise InvalidFleetFileException(
+            path, '{} (only JSON can be read without PyYAML)'.format(e))
+    except yaml.YAMLError as e:
+        raise InvalidFleetFileException(path, e)
+    if not isinstance(fleet, dict):
+        raise InvalidFleetFileException(path, 'expected a mapping')
+    for key in fleet:
+        if key not in ['defaults', 'instances', 'prune']:
+            raise InvalidFleetFileException(
+                path, 'unknown entry {}'.format(key))
+
+    defaults = fleet.get('defaults') or {}
+    _check_settings(path, 'defaults', defaults)
+    instances = {}
+    for entry in fleet.get('instances') or []:
+        if not isinstance(entry, dict) or not entry.get('name'):
+            raise InvalidFleetFileException(
+                path, 'every instance must have a name')
+        name = str(entry['name'])
+        if name in instances:
+            raise InvalidFleetFileException(
+                path, 'the instance {} is listed twice'.format(name))
+        settings = dict((k, v) for k, v in entry.items() if k != 'name')
+        _check_settings(path, name, settings)
+        instances[name] = dict(defaults)
+        instances[name].update(settings)
+    return instances, bool(fleet.get('prune'))
+
+
+def _check_settings(path, name, settings):
+    if not isinstance(settings, dict):
+        raise InvalidFleetFileException(
+            path, 'the settings of {} must be a mapping'.format(name))
+    for key in settings:
+        if key != 'status' and key not in _CREATE_SETTINGS:
+            raise InvalidFleetFileException(
+                path, 'unknown setting {} for {}'.format(key, name))
+    status = settings.get('status', _STATUS_RUNNING)
+    if status not in [_STATUS_RUNNING, _STATUS_TERMINATED]:
+        raise InvalidFleetFileException(
+            path, 'unknown status {} for {}'.format(status, name))
+
+
+def _create_args(args, name, settings, gcloud_zone):
+    """Build the arguments for running `datalab create` on an instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      name: The name of the instance
+      settings: The desired settings of the instance
+      gcloud_zone: The zone that gcloud is configured to use
+    Returns:
+      A Namespace like the one that `datalab create` would receive.
+    """
+    parser = argparse.ArgumentParser()
+    create.flags(parser)
+    command_line = [name]
+    for key in _CREATE_SETTINGS:
+        value = settings.get(key)
+        if key == 'zone' or value is None or value is False:
+            continue
+        elif value is True:
+            command_line.append('--' + key)
+        elif isinstance(value, list):
+            for item in value:
+                command_line.extend(['--' + key, str(item)])
+        else:
+            command_line.extend(['--' + key, str(value)])
+    create_args = parser.parse_args(command_line)
+    create_args.zone = settings.get('zone') or args.zone or gcloud_zone
+    create_args.project = args.project
+    create_args.verbosity = args.verbosity
+    create_args.quiet = True
+    create_args.no_connect = True
+    for attr in ['gcloud_project', 'compute_backend']:
+        if hasattr(args, attr):
+            setattr(create_args, attr, getattr(args, attr))
+    return create_args
+
+
+def _disk_size_gb(disk):
+    try:
+        return int(disk.get('sizeGb'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _plan(args, desired, live_instances, live_disks, live_networks, prune,
+          gcloud_zone):
+    """Compare the desired instances with the live ones.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      desired: The dictionary of desired instances and their settings
+      live_instances: The list of live Datalab instance resources
+      live_disks: The list of live disk resources
+      live_networks: The list of live network resources
+      prune: Whether to delete live instances that are not desired
+      gcloud_zone: The zone that gcloud is configured to use
+    Returns:
+      A tuple of the list of networks to create, the dictionary mapping
+      instance names to the list of changes to make to them, and the list
+      of warnings about differences that cannot be reconciled. Each change
+      is a tuple of a description and the arguments of its step.
+    """
+    network_names = set(n.get('name') for n in live_networks)
+    instances = dict((i.get('name'), i) for i in live_instances)
+    disks = dict(((utils.instance_zone(d), d.get('name')), d)
+                 for d in live_disks)
+
+    missing_networks = set()
+    changes = {}
+    warnings = []
+    for name in sorted(desired):
+        create_args = _create_args(args, name, desired[name], gcloud_zone)
+        zone = create_args.zone
+        status = desired[name].get('status', _STATUS_RUNNING)
+        disk_name = create_args.disk_name or '{0}-pd'.format(name)
+        disk = disks.get((zone, disk_name))
+        steps = []
+        if not zone:
+            warnings.append('{} has no zone, so it is skipped'.format(name))
+            continue
+        if create_args.network_name not in network_names:
+            missing_networks.add(create_args.network_name)
+
+        # The size of an existing disk is only compared with an
+        # explicit setting, rather than with the default for new disks.
+        disk_size = None
+        if disk and desired[name].get('disk-size-gb') is not None:
+            disk_size = _disk_size_gb(disk)
+        if disk_size is not None and disk_size < create_args.disk_size_gb:
+            steps.append((
+                'grow the disk [{}] from {}GB to {}GB'.format(
+                    disk_name, disk_size, create_args.disk_size_gb),
+                ('resize-disk', create_args, disk_name)))
+        elif disk_size is not None and disk_size > create_args.disk_size_gb:
+            warnings.append(
+                'the disk {} is larger than {}GB, and cannot be '
+                'shrunk'.format(disk_name, create_args.disk_size_gb))
+
+        instance = instances.get(name)
+        if not instance:
+            steps.append((
+                'create the instance [{}] in [{}]'.format(name, zone),
+                ('create', create_args)))
+            if status == _STATUS_TERMINATED:
+                steps.append((
+                    'stop the instance [{}]'.format(name),
+                    ('stop', create_args)))
+            changes[name] = steps
+            continue
+
+        live_zone = utils.instance_zone(instance)
+        if live_zone != zone:
+            warnings.append(
+                '{} is in {} rather than {}, and must be deleted to be '
+                'moved'.format(name, live_zone, zone))
+            continue
+        live_user = utils.flatten_metadata(
+            instance.get('metadata', {})).get('for-user')
+        if create_args.for_user and live_user != create_args.for_user:
+            warnings.append(
+                '{} was created for {} rather than {}, and must be '
+                'deleted to be changed'.format(
+                    name, live_user, create_args.for_user))
+
+        # Likewise, the machine type is only compared with an explicit
+        # setting.
+        live_status = instance.get('status')
+        machine_type = instance.get('machineType', '').rsplit('/', 1)[-1]
+        if (desired[name].get('machine-type') is not None and
+                machine_type != create_args.machine_type):
+            if live_status != _STATUS_TERMINATED:
+                steps.append((
+                    'stop the instance [{}]'.format(name),
+                    ('stop', create_args)))
+                live_status = _STATUS_TERMINATED
+            steps.append((
+                'change the machine type of [{}] from {} to {}'.format(
+                    name, machine_type, create_args.machine_type),
+                ('set-machine-type', create_args)))
+        if status == _STATUS_RUNNING and live_status == _STATUS_TERMINATED:
+            steps.append((
+                'start the instance [{}]'.format(name),
+                ('start', create_args)))
+        elif (status == _STATUS_TERMINATED and
+                live_status != _STATUS_TERMINATED):
+            steps.append((
+                'stop the instance [{}]'.format(name),
+                ('stop', create_args)))
+        if steps:
+            changes[name] = steps
+
+    if prune:
+        for name in sorted(set(instances) - set(desired)):
+            delete_args = copy.copy(args)
+            delete_args.zone = utils.instance_zone(instances[name])
+            changes[name] = [(
+                'delete the instance [{}] in [{}]'.format(
+                    name, delete_args.zone),
+                ('delete', delete_args))]
+    return sorted(missing_networks), changes, warnings
+
+
+def _run_step(step, name, gcloud_compute, create_kwargs):
+    """Run a single step of the changes to an instance.
+
+    Args:
+      step: The tuple of the kind of step and its arguments
+      name: The name of the instance
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      create_kwargs: The keyword arguments to pass to `create.run`
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+    """
+    kind, step_args = step[0], step[1]
+    zone_flag = ['--zone', step_args.zone]
+    if kind == 'create':
+        create.run(step_args, gcloud_compute, **create_kwargs)
+    elif kind == 'resize-disk':
+        utils.call_gcloud_quietly(step_args, gcloud_compute, [
+            'disks', 'resize'] + zone_flag + [
+            '--size', '{}GB'.format(step_args.disk_size_gb), step[2]])
+    elif kind == 'set-machine-type':
+        utils.call_gcloud_quietly(step_args, gcloud_compute, [
+            'instances', 'set-machine-type'] + zone_flag + [
+            '--machine-type', step_args.machine_type, name])
+    elif kind in ['start', 'stop', 'delete']:
+        utils.call_gcloud_quietly(step_args, gcloud_compute, [
+            'instances', kind] + zone_flag + [name])
+    utils.invalidate_instance_record(step_args, name)
+
+
+def run(args, gcloud_compute, gcloud_repos=None, gcloud_zone=None,
+        **kwargs):
+    """Implementation of the `datalab apply` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      gcloud_repos: Function that can be used to invoke
+        `gcloud source repos`
+      gcloud_zone: The zone that gcloud is configured to use
+      kwargs: The remaining keyword arguments to pass to `create.run`
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      InvalidFleetFileException: If the fleet file is malformed
+    """
+    desired, prune = load_fleet(args.file)
+    prune = prune or args.prune
+
+    live = utils.run_concurrently({
+        'instances': lambda: utils.list_instances(
+            args, gcloud_compute, utils.instances_filter()),
+        'disks': lambda: utils.list_resources(
+            args, gcloud_compute, 'disks',
+            resource_format='json(name,zone,sizeGb)'),
+        'networks': lambda: utils.list_resources(
+            args, gcloud_compute, 'networks', resource_format='json(name)'),
+    })
+    missing_networks, changes, warnings = _plan(
+        args, desired, live['instances'], live['disks'], live['networks'],
+        prune, gcloud_zone)
+    for warning in warnings:
+        print('WARNING: ' + warning)
+    if not (missing_networks or changes):
+        print('The fleet is up to date.')
+        return
+
+    descriptions = [' - create the network [{}]'.format(network)
+                    for network in missing_networks]
+    for name in sorted(changes):
+        descriptions.extend(' - ' + step[0] for step in changes[name])
+    message = _PLAN_PROMPT.format('\n'.join(descriptions))
+    if args.dry_run:
+        print(message)
+        return
+    if not utils.prompt_for_confirmation(
+            args=args, message=message, accept_by_default=True):
+        print('Apply aborted by user; Exiting.')
+        return
+
+    # Shared resources are created up front, so that concurrent
+    # creations of instances do not race to create them.
+    for network in missing_networks:
+        create.create_network(args, gcloud_compute, network)
+        create.ensure_firewall_rule_exists(args, gcloud_compute, network)
+    create_steps = [step[1][1] for steps in changes.values()
+                    for step in steps if step[1][0] == 'create']
+    if any(not create_args.no_create_repository
+           for create_args in create_steps):
+        create.ensure_repo_exists(
+            args, gcloud_repos, create._DATALAB_NOTEBOOKS_REPOSITORY)
+    for create_args in create_steps:
+        create_args.no_create_repository = True
+
+    create_kwargs = dict(kwargs)
+    create_kwargs.update(gcloud_repos=gcloud_repos, gcloud_zone=gcloud_zone)
+
+    def apply_changes(name):
+        for _, step in changes[name]:
+            _run_step(step, name, gcloud_compute, create_kwargs)
+
+    utils.run_concurrently(
+        dict((name, lambda name=name: apply_changes(name))
+             for name in changes),
+        max_workers=max(1, args.max_concurrency))
+    print('Applied {} changes to {} instances'.format(
+        len(descriptions) - len(missing_networks), len(changes)))
+    return
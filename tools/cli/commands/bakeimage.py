@@ -0,0 +1,247 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab bake-image` command."""
+
+from __future__ import absolute_import
+
+import os
+import tempfile
+import time
+
+from . import accelerators, connect, create, creategpu, utils
+
+
+description = ("""`{0} {1}` saves a boot image for Datalab instances with
+the Datalab image, and for GPU images the GPU driver, already on it.
+
+A temporary builder VM is booted from the same startup script as new
+instances, pulls the image and if needed builds the driver, and is then
+stopped so that its boot disk can be saved in an image family. Instances
+created with `{0} create --from-baked-image` boot from the latest image
+in the family, and skip pulling the image and building the driver.
+
+Bake a new image to pick up a newly published Datalab image.""")
+
+
+examples = ("""
+To bake the latest Datalab image into the image family 'datalab-baked':
+
+    $ {0} {1}
+
+To bake the latest Datalab GPU image and its driver for T4 GPUs:
+
+    $ {0} {1} --gpu --accelerator-type nvidia-tesla-t4
+
+To then create an instance from the baked image:
+
+    $ {0} create --from-baked-image my-instance
+""")
+
+
+_BUILDER_NAME_TEMPLATE = 'datalab-bake-{}'
+_IMAGE_NAME_TEMPLATE = '{}-{}'
+
+_DEFAULT_MACHINE_TYPE = 'n1-standard-4'
+_DEFAULT_TIMEOUT_SECONDS = 30 * 60
+_POLL_SECONDS = 10
+
+_BAKE_DONE = 'bake-done'
+_BAKE_FAILED = 'bake-failed'
+
+
+class BakeFailedException(Exception):
+
+    _MESSAGE = (
+        'Failed to bake the image on the builder instance {0}: {1}'
+        '\n\n'
+        'The instance has been kept so that its serial port output can be '
+        'inspected. Delete it with `gcloud compute instances delete {0}`.')
+
+    def __init__(self, builder, reason):
+        super(BakeFailedException, self).__init__(
+            BakeFailedException._MESSAGE.format(builder, reason))
+
+
+def flags(parser):
+    """Add command line flags for the `bake-image` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    create.image_flags(parser)
+    parser.set_defaults(image_name=None)
+    parser.add_argument(
+        '--image-family',
+        dest='image_family',
+        default=None,
+        help=('the image family in which to save the baked image. Defaults '
+              'to `{}`, or `{}` with `--gpu`.'.format(
+                  create._BAKED_IMAGE_FAMILY,
+                  create._BAKED_GPU_IMAGE_FAMILY)))
+    parser.add_argument(
+        '--gpu',
+        dest='gpu',
+        action='store_true',
+        default=False,
+        help=('bake the Datalab GPU image, along with a build of the GPU '
+              'driver for the accelerator type'))
+    parser.add_argument(
+        '--accelerator-type',
+        dest='accelerator_type',
+        choices=sorted(accelerators.SUPPORTED_ACCELERATORS),
+        default='nvidia-tesla-k80',
+        help=('the accelerator type whose driver is built with `--gpu`. The '
+              'builder VM needs one such GPU to verify the driver.'))
+    parser.add_argument(
+        '--machine-type',
+        dest='machine_type',
+        default=_DEFAULT_MACHINE_TYPE,
+        help='the machine type of the builder VM.')
+    parser.add_argument(
+        '--network-name',
+        dest='network_name',
+        default=create._DATALAB_NETWORK,
+        help='name of the network to which the builder VM is attached.')
+    parser.add_argument(
+        '--timeout',
+        dest='timeout',
+        type=int,
+        default=_DEFAULT_TIMEOUT_SECONDS,
+        help=('the maximum number of seconds to wait for the builder VM '
+              'to pull the image and build the driver.'))
+    return
+
+
+def _create_builder(args, gcloud_compute, builder, gpu_driver_files):
+    with tempfile.NamedTemporaryFile(mode='w', delete=False) \
+            as startup_script_file:
+        try:
+            startup_script_file.write(create.bake_startup_script(
+                args, gpu_driver_files=gpu_driver_files))
+            startup_script_file.close()
+            cmd = ['instances', 'create', '--zone', args.zone,
+                   '--format=none',
+                   '--boot-disk-size=20GB',
+                   '--network', args.network_name,
+                   '--image-family', 'cos-stable',
+                   '--image-project', 'cos-cloud',
+                   '--machine-type', args.machine_type,
+                   '--metadata-from-file',
+                   'startup-script=' + startup_script_file.name,
+                   '--scopes', 'cloud-platform']
+            if gpu_driver_files:
+                cmd.extend([
+                    '--accelerator',
+                    'type={},count=1'.format(args.accelerator_type),
+                    '--maintenance-policy', 'TERMINATE'])
+            cmd.append(builder)
+            utils.call_gcloud_quietly(args, gcloud_compute, cmd)
+        finally:
+            os.remove(startup_script_file.name)
+
+
+def _wait_for_bake(args, gcloud_compute, builder):
+    progress = connect.BootProgress(args, gcloud_compute, builder)
+    deadline = time.time() + args.timeout
+    while True:
+        progress.poll()
+        if progress.seen(_BAKE_DONE):
+            return
+        if progress.seen(_BAKE_FAILED):
+            raise BakeFailedException(
+                builder, 'the startup script reported a failure')
+        if time.time() > deadline:
+            raise BakeFailedException(
+                builder, 'timed out after {} seconds'.format(args.timeout))
+        time.sleep(_POLL_SECONDS)
+
+
+def run(args, gcloud_compute, gcloud_zone=None, **unused_kwargs):
+    """Implementation of the `datalab bake-image` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      gcloud_zone: The zone that gcloud is configured to use
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      BakeFailedException: If the builder VM failed to bake the image
+      accelerators.UnavailableAcceleratorException: If the zone does not
+        offer the requested accelerator
+    """
+    gpu_driver_files = None
+    if args.gpu:
+        driver_version = accelerators.driver_version(args.accelerator_type)
+        if not utils.prompt_for_confirmation(
+                args=args,
+                message=creategpu._THIRD_PARTY_SOFTWARE_DIALOG.format(
+                    driver_version),
+                question='Do you accept',
+                accept_by_default=False):
+            print('Installation not accepted; Exiting.')
+            return
+        gpu_driver_files = creategpu.gpu_driver_files(driver_version, '')
+
+    if not args.zone:
+        args.zone = gcloud_zone
+    if (not args.zone) and (not args.quiet):
+        args.zone = utils.prompt_for_zone(args, gcloud_compute)
+    if args.gpu:
+        accelerators.check_availability(
+            args, gcloud_compute, args.accelerator_type, 1)
+        default_image, default_family = (
+            create._DATALAB_GPU_IMAGE, create._BAKED_GPU_IMAGE_FAMILY)
+    else:
+        default_image, default_family = (
+            create._DATALAB_IMAGE, create._BAKED_IMAGE_FAMILY)
+    args.image_name = args.image_name or default_image
+    args.image_name = create.regional_image_name(args)
+    family = args.image_family or default_family
+    create.ensure_network_exists(args, gcloud_compute, args.network_name)
+
+    stamp = int(time.time())
+    builder = _BUILDER_NAME_TEMPLATE.format(stamp)
+    image = _IMAGE_NAME_TEMPLATE.format(family, stamp)
+    print('Creating the builder instance {}'.format(builder))
+    _create_builder(args, gcloud_compute, builder, gpu_driver_files)
+    keep_builder = False
+    try:
+        _wait_for_bake(args, gcloud_compute, builder)
+        print('Stopping the builder instance {}'.format(builder))
+        utils.call_gcloud_quietly(args, gcloud_compute, [
+            'instances', 'stop', '--zone', args.zone, builder])
+        print('Saving the image {} in the family {}'.format(image, family))
+        utils.call_gcloud_quietly(args, gcloud_compute, [
+            'images', 'create', '--format=none',
+            '--source-disk', builder,
+            '--source-disk-zone', args.zone,
+            '--family', family,
+            '--description', create.baked_image_description(args.image_name),
+            image])
+    except BakeFailedException:
+        keep_builder = True
+        raise
+    finally:
+        if not keep_builder:
+            print('Deleting the builder instance {}'.format(builder))
+            utils.call_gcloud_quietly(args, gcloud_compute, [
+                'instances', 'delete', '--quiet', '--zone', args.zone,
+                builder])
+    create_command = 'beta create-gpu' if args.gpu else 'create'
+    print('Baked the image {}. Create instances from it with '
+          '`datalab {} --from-baked-image{}`.'.format(
+              image, create_command,
+              '' if family == default_family else ' ' + family))
+    return
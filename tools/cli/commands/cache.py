@@ -0,0 +1,210 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-user, on-disk cache for values that are expensive to look up."""
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+
+from . import localstate
+
+
+_SESSION_CACHE_FILE = 'session-cache.json'
+
+
+# Files under the gcloud config directory whose modification
+# invalidates every cached value. These cover the active configuration
+# (account, project, zone) as well as the stored credentials.
+#
+# The access token database is deliberately left out, as gcloud
+# rewrites it every time that it refreshes a token.
+_GCLOUD_CONFIG_FILES = [
+    'active_config',
+    'config_sentinel',
+    'credentials.db',
+]
+
+
+# Environment variables that override the gcloud configuration.
+_GCLOUD_CONFIG_ENV_VARS = [
+    'CLOUDSDK_ACTIVE_CONFIG_NAME',
+    'CLOUDSDK_COMPUTE_ZONE',
+    'CLOUDSDK_CONFIG',
+    'CLOUDSDK_CORE_ACCOUNT',
+    'CLOUDSDK_CORE_PROJECT',
+]
+
+
+def gcloud_config_dir():
+    """Get the directory in which gcloud stores its configuration.
+
+    Returns:
+      The path of the gcloud config directory.
+    """
+    config_dir = os.environ.get('CLOUDSDK_CONFIG')
+    if config_dir:
+        return config_dir
+    if os.name == 'nt' and os.environ.get('APPDATA'):
+        return os.path.join(os.environ['APPDATA'], 'gcloud')
+    return os.path.join(os.path.expanduser('~'), '.config', 'gcloud')
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def gcloud_config_fingerprint(gcloud_cmd):
+    """Compute a value that changes whenever the gcloud config changes.
+
+    Args:
+      gcloud_cmd: The command used to invoke gcloud
+    Returns:
+      A JSON-serializable fingerprint of the gcloud configuration.
+    """
+    config_dir = gcloud_config_dir()
+    fingerprint = {
+        'gcloud-cmd': gcloud_cmd,
+        'config-dir': config_dir,
+    }
+    for name in _GCLOUD_CONFIG_FILES:
+        fingerprint[name] = _mtime(os.path.join(config_dir, name))
+    configurations_dir = os.path.join(config_dir, 'configurations')
+    fingerprint['configurations'] = _mtime(configurations_dir)
+    if os.path.isdir(configurations_dir):
+        for name in sorted(os.listdir(configurations_dir)):
+            fingerprint['configurations/' + name] = _mtime(
+                os.path.join(configurations_dir, name))
+    for name in _GCLOUD_CONFIG_ENV_VARS:
+        fingerprint[name] = os.environ.get(name)
+    return fingerprint
+
+
+class SessionCache(object):
+    """A cache of values that are shared between invocations of the CLI.
+
+    Each entry is stored with the time it was written, and is only
+    returned while it is younger than the time-to-live given when it
+    is read. All entries are discarded if the fingerprint that the cache
+    was written with does not match the current one.
+
+    Access is thread-safe, so that concurrent lookups can share a cache.
+    """
+
+    def __init__(self, path, fingerprint):
+        self._path = path
+        self._fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._dirty = False
+        contents = {}
+        if path:
+            contents = localstate.read_json_file(path, default={})
+        if (not isinstance(contents, dict) or
+                contents.get('fingerprint') != fingerprint):
+            contents = {}
+            self._dirty = True
+        self._entries = contents.get('entries', {})
+
+    def get(self, key, ttl_seconds):
+        """Get the cached value for the given key.
+
+        Args:
+          key: The name of the cached value.
+          ttl_seconds: The maximum age, in seconds, of a usable entry.
+        Returns:
+          The cached value, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if not entry:
+            return None
+        age = time.time() - entry.get('timestamp', 0)
+        if age < 0 or age > ttl_seconds:
+            return None
+        return entry.get('value')
+
+    def put(self, key, value):
+        """Store the given value in the cache.
+
+        Args:
+          key: The name of the cached value.
+          value: A JSON-serializable value.
+        """
+        with self._lock:
+            self._entries[key] = {'timestamp': time.time(), 'value': value}
+            self._dirty = True
+
+    def invalidate(self, key):
+        """Remove the cached value for the given key, if any."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def get_or_compute(self, key, ttl_seconds, compute_fn):
+        """Get the cached value for the key, computing it if necessary.
+
+        Args:
+          key: The name of the cached value.
+          ttl_seconds: The maximum age, in seconds, of a usable entry.
+          compute_fn: A function taking no arguments that computes the
+            value. Its result is only cached if it is not None.
+        Returns:
+          The cached or computed value.
+        """
+        value = self.get(key, ttl_seconds)
+        if value is None:
+            value = compute_fn()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def save(self):
+        """Write the cache back to disk if it has been modified.
+
+        Failures are ignored, since the cache is purely an optimization.
+        """
+        with self._lock:
+            if not (self._dirty and self._path):
+                return
+            contents = {
+                'fingerprint': self._fingerprint,
+                'entries': self._entries,
+            }
+            try:
+                localstate.write_json_file(self._path, contents)
+                self._dirty = False
+            except (IOError, OSError):
+                pass
+
+
+def session_cache(gcloud_cmd):
+    """Load the per-user session cache.
+
+    Args:
+      gcloud_cmd: The command used to invoke gcloud
+    Returns:
+      A SessionCache instance. If the per-user config directory is not
+      usable, then the returned cache is only kept in memory.
+    """
+    try:
+        path = os.path.join(
+            localstate.datalab_config_dir(), _SESSION_CACHE_FILE)
+    except (IOError, OSError):
+        path = None
+    return SessionCache(path, gcloud_config_fingerprint(gcloud_cmd))
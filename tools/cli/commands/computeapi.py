@@ -0,0 +1,1128 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process client for the Google Compute Engine API.
+
+Running a `gcloud compute` command starts a new Python interpreter,
+loads the Cloud SDK, and refreshes the user's credentials, which adds
+up to seconds per call. The `ComputeBackend` class defined here accepts
+the same arguments as the `gcloud_compute` function, and handles the
+`gcloud compute` commands used by this tool by calling the Compute
+Engine REST API directly over a pool of keep-alive HTTP connections.
+
+Any command that it does not understand (for example, `ssh`) is passed
+through unchanged to gcloud.
+
+The API endpoint honors the same override as gcloud, which is the
+CLOUDSDK_API_ENDPOINT_OVERRIDES_COMPUTE environment variable, and the
+access token can be read from the file named by the
+CLOUDSDK_AUTH_ACCESS_TOKEN_FILE environment variable. Together, these
+allow running against a local fake of the Compute Engine API.
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import http.client as httplib
+    from queue import Queue, Empty
+    from urllib.parse import quote, urlencode, urlsplit
+except ImportError:
+    import httplib
+    from Queue import Queue, Empty
+    from urllib import quote, urlencode
+    from urlparse import urlsplit
+
+from . import utils
+
+
+_DEFAULT_ENDPOINT = 'https://compute.googleapis.com/compute/'
+
+_ENDPOINT_OVERRIDE_ENV_VAR = 'CLOUDSDK_API_ENDPOINT_OVERRIDES_COMPUTE'
+_ACCESS_TOKEN_FILE_ENV_VAR = 'CLOUDSDK_AUTH_ACCESS_TOKEN_FILE'
+
+# Maximum number of idle connections kept open to the API.
+_MAX_IDLE_CONNECTIONS = 8
+
+_REQUEST_TIMEOUT_SECONDS = 60
+
+# Credentials are refreshed this many seconds before they expire.
+_CREDENTIAL_EXPIRY_MARGIN_SECONDS = 60
+
+# Session cache key and time-to-live for the cached access token. The
+# real lifetime of the token is enforced using its expiry time.
+_CREDENTIAL_CACHE_KEY = 'compute-credential'
+_CREDENTIAL_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+_OPERATION_POLL_INITIAL_SECONDS = 0.5
+_OPERATION_POLL_MAX_SECONDS = 5
+
+# Maximum number of requests issued at once for a multi-instance command.
+_MAX_CONCURRENT_REQUESTS = 10
+
+
+# The supported commands, and the flags that take a value for each of
+# them. Any other command or flag is run by gcloud instead.
+_COMMON_VALUE_FLAGS = ['--format', '--zone']
+_COMMANDS = {
+    ('accelerator-types', 'list'): ['--filter'],
+    ('disks', 'create'): [
+        '--description', '--size', '--source-snapshot', '--type'],
+    ('disks', 'describe'): [],
+    ('disks', 'list'): ['--filter'],
+    ('disks', 'resize'): ['--size'],
+    ('disks', 'snapshot'): ['--description', '--labels', '--snapshot-names'],
+    ('firewall-rules', 'create'): ['--allow', '--description', '--network'],
+    ('firewall-rules', 'describe'): [],
+    ('firewall-rules', 'list'): ['--filter'],
+    ('instances', 'delete'): ['--delete-disks', '--keep-disks'],
+    ('instances', 'describe'): [],
+    ('instances', 'get-serial-port-output'): ['--port', '--start'],
+    ('instances', 'list'): ['--filter'],
+    ('instances', 'set-machine-type'): ['--machine-type'],
+    ('instances', 'start'): [],
+    ('instances', 'stop'): ['--discard-local-ssd'],
+    ('machine-types', 'describe'): [],
+    ('networks', 'create'): ['--description'],
+    ('networks', 'describe'): [],
+    ('networks', 'list'): ['--filter'],
+    ('operations', 'describe'): [],
+    ('snapshots', 'describe'): [],
+    ('zones', 'describe'): [],
+    ('zones', 'list'): ['--filter'],
+}
+_BOOLEAN_FLAGS = ['--quiet']
+
+# The commands that accept more than one resource name.
+_MULTIPLE_NAME_COMMANDS = [
+    ('instances', 'delete'),
+    ('instances', 'start'),
+    ('instances', 'stop'),
+]
+
+# Mapping from `gcloud compute` resource names to their API collections.
+_COLLECTIONS = {
+    'accelerator-types': 'acceleratorTypes',
+    'disks': 'disks',
+    'firewall-rules': 'firewalls',
+    'instances': 'instances',
+    'machine-types': 'machineTypes',
+    'networks': 'networks',
+    'operations': 'operations',
+    'snapshots': 'snapshots',
+    'zones': 'zones',
+}
+_ZONAL_COLLECTIONS = [
+    'accelerator-types', 'disks', 'instances', 'machine-types', 'operations']
+
+# Fields printed by `value(...)` formats as the last component of
+# their URL, the same as gcloud displays them.
+_BASENAME_FIELDS = ['machineType', 'network', 'region', 'zone']
+
+try:
+    _STRING_TYPES = (str, unicode)  # noqa: F821
+except NameError:
+    _STRING_TYPES = (str,)
+
+# Matches the size flag of `gcloud compute disks create`, e.g. "200GB".
+_SIZE_PATTERN = re.compile(r'^(\d+)\s*(GB|TB)?$', re.IGNORECASE)
+
+
+class UnsupportedCommandException(Exception):
+    """The command is not one that the API backend can run itself."""
+    pass
+
+
+class ApiException(Exception):
+    """A call to the Compute Engine API failed."""
+
+    def __init__(self, status, message):
+        super(ApiException, self).__init__(message)
+        self.status = status
+
+
+def _basename(value):
+    if isinstance(value, _STRING_TYPES) and '/' in value:
+        return value.rstrip('/').rsplit('/', 1)[-1]
+    return value
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, _STRING_TYPES):
+        return value
+    if isinstance(value, bool):
+        return 'True' if value else 'False'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return '{}'.format(value)
+
+
+def _write(stream, text):
+    """Write text to a stream as passed to subprocess calls."""
+    if not text:
+        return
+    if stream is None:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return
+    try:
+        stream.write(text.encode('utf-8'))
+    except TypeError:
+        stream.write(text)
+    stream.flush()
+
+
+def _write_error(stream, text):
+    if stream is None:
+        sys.stderr.write(text)
+        sys.stderr.flush()
+    else:
+        _write(stream, text)
+
+
+def _lookup(resource, path):
+    """Get the values at the given dotted path within a resource.
+
+    Lists along the path are flattened, so looking up `tags.items`
+    returns the list of tags.
+
+    Returns:
+      A list of the values found at the path.
+    """
+    values = [resource]
+    for key in path.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                value = [v.get(key) for v in value if isinstance(v, dict)]
+                next_values.extend(v for v in value if v is not None)
+            elif isinstance(value, dict) and key in value:
+                next_values.append(value[key])
+        values = next_values
+    flattened = []
+    for value in values:
+        if isinstance(value, list):
+            flattened.extend(value)
+        else:
+            flattened.append(value)
+    return flattened
+
+
+def _tokenize_filter(expr):
+    tokens = []
+    i = 0
+    while i < len(expr):
+        c = expr[i]
+        if c.isspace():
+            i += 1
+        elif c in '()':
+            tokens.append(c)
+            i += 1
+        elif c in '\'"':
+            end = expr.find(c, i + 1)
+            if end < 0:
+                raise UnsupportedCommandException(expr)
+            tokens.append(('literal', expr[i + 1:end]))
+            i = end + 1
+        else:
+            start = i
+            while (i < len(expr) and not expr[i].isspace() and
+                   expr[i] not in '()\'"'):
+                i += 1
+            tokens.append(expr[start:i])
+    return tokens
+
+
+_FILTER_TERM_PATTERN = re.compile(r'^([A-Za-z][\w.]*)(!=|=|:|~)(.*)$')
+
+
+class _Filter(object):
+    """A subset of the gcloud filter language, evaluated client-side.
+
+    This supports conjunctions of `key=value`, `key!=value`,
+    `key:value`, and `key~regex` terms, optionally grouped with
+    parentheses, where the value may be a parenthesized list of
+    alternatives. Anything else raises an UnsupportedCommandException.
+    """
+
+    def __init__(self, expr):
+        self._tokens = _tokenize_filter(expr)
+        self._pos = 0
+        self._terms = self._parse_conjunction()
+        if self._pos != len(self._tokens):
+            raise UnsupportedCommandException(expr)
+
+    def _next(self):
+        if self._pos >= len(self._tokens):
+            raise UnsupportedCommandException('incomplete filter')
+        token = self._tokens[self._pos]
+        self._pos += 1
+        return token
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None
+
+    def _parse_conjunction(self):
+        terms = []
+        while self._peek() not in (None, ')'):
+            token = self._next()
+            if token == '(':
+                terms.extend(self._parse_conjunction())
+                if self._next() != ')':
+                    raise UnsupportedCommandException('unbalanced filter')
+            elif token == 'AND':
+                continue
+            elif isinstance(token, _STRING_TYPES):
+                terms.append(self._parse_term(token))
+            else:
+                raise UnsupportedCommandException('unexpected literal')
+        return terms
+
+    def _parse_term(self, token):
+        match = _FILTER_TERM_PATTERN.match(token)
+        if not match or token in ('OR', 'NOT'):
+            raise UnsupportedCommandException(token)
+        key, op, operand = match.groups()
+        if operand:
+            operands = [operand]
+        elif self._peek() == '(':
+            self._next()
+            operands = []
+            while self._peek() != ')':
+                value = self._next()
+                if value == '(':
+                    raise UnsupportedCommandException('nested values')
+                operands.append(
+                    value[1] if isinstance(value, tuple) else value)
+            self._next()
+        else:
+            value = self._next()
+            if not isinstance(value, tuple):
+                raise UnsupportedCommandException(token)
+            operands = [value[1]]
+        if op == '~':
+            try:
+                operands = [re.compile(o) for o in operands]
+            except re.error:
+                raise UnsupportedCommandException(operand)
+        return (key, op, operands)
+
+    @staticmethod
+    def _matches_one(op, operand, value):
+        candidates = [_text(value)]
+        if isinstance(value, _STRING_TYPES):
+            candidates.append(_basename(value))
+        if op == '~':
+            return any(operand.search(c) for c in candidates)
+        if op == ':':
+            operand = operand.lower()
+            for candidate in candidates:
+                candidate = candidate.lower()
+                if operand.endswith('*'):
+                    if candidate.startswith(operand[:-1]):
+                        return True
+                elif candidate == operand:
+                    return True
+            return False
+        return operand in candidates
+
+    def matches(self, resource):
+        for key, op, operands in self._terms:
+            values = _lookup(resource, key)
+            found = any(
+                _Filter._matches_one('=' if op == '!=' else op, o, v)
+                for o in operands for v in values)
+            if found == (op == '!='):
+                return False
+        return True
+
+
+def _parse_format(format_spec):
+    """Parse a `--format` value into a kind and a list of fields.
+
+    Supported formats are `none`, `json`, `json(...)`, and `value(...)`.
+    """
+    match = re.match(r'^(none|json|value)(?:\((.*)\))?$', format_spec or '')
+    if not match:
+        raise UnsupportedCommandException(format_spec)
+    kind, fields = match.groups()
+    fields = [f.strip() for f in (fields or '').split(',') if f.strip()]
+    if kind == 'value' and not fields:
+        raise UnsupportedCommandException(format_spec)
+    return kind, fields
+
+
+def _project_resource(resource, fields):
+    """Restrict the resource to the given dotted field paths."""
+    if not fields:
+        return resource
+    projected = {}
+    for field in fields:
+        source = resource
+        target = projected
+        keys = field.split('.')
+        for i, key in enumerate(keys):
+            if not isinstance(source, dict) or key not in source:
+                break
+            if i == len(keys) - 1:
+                target[key] = source[key]
+            else:
+                source = source[key]
+                target = target.setdefault(key, {})
+    return projected
+
+
+def _format_value(resource, fields):
+    columns = []
+    for field in fields:
+        values = _lookup(resource, field)
+        if field.split('.')[-1] in _BASENAME_FIELDS:
+            values = [_basename(v) for v in values]
+        columns.append(';'.join(_text(v) for v in values))
+    return '\t'.join(columns) + '\n'
+
+
+def format_resources(format_spec, resources, is_list):
+    """Render resources the same way as the given gcloud `--format`.
+
+    Args:
+      format_spec: The value of the `--format` flag
+      resources: The list of resources to render
+      is_list: Whether the resources came from a `list` command
+    Returns:
+      The rendered text.
+    Raises:
+      UnsupportedCommandException: If the format is not supported.
+    """
+    kind, fields = _parse_format(format_spec)
+    if kind == 'none':
+        return ''
+    if kind == 'value':
+        return ''.join(_format_value(r, fields) for r in resources)
+    projected = [_project_resource(r, fields) for r in resources]
+    if not is_list:
+        projected = projected[0] if projected else {}
+    return json.dumps(projected, indent=2, sort_keys=True) + '\n'
+
+
+def _parse_timestamp(value):
+    try:
+        expiry = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+    except (TypeError, ValueError):
+        return 0
+    epoch = datetime.datetime(1970, 1, 1)
+    return (expiry - epoch).total_seconds()
+
+
+class Credentials(object):
+    """Access token and default properties for calling the API.
+
+    The token is obtained from `gcloud config config-helper`, which
+    refreshes it if necessary, and is kept in the session cache until
+    shortly before it expires. This means that gcloud only needs to be
+    run about once an hour, rather than once per API call.
+    """
+
+    def __init__(self, gcloud_cmd, session_cache=None):
+        self._gcloud_cmd = gcloud_cmd
+        self._session_cache = session_cache
+        self._lock = threading.Lock()
+        self._credential = None
+
+    def _cached(self):
+        if self._credential is None and self._session_cache:
+            self._credential = self._session_cache.get(
+                _CREDENTIAL_CACHE_KEY, _CREDENTIAL_CACHE_TTL_SECONDS)
+        credential = self._credential
+        if not credential:
+            return None
+        remaining = credential.get('expiry', 0) - time.time()
+        if remaining < _CREDENTIAL_EXPIRY_MARGIN_SECONDS:
+            return None
+        return credential
+
+    def _fetch(self):
+        token_file = os.environ.get(_ACCESS_TOKEN_FILE_ENV_VAR)
+        if token_file:
+            with open(token_file, 'r') as f:
+                token = f.read().strip()
+            return {
+                'access-token': token,
+                'expiry': time.time() + 60 * 60,
+                'project': os.environ.get('CLOUDSDK_CORE_PROJECT', ''),
+                'zone': os.environ.get('CLOUDSDK_COMPUTE_ZONE', ''),
+            }
+        with open(os.devnull, 'w') as dn:
+            helper_json = subprocess.check_output(
+                [self._gcloud_cmd, 'config', 'config-helper',
+                 '--format=json'], stderr=dn).decode('utf-8')
+        helper = json.loads(helper_json)
+        credential = helper.get('credential', {})
+        properties = helper.get('configuration', {}).get('properties', {})
+        return {
+            'access-token': credential.get('access_token', ''),
+            'expiry': _parse_timestamp(credential.get('token_expiry')),
+            'project': properties.get('core', {}).get('project', ''),
+            'zone': properties.get('compute', {}).get('zone', ''),
+        }
+
+    def get(self, force_refresh=False):
+        """Get the current credential.
+
+        Args:
+          force_refresh: Whether to ignore any cached credential.
+        Returns:
+          A dictionary with the 'access-token', 'expiry', 'project',
+          and 'zone' keys.
+        Raises:
+          subprocess.CalledProcessError: If gcloud fails to provide one.
+        """
+        with self._lock:
+            credential = None if force_refresh else self._cached()
+            if not credential:
+                credential = self._fetch()
+                self._credential = credential
+                if self._session_cache:
+                    self._session_cache.put(
+                        _CREDENTIAL_CACHE_KEY, credential)
+                    self._session_cache.save()
+            return credential
+
+
+class ComputeClient(object):
+    """Minimal, thread-safe client for the Compute Engine REST API.
+
+    Connections are kept alive and reused across calls, and up to
+    _MAX_IDLE_CONNECTIONS of them are pooled for concurrent callers.
+    """
+
+    def __init__(self, credentials, api_version='v1', endpoint=None,
+                 debug=False):
+        endpoint = (endpoint or os.environ.get(_ENDPOINT_OVERRIDE_ENV_VAR) or
+                    _DEFAULT_ENDPOINT)
+        # The override names a specific API version, which we
+        # replace with the one requested.
+        endpoint = re.sub(r'/(v1|beta|alpha)/?$', '/', endpoint)
+        if not endpoint.endswith('/'):
+            endpoint += '/'
+        parts = urlsplit(endpoint)
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        self._base_path = '{}{}/'.format(parts.path, api_version)
+        self._credentials = credentials
+        self._debug = debug
+        self._idle_connections = Queue(_MAX_IDLE_CONNECTIONS)
+
+    def _connection(self, fresh=False):
+        """Get a connection, reusing an idle one unless `fresh` is set.
+
+        Returns:
+          A tuple of the connection and whether it was reused.
+        """
+        if not fresh:
+            try:
+                return self._idle_connections.get_nowait(), True
+            except Empty:
+                pass
+        if self._scheme == 'http':
+            conn = httplib.HTTPConnection(
+                self._netloc, timeout=_REQUEST_TIMEOUT_SECONDS)
+        else:
+            conn = httplib.HTTPSConnection(
+                self._netloc, timeout=_REQUEST_TIMEOUT_SECONDS)
+        return conn, False
+
+    def close(self):
+        """Close all of the idle connections."""
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except Empty:
+                return
+
+    def _release(self, conn):
+        try:
+            self._idle_connections.put_nowait(conn)
+        except Exception:
+            conn.close()
+
+    def _send(self, method, url, body, token):
+        headers = {
+            'Authorization': 'Bearer ' + token,
+            'Accept': 'application/json',
+            'Connection': 'keep-alive',
+        }
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        # A pooled connection may have been closed by the server, in
+        # which case we retry once on a fresh connection.
+        for attempt in range(2):
+            conn, reused = self._connection(fresh=(attempt > 0))
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (httplib.HTTPException, IOError, OSError):
+                conn.close()
+                if not reused:
+                    raise
+                continue
+            if resp.getheader('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                self._release(conn)
+            return resp.status, data
+
+    def request(self, method, path, body=None, params=None):
+        """Issue a request against the API.
+
+        Args:
+          method: The HTTP method
+          path: The path of the resource, relative to the API version
+          body: The JSON-serializable request body, if any
+          params: A dictionary of query parameters, if any
+        Returns:
+          The decoded JSON response.
+        Raises:
+          ApiException: If the API returns an error.
+        """
+        url = self._base_path + path
+        if params:
+            url += '?' + urlencode(sorted(params.items()))
+        if self._debug:
+            sys.stderr.write('Compute API: {} {}\n'.format(method, url))
+        status, data = self._send(
+            method, url, body, self._credentials.get()['access-token'])
+        if status == 401:
+            status, data = self._send(
+                method, url, body,
+                self._credentials.get(force_refresh=True)['access-token'])
+        try:
+            decoded = json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            decoded = {}
+        if status >= 400:
+            error = decoded.get('error', {}) if isinstance(
+                decoded, dict) else {}
+            message = error.get('message') or 'HTTP error {}'.format(status)
+            raise ApiException(status, message)
+        return decoded
+
+    def list_all(self, path, params=None):
+        """Fetch every page of a list (or aggregated list) request.
+
+        Returns:
+          The list of resources.
+        """
+        params = dict(params or {})
+        items = []
+        while True:
+            page = self.request('GET', path, params=params)
+            page_items = page.get('items', [])
+            if isinstance(page_items, dict):
+                # Aggregated lists map scopes to their resources.
+                for scoped in page_items.values():
+                    for key, value in scoped.items():
+                        if key != 'warning' and isinstance(value, list):
+                            items.extend(value)
+            else:
+                items.extend(page_items)
+            token = page.get('nextPageToken')
+            if not token:
+                return items
+            params['pageToken'] = token
+
+    def operation_path(self, project, operation):
+        """Get the API path used to poll the given operation."""
+        name = operation.get('name', '')
+        if operation.get('zone'):
+            return 'projects/{}/zones/{}/operations/{}'.format(
+                project, _basename(operation['zone']), name)
+        if operation.get('region'):
+            return 'projects/{}/regions/{}/operations/{}'.format(
+                project, _basename(operation['region']), name)
+        return 'projects/{}/global/operations/{}'.format(project, name)
+
+    def wait_for_operations(self, project, operations, on_done=None):
+        """Wait for all of the given operations to complete.
+
+        The operations are polled together in a single loop, backing
+        off between rounds while any of them are still running.
+
+        Args:
+          project: The project containing the operations
+          operations: The list of operation resources to wait for
+          on_done: Optional function called with each completed operation
+        Returns:
+          The list of completed operation resources, in the same order.
+        """
+        results = list(operations)
+        pending = [i for i, op in enumerate(results)
+                   if op.get('status') != 'DONE']
+        for i, op in enumerate(results):
+            if i not in pending and on_done:
+                on_done(op)
+        delay = _OPERATION_POLL_INITIAL_SECONDS
+        while pending:
+            time.sleep(delay)
+            delay = min(delay * 2, _OPERATION_POLL_MAX_SECONDS)
+            still_pending = []
+            for i in pending:
+                op = self.request(
+                    'GET', self.operation_path(project, results[i]))
+                results[i] = op
+                if op.get('status') == 'DONE':
+                    if on_done:
+                        on_done(op)
+                else:
+                    still_pending.append(i)
+            pending = still_pending
+        return results
+
+
+def operation_error(operation):
+    """Get the error message of a completed operation, if it failed."""
+    errors = operation.get('error', {}).get('errors', [])
+    if not errors:
+        return None
+    return '\n'.join(' - ' + e.get('message', e.get('code', ''))
+                     for e in errors)
+
+
+def _parse_command(compute_cmd):
+    """Split a `gcloud compute` command into its parts.
+
+    Returns:
+      A tuple of the resource name, the verb, the list of positional
+      arguments, and a dictionary of flag values.
+    Raises:
+      UnsupportedCommandException: If the command is not supported.
+    """
+    positionals = []
+    flag_values = {}
+    pending = list(compute_cmd)
+    while pending:
+        arg = pending.pop(0)
+        if arg.startswith('--'):
+            if '=' in arg:
+                name, value = arg.split('=', 1)
+                flag_values[name] = value
+            elif arg in _BOOLEAN_FLAGS:
+                flag_values[arg] = True
+            else:
+                if not pending:
+                    raise UnsupportedCommandException(arg)
+                flag_values[arg] = pending.pop(0)
+        else:
+            positionals.append(arg)
+    if len(positionals) < 2:
+        raise UnsupportedCommandException(' '.join(compute_cmd))
+    resource, verb = positionals[0], positionals[1]
+    command = (resource, verb)
+    if command not in _COMMANDS:
+        raise UnsupportedCommandException(' '.join(command))
+    allowed = _COMMON_VALUE_FLAGS + _BOOLEAN_FLAGS + _COMMANDS[command]
+    for name in flag_values:
+        if name not in allowed:
+            raise UnsupportedCommandException(name)
+    names = positionals[2:]
+    if not names and verb != 'list':
+        raise UnsupportedCommandException(' '.join(compute_cmd))
+    if len(names) > 1 and command not in _MULTIPLE_NAME_COMMANDS:
+        raise UnsupportedCommandException(' '.join(compute_cmd))
+    if verb in ['describe', 'list']:
+        # Without a format gcloud renders YAML or a table,
+        # which we leave to gcloud itself.
+        _parse_format(flag_values.get('--format'))
+    if '--filter' in flag_values:
+        _Filter(flag_values['--filter'])
+    if '--size' in flag_values or command == ('disks', 'resize'):
+        _parse_size_gb(flag_values.get('--size'))
+    for name in ['--delete-disks', '--keep-disks']:
+        # Only the selection of data disks maps onto their auto-delete
+        # settings; gcloud handles the others.
+        if flag_values.get(name, 'data') != 'data':
+            raise UnsupportedCommandException(name)
+    return resource, verb, names, flag_values
+
+
+def _parse_size_gb(size):
+    match = _SIZE_PATTERN.match(size or '')
+    if not match:
+        raise UnsupportedCommandException(size)
+    value, unit = match.groups()
+    value = int(value)
+    if unit and unit.upper() == 'TB':
+        value *= 1024
+    return value
+
+
+class ComputeBackend(object):
+    """Runs `gcloud compute` commands using the Compute Engine API.
+
+    Instances of this class are callable with the same arguments as
+    the `gcloud_compute` function, and delegate to that function (the
+    `fallback`) for commands that they do not support. If the API cannot
+    be used at all (e.g. because no credentials are available), then
+    every subsequent command is delegated.
+    """
+
+    def __init__(self, fallback, gcloud_cmd, session_cache=None,
+                 api_version='v1', endpoint=None):
+        self._fallback = fallback
+        self._gcloud_cmd = gcloud_cmd
+        self._credentials = Credentials(gcloud_cmd, session_cache)
+        self._api_version = api_version
+        self._endpoint = endpoint
+        self._client = None
+        self._disabled = False
+        self._lock = threading.Lock()
+
+    def client(self, args):
+        """Get the (shared) API client."""
+        with self._lock:
+            if self._client is None:
+                self._client = ComputeClient(
+                    self._credentials, api_version=self._api_version,
+                    endpoint=self._endpoint,
+                    debug=utils.print_debug_messages(args))
+            return self._client
+
+    def close(self):
+        """Release the connections held by the API client, if any."""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+
+    def project(self, args):
+        """Get the project that commands should run against."""
+        return args.project or self._credentials.get()['project']
+
+    def _zone(self, args, flags, resource_name):
+        zone = flags.get('--zone') or self._credentials.get()['zone']
+        if not zone:
+            raise ApiException(
+                400, 'Underspecified resource [{}]. Specify the [--zone] '
+                'flag.'.format(resource_name))
+        return zone
+
+    def __call__(self, args, compute_cmd, stdin=None, stdout=None,
+                 stderr=None):
+        if self._disabled:
+            return self._fallback(
+                args, compute_cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+        try:
+            resource, verb, names, flags = _parse_command(compute_cmd)
+            scope = 'zonal' if resource in _ZONAL_COLLECTIONS else 'global'
+            handler = getattr(
+                self, '_{}_{}'.format(verb.replace('-', '_'), scope))
+            project = self.project(args)
+        except UnsupportedCommandException:
+            return self._fallback(
+                args, compute_cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            # We could not get credentials, so stop trying to use the API.
+            self._disabled = True
+            return self._fallback(
+                args, compute_cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+
+        command_name = 'gcloud.compute.{}.{}'.format(resource, verb)
+        messages = []
+        try:
+            text = handler(args, project, resource, names, flags, messages)
+        except (ApiException, httplib.HTTPException, IOError, OSError) as e:
+            messages.append('ERROR: ({}) {}\n'.format(command_name, e))
+            _write_error(stderr, ''.join(messages))
+            raise subprocess.CalledProcessError(
+                1, ['gcloud', 'compute'] + list(compute_cmd))
+        _write_error(stderr, ''.join(messages))
+        _write(stdout, text)
+        return 0
+
+    def _path(self, project, resource, zone=None, name=None):
+        collection = _COLLECTIONS[resource]
+        if zone:
+            path = 'projects/{}/zones/{}/{}'.format(project, zone, collection)
+        elif resource == 'zones':
+            path = 'projects/{}/zones'.format(project)
+        else:
+            path = 'projects/{}/global/{}'.format(project, collection)
+        if name:
+            path += '/' + quote(name)
+        return path
+
+    def _wait(self, args, project, operation, verb):
+        client = self.client(args)
+        operation = client.wait_for_operations(project, [operation])[0]
+        error = operation_error(operation)
+        if error:
+            raise ApiException(500, 'Could not {} resource:\n{}'.format(
+                verb, error))
+        return operation
+
+    def _report(self, messages, action, operation):
+        messages.append('{} [{}].\n'.format(
+            action, operation.get('targetLink', '')))
+
+    # Handlers for each supported (scope, verb) combination. Each returns
+    # the text that gcloud would have written to stdout.
+
+    def _describe_zonal(
+            self, args, project, resource, names, flags, messages):
+        zone = self._zone(args, flags, names[0])
+        result = self.client(args).request(
+            'GET', self._path(project, resource, zone, names[0]))
+        return format_resources(flags['--format'], [result], False)
+
+    def _describe_global(
+            self, args, project, resource, names, flags, messages):
+        result = self.client(args).request(
+            'GET', self._path(project, resource, name=names[0]))
+        return format_resources(flags['--format'], [result], False)
+
+    def _get_serial_port_output_zonal(
+            self, args, project, resource, names, flags, messages):
+        zone = self._zone(args, flags, names[0])
+        params = {'port': flags.get('--port', '1')}
+        if '--start' in flags:
+            params['start'] = flags['--start']
+        result = self.client(args).request(
+            'GET', self._path(project, resource, zone, names[0]) +
+            '/serialPort', params=params)
+        messages.append(
+            '\nSpecify --start={} in the next get-serial-port-output '
+            'invocation to get only the new output starting from '
+            'here.\n'.format(result.get('next', 0)))
+        return result.get('contents', '')
+
+    def _list_zonal(
+            self, args, project, resource, names, flags, messages):
+        if flags.get('--zone'):
+            items = self.client(args).list_all(
+                self._path(project, resource, flags['--zone']))
+        else:
+            items = self.client(args).list_all(
+                'projects/{}/aggregated/{}'.format(
+                    project, _COLLECTIONS[resource]))
+        return self._filtered(items, names, flags)
+
+    def _list_global(
+            self, args, project, resource, names, flags, messages):
+        items = self.client(args).list_all(self._path(project, resource))
+        return self._filtered(items, names, flags)
+
+    def _filtered(self, items, names, flags):
+        if names:
+            items = [i for i in items if i.get('name') in names]
+        if flags.get('--filter'):
+            resource_filter = _Filter(flags['--filter'])
+            items = [i for i in items if resource_filter.matches(i)]
+        return format_resources(flags['--format'], items, True)
+
+    def _create_zonal(
+            self, args, project, resource, names, flags, messages):
+        zone = self._zone(args, flags, names[0])
+        body = {'name': names[0]}
+        if '--size' in flags:
+            body['sizeGb'] = str(_parse_size_gb(flags['--size']))
+        if '--type' in flags:
+            body['type'] = 'projects/{}/zones/{}/diskTypes/{}'.format(
+                project, zone, flags['--type'])
+        if '--source-snapshot' in flags:
+            body['sourceSnapshot'] = 'projects/{}/global/snapshots/{}'.format(
+                project, flags['--source-snapshot'])
+        if '--description' in flags:
+            body['description'] = flags['--description']
+        operation = self.client(args).request(
+            'POST', self._path(project, resource, zone), body=body)
+        self._report(
+            messages, 'Created',
+            self._wait(args, project, operation, 'create'))
+        return format_resources(flags.get('--format', 'none'), [], False)
+
+    def _snapshot_zonal(
+            self, args, project, resource, names, flags, messages):
+        zone = self._zone(args, flags, names[0])
+        body = {'name': flags['--snapshot-names']}
+        if '--description' in flags:
+            body['description'] = flags['--description']
+        if '--labels' in flags:
+            body['labels'] = dict(
+                label.partition('=')[::2]
+                for label in flags['--labels'].split(','))
+        operation = self.client(args).request(
+            'POST', self._path(project, resource, zone, names[0]) +
+            '/createSnapshot', body=body)
+        self._report(
+            messages, 'Created',
+            self._wait(args, project, operation, 'snapshot'))
+        return format_resources(flags.get('--format', 'none'), [], False)
+
+    def _resize_zonal(
+            self, args, project, resource, names, flags, messages):
+        zone = self._zone(args, flags, names[0])
+        body = {'sizeGb': str(_parse_size_gb(flags.get('--size')))}
+        operation = self.client(args).request(
+            'POST', self._path(project, resource, zone, names[0]) +
+            '/resize', body=body)
+        self._report(
+            messages, 'Updated',
+            self._wait(args, project, operation, 'resize'))
+        return format_resources(flags.get('--format', 'none'), [], False)
+
+    def _create_global(
+            self, args, project, resource, names, flags, messages):
+        body = {'name': names[0]}
+        if '--description' in flags:
+            body['description'] = flags['--description']
+        if resource == 'networks':
+            body['autoCreateSubnetworks'] = True
+        elif resource == 'firewall-rules':
+            allowed = []
+            for rule in flags.get('--allow', '').split(','):
+                protocol, _, ports = rule.partition(':')
+                allowed_rule = {'IPProtocol': protocol}
+                if ports:
+                    allowed_rule['ports'] = [ports]
+                allowed.append(allowed_rule)
+            body['allowed'] = allowed
+            body['sourceRanges'] = ['0.0.0.0/0']
+            body['network'] = 'projects/{}/global/networks/{}'.format(
+                project, flags.get('--network', 'default'))
+        operation = self.client(args).request(
+            'POST', self._path(project, resource), body=body)
+        self._report(
+            messages, 'Created',
+            self._wait(args, project, operation, 'create'))
+        return format_resources(flags.get('--format', 'none'), [], False)
+
+    def _instance_operations(self, args, project, names, flags, messages,
+                             verb, action, issue_fn):
+        """Run an operation against each of the named instances.
+
+        As with gcloud, the operations are all started before any of
+        them are waited for, and are then polled together.
+
+        Args:
+          args: The Namespace instance returned by argparse
+          project: The project containing the instances
+          names: The names of the instances
+          flags: The flag values of the command
+          messages: The list to which to append status messages
+          verb: The verb used to describe a failure of the operation
+          action: The verb used to report a successful operation
+          issue_fn: Function taking the API client and the path of an
+            instance, which starts the operation and returns it.
+        Raises:
+          ApiException: If the operation failed for any of the instances.
+        """
+        zone = self._zone(args, flags, names[0])
+        client = self.client(args)
+
+        def issue(name):
+            path = self._path(project, 'instances', zone, name)
+            try:
+                return issue_fn(client, path), None
+            except (ApiException, httplib.HTTPException, IOError,
+                    OSError) as e:
+                return None, str(e)
+
+        issued = utils.run_concurrently(
+            dict((name, lambda name=name: issue(name)) for name in names),
+            max_workers=_MAX_CONCURRENT_REQUESTS)
+        errors = [issued[name][1] for name in names if issued[name][1]]
+        operations = [issued[name][0] for name in names if issued[name][0]]
+        for operation in client.wait_for_operations(project, operations):
+            error = operation_error(operation)
+            if error:
+                errors.append('Could not {} resource:\n{}'.format(
+                    verb, error))
+            else:
+                self._report(messages, action, operation)
+        if errors:
+            raise ApiException(500, '\n'.join(errors))
+
+    def _instance_action(self, args, project, names, flags, messages,
+                         action, params=None):
+        self._instance_operations(
+            args, project, names, flags, messages, action, 'Updated',
+            lambda client, path: client.request(
+                'POST', '{}/{}'.format(path, action), params=params))
+        return format_resources(flags.get('--format', 'none'), [], False)
+
+    def _set_machine_type_zonal(
+            self, args, project, resource, names, flags, messages):
+        zone = self._zone(args, flags, names[0])
+        body = {'machineType': 'zones/{}/machineTypes/{}'.format(
+            zone, flags.get('--machine-type'))}
+        self._instance_operations(
+            args, project, names, flags, messages, 'update', 'Updated',
+            lambda client, path: client.request(
+                'POST', path + '/setMachineType', body=body))
+        return format_resources(flags.get('--format', 'none'), [], False)
+
+    def _start_zonal(
+            self, args, project, resource, names, flags, messages):
+        return self._instance_action(
+            args, project, names, flags, messages, 'start')
+
+    def _stop_zonal(
+            self, args, project, resource, names, flags, messages):
+        params = None
+        if '--discard-local-ssd' in flags:
+            discard = flags['--discard-local-ssd'] != 'false'
+            params = {'discardLocalSsd': 'true' if discard else 'false'}
+        return self._instance_action(
+            args, project, names, flags, messages, 'stop', params=params)
+
+    def _delete_zonal(
+            self, args, project, resource, names, flags, messages):
+        auto_delete = None
+        if flags.get('--delete-disks') == 'data':
+            auto_delete = True
+        elif flags.get('--keep-disks') == 'data':
+            auto_delete = False
+
+        def delete(client, path):
+            if auto_delete is not None:
+                instance = client.request('GET', path)
+                for disk in instance.get('disks', []):
+                    if (disk.get('boot') or
+                            disk.get('autoDelete') == auto_delete):
+                        continue
+                    operation = client.request(
+                        'POST', path + '/setDiskAutoDelete', params={
+                            'autoDelete': 'true' if auto_delete else 'false',
+                            'deviceName': disk.get('deviceName', ''),
+                        })
+                    self._wait(args, project, operation, 'update')
+            return client.request('DELETE', path)
+
+        self._instance_operations(
+            args, project, names, flags, messages, 'delete', 'Deleted',
+            delete)
+        return format_resources(flags.get('--format', 'none'), [], False)
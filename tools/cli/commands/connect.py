@@ -16,9 +16,12 @@
 
 from __future__ import absolute_import
 
-import os
+import argparse
+import re
 import subprocess
+import tempfile
 import threading
+import time
 import webbrowser
 
 try:
@@ -26,7 +29,7 @@ try:
 except ImportError:
     from urllib2 import urlopen
 
-from . import utils
+from . import agent, tunnel, utils
 
 
 description = """`{0} {1}` creates a persistent connection to a
@@ -36,6 +39,12 @@ This is a thin wrapper around the *ssh(1)* command that takes care
 of authentication and the translation of the instance name into an
 IP address.
 
+The connection sends keepalives every few seconds, so that a dropped
+connection is noticed quickly. It is then re-established without
+going through gcloud when possible, either by reusing the SSH master
+connection, or by connecting directly to the last known address of
+the instance.
+
 This command ensures that the user's public SSH key is present
 in the project's metadata. If the user does not have a public
 SSH key, one is generated using *ssh-keygen(1)* (if the --quiet
@@ -47,14 +56,21 @@ the --no-launch-browser flag.
 
 This command will attempt to re-establish the connection if it
 gets dropped. However, that connection will only exist while
-this command is running.
+this command is running, unless the --daemon flag is given, in
+which case the connection is handed over to a background agent.
 """
 
 
 examples = """
 To connect to 'example-instance' in zone 'us-central1-a', run:
 
-    $ {0} {1} example-instance --zone us-central1-a"""
+    $ {0} {1} example-instance --zone us-central1-a
+
+To keep connections to two instances open in the background, run:
+
+    $ {0} {1} --daemon example-instance
+    $ {0} {1} --daemon other-instance
+    $ {0} tunnels list"""
 
 
 wrong_user_message_template = (
@@ -95,6 +111,147 @@ unsupported_browsers = [
 _STATUS_RUNNING = 'RUNNING'
 
 
+# The local port on which Datalab is accessible, unless otherwise specified.
+DEFAULT_PORT = 8081
+
+
+# Maximum age, in seconds, of an instance description that can be reused
+# when deciding whether or not to reconnect. This avoids describing the
+# instance again when the connection drops repeatedly in quick succession.
+_RECONNECT_STATUS_MAX_AGE_SECONDS = 30
+
+
+# Timeout, in seconds, of each request used to check whether Datalab is
+# reachable, and the bounds of the backoff between those requests.
+_HEALTH_CHECK_TIMEOUT_SECONDS = 5
+_HEALTH_CHECK_INITIAL_DELAY_SECONDS = 0.25
+_HEALTH_CHECK_MAX_DELAY_SECONDS = 2
+
+
+# How long, in seconds, to wait for Datalab to become reachable before
+# following the instance's boot on its serial console, and how often
+# to check the serial console after that.
+_BOOT_PROGRESS_DELAY_SECONDS = 5
+_BOOT_PROGRESS_INTERVAL_SECONDS = 10
+
+
+# Prefix of the serial console lines that mark the start of each phase
+# of an instance's boot. Each is followed by the name of the phase and
+# the time, in seconds since the epoch, at which it started.
+BOOT_PHASE_MARKER = 'datalab-boot-phase:'
+
+_BOOT_PHASE_PATTERN = re.compile(
+    re.escape(BOOT_PHASE_MARKER) + r' (\S+) (\d+)')
+
+_NEXT_SERIAL_START_PATTERN = re.compile(r'--start=(\d+)')
+
+# The phases of the startup script, in the order in which they run, and
+# the marker written once it has finished.
+_STARTUP_SCRIPT_PHASES = ['disk', 'image-pull', 'swap', 'tmp-cleanup']
+_STARTUP_SCRIPT_DONE = 'startup-done'
+
+# The phase in which the Datalab container is started. This overlaps
+# with the end of the startup script, and lasts until Datalab is ready.
+_CONTAINER_START_PHASE = 'container-start'
+
+_BOOT_PHASE_DESCRIPTIONS = {
+    'image-pull': 'loading or pulling the Datalab image',
+    'disk': 'mounting (and if necessary formatting) the notebooks disk',
+    'swap': 'setting up swap',
+    'tmp-cleanup': 'preparing temporary storage',
+    'container-start': 'starting the Datalab container',
+    'gpu-driver': 'installing the GPU driver',
+}
+
+
+class BootProgress(object):
+    """Follows the boot of an instance using its serial console.
+
+    The startup script marks the start of each boot phase on the serial
+    console. This fetches the console output incrementally, and reports
+    each phase as soon as it is seen.
+    """
+
+    def __init__(self, args, gcloud_compute, instance):
+        self._args = args
+        self._gcloud_compute = gcloud_compute
+        self._instance = instance
+        self._next_start = 0
+        self._phases = []
+        self._reported = 0
+        self.polled = False
+
+    def _serial_port_output(self):
+        cmd = ['instances', 'get-serial-port-output', '--quiet']
+        if self._args.zone:
+            cmd.extend(['--zone', self._args.zone])
+        cmd.extend(['--start', str(self._next_start), self._instance])
+        with tempfile.TemporaryFile() as stdout, \
+                tempfile.TemporaryFile() as stderr:
+            try:
+                self._gcloud_compute(
+                    self._args, cmd, stdout=stdout, stderr=stderr)
+            except subprocess.CalledProcessError:
+                return ''
+            stdout.seek(0)
+            stderr.seek(0)
+            match = _NEXT_SERIAL_START_PATTERN.search(
+                stderr.read().decode('utf-8', 'replace'))
+            if match:
+                self._next_start = int(match.group(1))
+            return stdout.read().decode('utf-8', 'replace')
+
+    def poll(self):
+        """Check the serial console, and report any newly started phases."""
+        self.polled = True
+        for line in self._serial_port_output().splitlines():
+            match = _BOOT_PHASE_PATTERN.search(line)
+            if not match:
+                continue
+            phase, started = match.group(1), int(match.group(2))
+            if phase == _STARTUP_SCRIPT_PHASES[0]:
+                # The instance has (re)booted, so start over.
+                self._phases = []
+                self._reported = 0
+            self._phases.append((phase, started))
+        for phase, _ in self._phases[self._reported:]:
+            if phase in _BOOT_PHASE_DESCRIPTIONS:
+                print('Boot phase: {}'.format(_BOOT_PHASE_DESCRIPTIONS[phase]))
+        self._reported = len(self._phases)
+
+    def seen(self, phase):
+        """Check whether the given phase has started since the last boot."""
+        return any(name == phase for name, _ in self._phases)
+
+    def timings(self, ready_time):
+        """Compute how long each of the observed boot phases took.
+
+        Args:
+          ready_time: The time at which Datalab became reachable
+        Returns:
+          A list of (phase, seconds) tuples, in the order of the phases.
+        """
+        started = dict(self._phases)
+        ends = _STARTUP_SCRIPT_PHASES[1:] + [_STARTUP_SCRIPT_DONE]
+        result = []
+        for phase, end in zip(_STARTUP_SCRIPT_PHASES, ends):
+            if phase in started and end in started:
+                result.append((phase, started[end] - started[phase]))
+        if _CONTAINER_START_PHASE in started:
+            result.append((_CONTAINER_START_PHASE, max(
+                0, ready_time - started[_CONTAINER_START_PHASE])))
+        return result
+
+    def print_timings(self, ready_time):
+        """Print how long each of the observed boot phases took."""
+        timings = self.timings(ready_time)
+        if not timings:
+            return
+        print('\nThe instance took the following time in each boot phase:')
+        for phase, seconds in timings:
+            print(' {:<16} {:>6.0f}s'.format(phase, seconds))
+
+
 def flags(parser):
     """Add command line flags for the `connect` subcommand.
 
@@ -111,6 +268,17 @@ def flags(parser):
         action='store_true',
         default=False,
         help='do not check if the current user matches the Datalab instance')
+    parser.add_argument(
+        '--daemon',
+        dest='daemon',
+        action='store_true',
+        default=False,
+        help=(
+            'hand the connection over to the background tunnel agent.'
+            '\n\n'
+            'The agent keeps tunnels to any number of instances open, and '
+            'picks a free local port for each one unless --port is given. '
+            'Use the `tunnels` command to list and close them.'))
 
     connection_flags(parser)
     return
@@ -126,8 +294,12 @@ def connection_flags(parser):
         '--port',
         dest='port',
         type=int,
-        default=8081,
-        help='local port on which Datalab is accessible')
+        default=None,
+        help=(
+            'local port on which Datalab is accessible.'
+            '\n\n'
+            'The default is {0}, or a free port when handing the '
+            'connection over to the tunnel agent.'.format(DEFAULT_PORT)))
     parser.add_argument(
         '--max-reconnects',
         dest='max_reconnects',
@@ -157,10 +329,81 @@ def connection_flags(parser):
         action='store_true',
         default=False,
         help='do not open a browser connected to Datalab')
+    parser.add_argument(
+        '--tunnel-stats-interval',
+        dest='tunnel_stats_interval',
+        metavar='SECONDS',
+        type=int,
+        default=0,
+        help=(
+            'print the round-trip time to Datalab and the traffic through '
+            'the tunnel every SECONDS seconds.'
+            '\n\n'
+            'This helps to tell a slow tunnel from a slow kernel. To count '
+            'the traffic, the connections to Datalab are relayed through '
+            'this command.'))
+    tunnel_flags(parser)
 
     return
 
 
+def forward(value):
+    """Parse a port forward given on the command line."""
+    try:
+        return tunnel.parse_forward(value)
+    except tunnel.InvalidForwardException as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def tunnel_flags(parser):
+    """Add the flags that control the SSH tunnel of a connection.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        '--forward',
+        dest='forwards',
+        metavar='PORT',
+        type=forward,
+        action='append',
+        default=[],
+        help=(
+            'also forward the given port, or LOCAL_PORT:REMOTE_PORT, '
+            'to the instance.'
+            '\n\n'
+            'This can be given several times, e.g. to reach TensorBoard '
+            'with `--forward 6006`. Every forward shares the SSH '
+            'connection to Datalab. Forwards can also be added to or '
+            'removed from a running connection with the `port-forward` '
+            'command.'))
+    tunnel_profile_flag(parser)
+    return
+
+
+def tunnel_profile_flag(parser):
+    """Add the flag for picking the SSH settings of a tunnel.
+
+    Args:
+      parser: The argparse parser to which to add the flag.
+    """
+    parser.add_argument(
+        '--tunnel-profile',
+        dest='tunnel_profile',
+        choices=sorted(tunnel.TUNNEL_PROFILES),
+        default=tunnel.DEFAULT_TUNNEL_PROFILE,
+        help=(
+            'the kind of network that the SSH tunnel crosses.'
+            '\n\n'
+            'This picks the compression, ciphers, MACs, type of service '
+            'and keepalives of the tunnel. "lan" favors throughput, "wan" '
+            'favors latency, and "lowbandwidth" compresses the traffic '
+            'and tolerates slow keepalives, for slow home or VPN links.'
+            '\n\n'
+            'The default is "{}".'.format(tunnel.DEFAULT_TUNNEL_PROFILE)))
+    return
+
+
 def connect(args, gcloud_compute, email, in_cloud_shell):
     """Create a persistent connection to a Datalab instance.
 
@@ -179,9 +422,22 @@ def connect(args, gcloud_compute, email, in_cloud_shell):
                    'compute/docs/instances/adding-removing-ssh-keys')
     print(connect_msg.format(instance))
 
+    if args.port is None:
+        args.port = DEFAULT_PORT
     datalab_port = args.port
     datalab_address = 'http://localhost:{0}/'.format(str(datalab_port))
 
+    # To count the traffic to Datalab, the tunnel forwards another port,
+    # and the connections to the Datalab port are relayed to that one.
+    tunnel_port = datalab_port
+    if args.tunnel_stats_interval > 0:
+        tunnel_port = tunnel.free_local_port()
+    ssh_tunnel = tunnel.Tunnel(
+        args, gcloud_compute, instance,
+        [(tunnel_port, tunnel.DATALAB_PORT)] + args.forwards)
+    # When the connection was last lost, and how it was re-established.
+    reconnect = {}
+
     def create_tunnel():
         """Create an SSH tunnel to the Datalab instance.
 
@@ -190,31 +446,16 @@ def connect(args, gcloud_compute, email, in_cloud_shell):
         Raises:
           KeyboardInterrupt: When the end user kills the connection
           subprocess.CalledProcessError: If the connection dies on its own
+          tunnel.TunnelClosedException: If the connection dies on its own
         """
         if utils.print_debug_messages(args):
-            print('Connecting to {0} via SSH').format(instance)
+            print('Connecting to {0} via SSH'.format(instance))
 
-        cmd = ['ssh']
-        if args.zone:
-            cmd.extend(['--zone', args.zone])
-        port_mapping = 'localhost:' + str(args.port) + ':localhost:8080'
-        if os.name == 'posix':
-            # The '-o' flag is not supported by all SSH clients (notably,
-            # PuTTY does not support it). To avoid any potential issues
-            # with it, we only add that flag when we believe it will
-            # be supported. In particular, checking for an os name of
-            # 'posix' works for both Linux and Mac OSX, which do support
-            # that flag.
-            cmd.extend([
-                '--ssh-flag=-o',
-                '--ssh-flag=LogLevel=' + args.ssh_log_level])
-        cmd.extend([
-            '--ssh-flag=-4',
-            '--ssh-flag=-N',
-            '--ssh-flag=-L',
-            '--ssh-flag=' + port_mapping])
-        cmd.append('datalab@{0}'.format(instance))
-        gcloud_compute(args, cmd)
+        if not tunnel.multiplexing_supported():
+            ssh_tunnel.run_in_foreground()
+            return
+        reconnect['via'] = ssh_tunnel.open()
+        ssh_tunnel.wait()
         return
 
     def maybe_open_browser(address):
@@ -230,8 +471,16 @@ def connect(args, gcloud_compute, email, in_cloud_shell):
 
     def on_ready():
         """Callback that handles a successful connection."""
+        dropped = reconnect.pop('dropped', None)
+        if dropped:
+            print('Reconnected via {0} in {1:.1f} seconds'.format(
+                reconnect.get('via', tunnel.VIA_GCLOUD),
+                time.time() - dropped))
         print('\nThe connection to Datalab is now open and will '
               'remain until this command is killed.')
+        for local_port, remote_port in ssh_tunnel.forwards[1:]:
+            print('Port {0} of the instance is forwarded to local port '
+                  '{1}'.format(remote_port, local_port))
         if in_cloud_shell:
             print(web_preview_message_template.format(datalab_port))
         else:
@@ -240,11 +489,35 @@ def connect(args, gcloud_compute, email, in_cloud_shell):
                 maybe_open_browser(datalab_address)
         return
 
+    def follow_boot(progress, done_event):
+        """Report the boot phases of the instance until it is reachable.
+
+        The serial console is only checked if Datalab does not become
+        reachable right away, as is the case for an instance that is
+        still booting.
+
+        Args:
+          progress: The BootProgress instance to poll
+          done_event: A threading.Event instance that indicates we should
+            stop following the boot.
+        """
+        if done_event.wait(_BOOT_PROGRESS_DELAY_SECONDS):
+            return
+        print('Datalab is not reachable yet; following the boot of '
+              'the instance')
+        while not done_event.is_set():
+            progress.poll()
+            done_event.wait(_BOOT_PROGRESS_INTERVAL_SECONDS)
+
     def health_check(cancelled_event, healthy_event):
         """Check if the Datalab instance is reachable via the connection.
 
         After the instance is reachable, the `on_ready` method is called.
 
+        Each check times out after a few seconds, and the checks back off
+        while the instance is unreachable. Meanwhile, the boot phases of
+        the instance are reported from its serial console.
+
         This method is meant to be suitable for running in a separate thread,
         and takes an event argument to indicate when that thread should exit.
 
@@ -257,20 +530,66 @@ def connect(args, gcloud_compute, email, in_cloud_shell):
         health_url = '{0}_info/'.format(datalab_address)
         healthy = False
         print('Waiting for Datalab to be reachable at ' + datalab_address)
+        progress = BootProgress(args, gcloud_compute, instance)
+        done_event = threading.Event()
+        progress_thread = threading.Thread(
+            target=follow_boot, args=[progress, done_event])
+        progress_thread.daemon = True
+        progress_thread.start()
+        delay = _HEALTH_CHECK_INITIAL_DELAY_SECONDS
         while not cancelled_event.is_set():
             try:
-                health_resp = urlopen(health_url)
+                health_resp = urlopen(
+                    health_url, timeout=_HEALTH_CHECK_TIMEOUT_SECONDS)
                 if health_resp.getcode() == 200:
                     healthy = True
                     break
             except Exception:
-                continue
+                pass
+            cancelled_event.wait(delay)
+            delay = min(delay * 2, _HEALTH_CHECK_MAX_DELAY_SECONDS)
+        ready_time = time.time()
+        done_event.set()
+        progress_thread.join()
 
         if healthy:
             healthy_event.set()
+            if progress.polled:
+                # Pick up the phases that started since the last check.
+                progress.poll()
+                progress.print_timings(ready_time)
             on_ready()
         return
 
+    def report_stats(proxy, stopped_event):
+        """Periodically print the latency and throughput of the tunnel.
+
+        Args:
+          proxy: The tunnel.CountingProxy that relays to the tunnel
+          stopped_event: A threading.Event instance that indicates we
+            should stop reporting.
+        """
+        health_url = '{0}_info/'.format(datalab_address)
+        last_time = time.time()
+        last_sent, last_received = proxy.bytes_transferred
+        while not stopped_event.wait(args.tunnel_stats_interval):
+            now = time.time()
+            sent, received = proxy.bytes_transferred
+            try:
+                urlopen(health_url,
+                        timeout=_HEALTH_CHECK_TIMEOUT_SECONDS).read()
+                round_trip = '{0:.0f} ms'.format((time.time() - now) * 1000)
+            except Exception:
+                round_trip = 'unreachable'
+            elapsed = max(now - last_time, 1e-3)
+            print('Tunnel: round trip to Datalab {0}, receiving {1}, '
+                  'sending {2}'.format(
+                      round_trip,
+                      utils.format_bytes(
+                          (received - last_received) / elapsed) + '/s',
+                      utils.format_bytes((sent - last_sent) / elapsed) + '/s'))
+            last_time, last_sent, last_received = now, sent, received
+
     def connect_and_check(healthy_event):
         """Create a connection to Datalab and notify the user when ready.
 
@@ -291,42 +610,60 @@ def connect(args, gcloud_compute, email, in_cloud_shell):
         health_check_thread.start()
         try:
             create_tunnel()
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError,
+                tunnel.TunnelClosedException):
             print('Connection broken')
+            reconnect['dropped'] = time.time()
         finally:
             cancelled_event.set()
             health_check_thread.join()
         return healthy_event.is_set()
 
-    remaining_reconnects = args.max_reconnects
-    while True:
-        healthy_event = threading.Event()
-        try:
-            connect_and_check(healthy_event)
-        except KeyboardInterrupt:
-            if healthy_event.is_set():
-                cli_flags = ' '
-                if args.project:
-                    cli_flags += '--project {} '.format(args.project)
-                if args.zone:
-                    cli_flags += '--zone {} '.format(args.zone)
-                cli_flags += '--port {} '.format(args.port)
-                print(connection_closed_message_template.format(
-                    instance, cli_flags))
-            return
-        if remaining_reconnects == 0:
-            return
-        # Before we try to reconnect, check to see if the VM is still running.
-        status, unused_metadata_items = utils.describe_instance(
-            args, gcloud_compute, instance)
-        if status != _STATUS_RUNNING:
-            print('Instance {0} is no longer running ({1})'.format(
-                instance, status))
-            return
-        print('Attempting to reconnect...')
-        remaining_reconnects -= 1
-        # Don't launch the browser on reconnect...
-        args.no_launch_browser = True
+    proxy = None
+    stats_stopped = threading.Event()
+    if args.tunnel_stats_interval > 0:
+        proxy = tunnel.CountingProxy(datalab_port, tunnel_port)
+        stats_thread = threading.Thread(
+            target=report_stats, args=[proxy, stats_stopped])
+        stats_thread.daemon = True
+        stats_thread.start()
+
+    try:
+        remaining_reconnects = args.max_reconnects
+        while True:
+            healthy_event = threading.Event()
+            try:
+                connect_and_check(healthy_event)
+            except KeyboardInterrupt:
+                ssh_tunnel.close()
+                if healthy_event.is_set():
+                    cli_flags = ' '
+                    if args.project:
+                        cli_flags += '--project {} '.format(args.project)
+                    if args.zone:
+                        cli_flags += '--zone {} '.format(args.zone)
+                    cli_flags += '--port {} '.format(args.port)
+                    print(connection_closed_message_template.format(
+                        instance, cli_flags))
+                return
+            if remaining_reconnects == 0:
+                return
+            # Before we try to reconnect, check if the VM is still running.
+            status, unused_metadata_items = utils.describe_instance(
+                args, gcloud_compute, instance,
+                max_age=_RECONNECT_STATUS_MAX_AGE_SECONDS)
+            if status != _STATUS_RUNNING:
+                print('Instance {0} is no longer running ({1})'.format(
+                    instance, status))
+                return
+            print('Attempting to reconnect...')
+            remaining_reconnects -= 1
+            # Don't launch the browser on reconnect...
+            args.no_launch_browser = True
+    finally:
+        stats_stopped.set()
+        if proxy:
+            proxy.close()
     return
 
 
@@ -349,19 +686,22 @@ def maybe_start(args, gcloud_compute, instance, status):
         if args.zone:
             start_cmd.extend(['--zone', args.zone])
         start_cmd.extend([instance])
-        gcloud_compute(args, start_cmd)
+        try:
+            gcloud_compute(args, start_cmd)
+        finally:
+            utils.invalidate_instance_record(args, instance)
     return
 
 
-def run(args, gcloud_compute, email='', in_cloud_shell=False, **unused_kwargs):
-    """Implementation of the `datalab connect` subcommand.
+def check_instance(args, gcloud_compute, email):
+    """Check that the user may connect to an instance, and start it.
 
     Args:
       args: The Namespace instance returned by argparse
       gcloud_compute: Function that can be used to invoke `gcloud compute`
       email: The user's email address
-      in_cloud_shell: Whether or not the command is being run in the
-        Google Cloud Shell
+    Returns:
+      True iff the instance is running and the user may connect to it.
     Raises:
       subprocess.CalledProcessError: If a nested `gcloud` calls fails
     """
@@ -374,7 +714,7 @@ def run(args, gcloud_compute, email='', in_cloud_shell=False, **unused_kwargs):
         'created-with-datalab-version', 'UNKNOWN')
     if (not args.no_user_checking) and for_user and (for_user != email):
         print(wrong_user_message_template.format(for_user, email))
-        return
+        return False
 
     if args.diagnose_me:
         print('Instance {} was created with the following '
@@ -384,5 +724,48 @@ def run(args, gcloud_compute, email='', in_cloud_shell=False, **unused_kwargs):
                   instance, sdk_version, datalab_version))
 
     maybe_start(args, gcloud_compute, instance, status)
-    connect(args, gcloud_compute, email, in_cloud_shell)
+    return True
+
+
+def connect_in_background(args, gcloud_compute):
+    """Have the tunnel agent connect to a Datalab instance.
+
+    The agent is started if it is not already running.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      agent.AgentNotSupportedException: If the platform does not
+        support the agent
+      agent.AgentRequestException: If the agent failed to connect
+    """
+    result = agent.open_tunnel(
+        args, gcloud_compute, args.instance, port=args.port,
+        forwards=args.forwards)
+    print('Datalab on {0} is accessible at http://localhost:{1}/ for as '
+          'long as the tunnel agent runs.'.format(
+              args.instance, result['port']))
+    print('The agent log is {0}'.format(agent.log_path()))
+    return
+
+
+def run(args, gcloud_compute, email='', in_cloud_shell=False, **unused_kwargs):
+    """Implementation of the `datalab connect` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      email: The user's email address
+      in_cloud_shell: Whether or not the command is being run in the
+        Google Cloud Shell
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+    """
+    if check_instance(args, gcloud_compute, email):
+        if args.daemon:
+            connect_in_background(args, gcloud_compute)
+        else:
+            connect(args, gcloud_compute, email, in_cloud_shell)
     return
@@ -0,0 +1,547 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab cp` command."""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import posixpath
+import re
+import subprocess
+import time
+import zlib
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from . import connect, inventory, localstate, tunnel, utils
+
+
+description = ("""`{0} {1}` copies a file between the local machine and the
+notebooks disk of a Datalab instance.
+
+Exactly one of SOURCE and DESTINATION names a file on the instance, as
+NAME:PATH. PATH is under /content, the directory in which Datalab keeps
+notebooks, and relative paths are taken to be relative to /content.
+
+The file is copied over the instance's SSH connection, reusing that of
+a running `{0} connect` if there is one. Large files are split into
+chunks that are sent as several parallel streams, each compressed on
+the fly unless the chunk does not compress well. Every chunk is then
+checked against its SHA-256 checksum on both ends.
+
+If a copy is interrupted, running the same command again resumes it,
+sending only the chunks that were not yet completed.
+
+This is not supported on Windows.""")
+
+
+examples = ("""
+To copy a dataset to the notebooks disk of 'my-instance':
+
+    $ {0} {1} data.csv my-instance:/content/datalab/data.csv
+
+To copy a notebook back from the instance:
+
+    $ {0} {1} my-instance:datalab/notebooks/analysis.ipynb .
+""")
+
+
+# Where the notebooks disk, mounted as /content in the Datalab
+# container, is mounted on the instance.
+_CONTENT_DIR = '/content'
+_REMOTE_CONTENT_DIR = '/mnt/disks/datalab-pd/content'
+
+# The files on the notebooks disk belong to the Datalab container, so
+# they are accessed as root.
+_REMOTE_SHELL = 'sudo -n sh -c'
+
+_PART_SUFFIX = '.datalab-part'
+
+# The directory, under the per-user config directory, that holds the
+# progress of interrupted copies.
+_TRANSFERS_DIR = 'transfers'
+
+# A chunk is compressed if this much of it compresses to at most this
+# fraction of its size.
+_COMPRESSION_SAMPLE_BYTES = 64 * 1024
+_COMPRESSION_MAX_RATIO = 0.9
+_COMPRESSION_LEVEL = 1
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Files that are downloaded without compression, since their contents
+# are already compressed.
+_COMPRESSED_EXTENSIONS = [
+    '.7z', '.bz2', '.gif', '.gz', '.jpeg', '.jpg', '.mp3', '.mp4',
+    '.npz', '.parquet', '.png', '.tgz', '.xz', '.zip',
+]
+
+_INSTANCE_LOCATION_PATTERN = re.compile(r'^([a-z](?:[-a-z0-9]*[a-z0-9])?):')
+
+
+class CopyNotSupportedException(Exception):
+
+    _MESSAGE = ('Copying files requires OpenSSH, which is not available, '
+                'so it is not supported on this platform.')
+
+    def __init__(self):
+        super(CopyNotSupportedException, self).__init__(
+            CopyNotSupportedException._MESSAGE)
+
+
+class LocationException(Exception):
+
+    _MESSAGE = ('Exactly one of the source and destination must be a file '
+                'on an instance, given as NAME:PATH.')
+
+    def __init__(self):
+        super(LocationException, self).__init__(LocationException._MESSAGE)
+
+
+class RemotePathException(Exception):
+
+    _MESSAGE = 'Only paths under {} can be copied, but {} is not.'
+
+    def __init__(self, path):
+        super(RemotePathException, self).__init__(
+            RemotePathException._MESSAGE.format(_CONTENT_DIR, path))
+
+
+class NoSuchFileException(Exception):
+
+    _MESSAGE = '{} is not a file.'
+
+    def __init__(self, location):
+        super(NoSuchFileException, self).__init__(
+            NoSuchFileException._MESSAGE.format(location))
+
+
+class ChecksumMismatchException(Exception):
+
+    _MESSAGE = ('The checksums of chunks {} of {} still do not match after '
+                'sending them again.')
+
+    def __init__(self, chunks, location):
+        super(ChecksumMismatchException, self).__init__(
+            ChecksumMismatchException._MESSAGE.format(
+                ', '.join(str(chunk) for chunk in chunks), location))
+
+
+def flags(parser):
+    """Add command line flags for the `cp` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        'source',
+        metavar='SOURCE',
+        help='file to copy, either local or as NAME:PATH')
+    parser.add_argument(
+        'destination',
+        metavar='DESTINATION',
+        help='where to copy the file, either local or as NAME:PATH')
+    parser.add_argument(
+        '--streams',
+        dest='streams',
+        type=int,
+        default=4,
+        help='number of chunks to transfer at once')
+    parser.add_argument(
+        '--chunk-size-mb',
+        dest='chunk_size_mb',
+        type=int,
+        default=8,
+        help=(
+            'size, in megabytes, of the chunks that the file is split into.'
+            '\n\n'
+            'An interrupted copy can only be resumed with the same size.'))
+    parser.add_argument(
+        '--compress',
+        dest='compress',
+        choices=['auto', 'always', 'never'],
+        default='auto',
+        help=(
+            'whether to compress the chunks.'
+            '\n\n'
+            'With "auto", chunks are compressed unless a sample of an '
+            'uploaded chunk does not compress well, or the name of a '
+            'downloaded file shows that it is already compressed.'))
+    parser.add_argument(
+        '--ssh-log-level',
+        dest='ssh_log_level',
+        choices=['quiet', 'fatal', 'error', 'info', 'verbose',
+                 'debug', 'debug1', 'debug2', 'debug3'],
+        default='error',
+        help='the log level for the SSH commands.')
+    connect.tunnel_profile_flag(parser)
+    return
+
+
+def parse_location(location):
+    """Split a location into the name of its instance and its path.
+
+    Args:
+      location: A local path, or NAME:PATH for a path on an instance
+    Returns:
+      A tuple of the instance name, or None for a local path, and the path.
+    """
+    match = _INSTANCE_LOCATION_PATTERN.match(location)
+    if not match or (os.name == 'nt' and len(match.group(1)) == 1):
+        # A single letter followed by a colon is a drive on Windows.
+        return None, location
+    return match.group(1), location[match.end():]
+
+
+def remote_host_path(path):
+    """Get the path on the instance of the given path under /content.
+
+    Raises:
+      RemotePathException: If the path is not under /content
+    """
+    path = posixpath.normpath(posixpath.join(_CONTENT_DIR, path))
+    if path == _CONTENT_DIR:
+        return _REMOTE_CONTENT_DIR
+    if not path.startswith(_CONTENT_DIR + '/'):
+        raise RemotePathException(path)
+    return _REMOTE_CONTENT_DIR + path[len(_CONTENT_DIR):]
+
+
+def _should_compress_chunk(args, data):
+    if args.compress != 'auto':
+        return args.compress == 'always'
+    sample = data[:_COMPRESSION_SAMPLE_BYTES]
+    if not sample:
+        return False
+    compressed = zlib.compress(sample, _COMPRESSION_LEVEL)
+    return len(compressed) <= _COMPRESSION_MAX_RATIO * len(sample)
+
+
+def _should_compress_file(args, path):
+    if args.compress != 'auto':
+        return args.compress == 'always'
+    return os.path.splitext(path)[1].lower() not in _COMPRESSED_EXTENSIONS
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(
+        _COMPRESSION_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def run_remote(ssh_tunnel, script, stdin_data=None, capture=False):
+    """Run a shell script on the instance, over the master connection.
+
+    Args:
+      ssh_tunnel: The tunnel.Tunnel whose master connection to use
+      script: The shell script to run, as root
+      stdin_data: The bytes to send to the script's standard input
+      capture: Whether to return the script's standard output
+    Returns:
+      The script's standard output, if captured.
+    Raises:
+      subprocess.CalledProcessError: If the script fails
+    """
+    cmd = ssh_tunnel.remote_command(
+        '{} {}'.format(_REMOTE_SHELL, quote(script)))
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if stdin_data is not None else devnull,
+            stdout=subprocess.PIPE if capture else devnull)
+        output, _ = process.communicate(stdin_data)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return output
+
+
+class Transfer(object):
+    """The state of a copy of one file, split into chunks.
+
+    The checksum of each chunk is recorded in a file in the per-user
+    config directory as soon as the chunk is completed, so that an
+    interrupted copy can be resumed.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      ssh_tunnel: The tunnel.Tunnel whose master connection to use
+      key: A list of values that identify the copy
+      size: The size of the file, in bytes
+    """
+
+    def __init__(self, args, ssh_tunnel, key, size):
+        self._args = args
+        self._tunnel = ssh_tunnel
+        self.size = size
+        self.chunk_size = args.chunk_size_mb * 1024 * 1024
+        self.chunk_count = max(
+            1, (size + self.chunk_size - 1) // self.chunk_size)
+        self.bytes_sent = 0
+        digest = hashlib.sha1(
+            json.dumps(key + [self.chunk_size]).encode('utf-8')).hexdigest()
+        transfers_dir = os.path.join(
+            localstate.datalab_config_dir(), _TRANSFERS_DIR)
+        if not os.path.isdir(transfers_dir):
+            os.makedirs(transfers_dir)
+        self._state_path = os.path.join(transfers_dir, digest + '.json')
+
+    def chunk_range(self, index):
+        """Get the offset and length of the given chunk."""
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    @property
+    def completed(self):
+        """A dictionary mapping completed chunks to their checksums."""
+        contents = localstate.read_json_file(self._state_path, default={})
+        if not isinstance(contents, dict):
+            return {}
+        return dict((int(index), checksum) for index, checksum
+                    in contents.get('chunks', {}).items())
+
+    def complete(self, index, checksum, sent):
+        """Record that the given chunk was completed."""
+        def update(contents):
+            contents.setdefault('chunks', {})[str(index)] = checksum
+
+        localstate.update_json_file(self._state_path, update)
+        self.bytes_sent += sent
+
+    def forget(self, indices=None):
+        """Forget the given chunks, or the whole copy if none are given."""
+        if indices is None:
+            if os.path.exists(self._state_path):
+                os.remove(self._state_path)
+            return
+
+        def update(contents):
+            for index in indices:
+                contents.get('chunks', {}).pop(str(index), None)
+
+        localstate.update_json_file(self._state_path, update)
+
+    def run_remote(self, script, stdin_data=None, capture=False):
+        """Run a shell script on the instance; see `run_remote`."""
+        return run_remote(self._tunnel, script, stdin_data=stdin_data,
+                          capture=capture)
+
+    def remote_checksums(self, host_path):
+        """Compute the checksum of every chunk of a file on the instance.
+
+        Returns:
+          A list of the checksums, in the order of the chunks.
+        """
+        script = (
+            'i=0; while [ $i -lt {count} ]; do '
+            'dd if={path} bs=1M skip=$((i * {chunk})) count={chunk} '
+            'iflag=skip_bytes,count_bytes status=none '
+            '| sha256sum | cut -c1-64; i=$((i + 1)); done').format(
+                count=self.chunk_count, chunk=self.chunk_size,
+                path=quote(host_path))
+        return self.run_remote(script, capture=True).decode(
+            'utf-8').split()
+
+    def run(self, copy_chunk, host_path, location):
+        """Copy every chunk that is not yet completed, then verify them.
+
+        Chunks whose checksums do not match are copied once more.
+
+        Args:
+          copy_chunk: A function that copies the chunk with the given
+            index and records it as completed
+          host_path: The path of the file, or partial file, on the instance
+          location: The location of the file, for error messages
+        Returns:
+          The number of chunks that were already completed.
+        Raises:
+          ChecksumMismatchException: If some chunks still do not match
+        """
+        completed = self.completed
+        resumed = len([index for index in completed
+                       if index < self.chunk_count])
+        for attempt in range(2):
+            pending = [index for index in range(self.chunk_count)
+                       if index not in completed]
+            utils.run_concurrently(
+                dict((index, lambda index=index: copy_chunk(index))
+                     for index in pending),
+                max_workers=max(1, self._args.streams))
+            completed = self.completed
+            remote = self.remote_checksums(host_path)
+            mismatched = [index for index in range(self.chunk_count)
+                          if index >= len(remote) or
+                          completed.get(index) != remote[index]]
+            if not mismatched:
+                return resumed
+            self.forget(mismatched)
+            completed = self.completed
+        raise ChecksumMismatchException(mismatched, location)
+
+
+def upload(args, ssh_tunnel, local_path, instance, remote_path):
+    """Copy a local file to the instance.
+
+    Returns:
+      A tuple of the Transfer instance, and the number of chunks resumed.
+    """
+    if not os.path.isfile(local_path):
+        raise NoSuchFileException(local_path)
+    size = os.path.getsize(local_path)
+    name = os.path.basename(local_path)
+    script = 'p={path}; if [ -d "$p" ]; then p="$p"/{name}; fi; echo "$p"'
+    host_path = run_remote(ssh_tunnel, script.format(
+        path=quote(remote_host_path(remote_path)), name=quote(name)),
+        capture=True).decode('utf-8').strip()
+    part_path = host_path + _PART_SUFFIX
+    transfer = Transfer(
+        args, ssh_tunnel,
+        ['upload', inventory.project_key(args), args.zone, instance,
+         os.path.abspath(local_path), host_path, size,
+         os.path.getmtime(local_path)],
+        size)
+    transfer.run_remote(
+        'mkdir -p {dir} && touch {part} && truncate -s {size} {part}'.format(
+            dir=quote(posixpath.dirname(host_path)), part=quote(part_path),
+            size=size))
+
+    def send_chunk(index):
+        offset, length = transfer.chunk_range(index)
+        with open(local_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        script = ('dd of={part} bs=1M seek={offset} oflag=seek_bytes '
+                  'conv=notrunc status=none').format(
+                      part=quote(part_path), offset=offset)
+        payload = data
+        if _should_compress_chunk(args, data):
+            script = 'gzip -dc | ' + script
+            payload = _gzip(data)
+        transfer.run_remote(script, stdin_data=payload)
+        transfer.complete(index, _sha256(data), len(payload))
+
+    resumed = transfer.run(send_chunk, part_path, host_path)
+    transfer.run_remote('mv -f {part} {path}'.format(
+        part=quote(part_path), path=quote(host_path)))
+    transfer.forget()
+    return transfer, resumed
+
+
+def download(args, ssh_tunnel, instance, remote_path, local_path):
+    """Copy a file from the instance to the local machine.
+
+    Returns:
+      A tuple of the Transfer instance, and the number of chunks resumed.
+    """
+    host_path = remote_host_path(remote_path)
+    script = 'p={path}; if [ -f "$p" ]; then stat -c "%s %Y" "$p"; fi'
+    stat = run_remote(ssh_tunnel, script.format(path=quote(host_path)),
+                      capture=True).decode('utf-8').split()
+    if not stat:
+        raise NoSuchFileException('{}:{}'.format(instance, remote_path))
+    size, mtime = int(stat[0]), int(stat[1])
+    if os.path.isdir(local_path):
+        local_path = os.path.join(local_path, posixpath.basename(host_path))
+    part_path = local_path + _PART_SUFFIX
+    transfer = Transfer(
+        args, ssh_tunnel,
+        ['download', inventory.project_key(args), args.zone, instance,
+         host_path, size, mtime, os.path.abspath(local_path)],
+        size)
+    if not os.path.exists(part_path):
+        transfer.forget()
+    with open(part_path, 'ab') as f:
+        f.truncate(size)
+    compress = _should_compress_file(args, host_path)
+
+    def fetch_chunk(index):
+        offset, length = transfer.chunk_range(index)
+        script = ('dd if={path} bs=1M skip={offset} count={length} '
+                  'iflag=skip_bytes,count_bytes status=none').format(
+                      path=quote(host_path), offset=offset, length=length)
+        if compress:
+            script += ' | gzip -{}c'.format(_COMPRESSION_LEVEL)
+        payload = transfer.run_remote(script, capture=True)
+        data = zlib.decompress(payload, _GZIP_WBITS) if compress else payload
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        transfer.complete(index, _sha256(data), len(payload))
+
+    resumed = transfer.run(fetch_chunk, host_path, local_path)
+    if os.name == 'nt' and os.path.exists(local_path):
+        os.remove(local_path)
+    os.rename(part_path, local_path)
+    transfer.forget()
+    return transfer, resumed
+
+
+def run(args, gcloud_compute, **unused_kwargs):
+    """Implementation of the `datalab cp` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` or `ssh` call
+        fails
+      CopyNotSupportedException: If the platform does not support it
+      LocationException: If not exactly one location is on an instance
+      RemotePathException: If the path on the instance is not under
+        /content
+      NoSuchFileException: If the source is not a file
+      ChecksumMismatchException: If the copied file could not be verified
+    """
+    if not tunnel.multiplexing_supported():
+        raise CopyNotSupportedException()
+    source_instance, source_path = parse_location(args.source)
+    dest_instance, dest_path = parse_location(args.destination)
+    if bool(source_instance) == bool(dest_instance):
+        raise LocationException()
+    instance = source_instance or dest_instance
+    # This resolves the zone, which identifies the connection.
+    utils.get_instance_record(args, gcloud_compute, instance)
+
+    ssh_tunnel = tunnel.Tunnel(args, gcloud_compute, instance, [])
+    opened = not ssh_tunnel.master_alive()
+    if opened:
+        ssh_tunnel.open()
+    start = time.time()
+    try:
+        if source_instance:
+            transfer, resumed = download(
+                args, ssh_tunnel, instance, source_path, dest_path)
+        else:
+            transfer, resumed = upload(
+                args, ssh_tunnel, source_path, instance, dest_path)
+    finally:
+        if opened:
+            ssh_tunnel.close()
+    elapsed = max(time.time() - start, 1e-3)
+    print('Copied {0} in {1:.1f} seconds ({2}/s), transferring {3}'.format(
+        utils.format_bytes(transfer.size), elapsed,
+        utils.format_bytes(transfer.size / elapsed),
+        utils.format_bytes(transfer.bytes_sent)))
+    if resumed:
+        print('Resumed {0} of {1} chunks from an interrupted copy'.format(
+            resumed, transfer.chunk_count))
+    return
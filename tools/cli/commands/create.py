@@ -16,12 +16,13 @@
 
 from __future__ import absolute_import
 
+import argparse
 import json
 import os
 import subprocess
 import tempfile
 
-from . import connect, utils
+from . import connect, inventory, utils, wait
 
 try:
     # If we are running in Python 2, builtins is available in 'future'.
@@ -39,7 +40,11 @@ This command also creates the 'datalab-network' network if necessary.
 
 By default, the command creates a persistent connection to the newly
 created instance. You can disable that behavior by passing in the
-'--no-connect' flag.""")
+'--no-connect' flag.
+
+With the '--async' flag, the command returns as soon as the instance
+has started being created, without connecting to it. The creation can
+then be waited for with the `wait` command.""")
 
 
 _DATALAB_NETWORK = 'datalab-network'
@@ -53,11 +58,115 @@ _DATALAB_UNEXPECTED_FIREWALLS_WARNING_TEMPLATE = (
     'be open to traffic that they should not be exposed to.')
 
 _DATALAB_DEFAULT_DISK_SIZE_GB = 200
+_DATALAB_DISK_TYPES = ['pd-standard', 'pd-balanced', 'pd-ssd']
+_DATALAB_DEFAULT_DISK_TYPE = 'pd-standard'
 _DATALAB_DISK_DESCRIPTION = (
     'Persistent disk for a Google Cloud Datalab instance')
 
 _DATALAB_NOTEBOOKS_REPOSITORY = 'datalab-notebooks'
 
+_DATALAB_IMAGE = 'gcr.io/cloud-datalab/datalab:latest'
+_DATALAB_GPU_IMAGE = 'gcr.io/cloud-datalab/datalab-gpu:latest'
+
+# Images that are pulled from the regional registry nearest to the
+# instance unless told otherwise.
+_DATALAB_DEFAULT_IMAGES = [_DATALAB_IMAGE, _DATALAB_GPU_IMAGE]
+
+_GLOBAL_REGISTRY = 'gcr.io'
+_REGIONAL_REGISTRIES = {
+    'us': 'us.gcr.io',
+    'eu': 'eu.gcr.io',
+    'asia': 'asia.gcr.io',
+}
+_REGISTRY_REGIONS = ['auto', 'global'] + sorted(_REGIONAL_REGISTRIES)
+
+# The regional registry nearest to the zones in each geographic area,
+# keyed by the first part of the zones' names.
+_AREA_REGISTRY_REGIONS = {
+    'africa': 'eu',
+    'asia': 'asia',
+    'australia': 'asia',
+    'europe': 'eu',
+    'me': 'eu',
+    'northamerica': 'us',
+    'southamerica': 'us',
+    'us': 'us',
+}
+
+_SWAP_MODES = ['file', 'zram', 'local-ssd']
+
+_DEFAULT_SHM_SIZE = '50%'
+
+# Resource limits that can be set for the container with `--ulimit`.
+_ULIMIT_NAMES = [
+    'core', 'cpu', 'data', 'fsize', 'locks', 'memlock', 'msgqueue', 'nice',
+    'nofile', 'nproc', 'rss', 'rtprio', 'rttime', 'sigpending', 'stack',
+]
+
+_TMP_STORAGE_TYPES = ['persistent-disk', 'local-ssd', 'tmpfs']
+
+# How the persistent disk is formatted, mounted and maintained, keyed
+# by the name of the disk profile. The format options only take effect
+# when the disk is first formatted.
+_DISK_PROFILES = {
+    'standard': {
+        'format-options': 'lazy_itable_init=1,lazy_journal_init=1,nodiscard',
+        'mount-options': 'defaults,noatime',
+        'readahead-kb': 0,
+        'periodic-trim': True,
+    },
+    'throughput': {
+        'format-options': 'lazy_itable_init=1,lazy_journal_init=1,nodiscard',
+        'mount-options': 'defaults,noatime',
+        'readahead-kb': 4096,
+        'periodic-trim': True,
+    },
+    'legacy': {
+        'format-options': 'lazy_itable_init=0,lazy_journal_init=0,discard',
+        'mount-options': 'discard,defaults',
+        'readahead-kb': 0,
+        'periodic-trim': False,
+    },
+}
+_DEFAULT_DISK_PROFILE = 'standard'
+
+# The performance of each persistent disk type, as the read IOPS, write
+# IOPS, read MB/s and write MB/s. Performance grows linearly with the
+# size of the disk from a baseline, up to a per-disk maximum.
+_DISK_PERFORMANCE = {
+    'pd-standard': {
+        'baseline': (0, 0, 0, 0),
+        'per-gb': (0.75, 1.5, 0.12, 0.12),
+        'max': (7500, 15000, 1200, 400),
+    },
+    'pd-balanced': {
+        'baseline': (3000, 3000, 140, 140),
+        'per-gb': (6, 6, 0.28, 0.28),
+        'max': (80000, 80000, 1200, 1200),
+    },
+    'pd-ssd': {
+        'baseline': (6000, 6000, 240, 240),
+        'per-gb': (30, 30, 0.48, 0.48),
+        'max': (100000, 100000, 1200, 1200),
+    },
+}
+
+_DISK_PERFORMANCE_MESSAGE = (
+    'The {0} GB {1} disk {2} is expected to provide up to {3} read and {4} '
+    'write IOPS, and {5} MB/s of read and {6} MB/s of write throughput. '
+    'The actual limits also depend on the machine type.')
+
+_DATALAB_PD_MOUNT_DIR = '/mnt/disks/datalab-pd'
+_DATALAB_SCRATCH_DIR = '/mnt/disks/datalab-scratch'
+_DEFAULT_SWAP_SIZE = 'auto'
+
+# Where `bake-image` records the Datalab image that it preloaded on a
+# boot disk, and the image families in which it saves baked boot disks.
+_BAKED_IMAGE_FILE = '/var/lib/datalab/baked-image'
+_BAKED_IMAGE_FAMILY = 'datalab-baked'
+_BAKED_GPU_IMAGE_FAMILY = 'datalab-gpu-baked'
+_BAKED_IMAGE_DESCRIPTION = 'Datalab boot disk preloaded with {}'
+
 _DATALAB_BASE_STARTUP_SCRIPT = """#!/bin/bash
 
 # First, make sure the `datalab` user exists with their
@@ -66,9 +175,115 @@ useradd datalab
 
 PERSISTENT_DISK_DEV="/dev/disk/by-id/google-datalab-pd"
 MOUNT_DIR="/mnt/disks/datalab-pd"
-MOUNT_CMD="mount -o discard,defaults ${{PERSISTENT_DISK_DEV}} ${{MOUNT_DIR}}"
+MOUNT_CMD="mount -o {10} ${{PERSISTENT_DISK_DEV}} ${{MOUNT_DIR}}"
+IMAGE_CACHE_DIR="${{MOUNT_DIR}}/image-cache"
+IMAGE_CACHE_FILE="${{IMAGE_CACHE_DIR}}/image.tar"
+IMAGE_CACHE_INDEX="${{IMAGE_CACHE_DIR}}/index"
+SCRATCH_DIR="{8}"
+BAKED_IMAGE_FILE="{15}"
+
+report_phase() {{
+  # Mark the start of a boot phase on the serial console, which is
+  # where `datalab connect` looks for the progress of the boot.
+  echo "{3} $1 $(date +%s)" > /dev/ttyS0 || true
+}}
+
+local_image_digest() {{
+  # Print the registry digest of the local copy of the image, if known.
+  image_id=$(docker image inspect --format '{{{{.Id}}}}' "{0}" 2>/dev/null)
+  if [ -z "${{image_id}}" ]; then
+    return
+  fi
+  repo_digest=$(docker image inspect \
+    --format '{{{{join .RepoDigests " "}}}}' "{0}" \
+    | grep -o 'sha256:[0-9a-f]*' | head -n 1)
+  if [ -n "${{repo_digest}}" ]; then
+    echo "${{repo_digest}}"
+    return
+  fi
+
+  # Images loaded from the cache on the persistent disk do not have
+  # any repo digests, so use the one recorded when it was saved.
+  read_image_cache_index
+  if [ "${{cached_name}}" == "{0}" ] && \
+      [ "${{cached_id}}" == "${{image_id}}" ]; then
+    echo "${{cached_digest}}"
+  fi
+}}
+
+remote_image_digest() {{
+  # Print the digest of the given image's manifest in its registry,
+  # without downloading any of its layers. Nothing is printed if the
+  # manifest could not be found, e.g. because the image is not in that
+  # registry, or for registries other than GCR.
+  image="$1"
+  if [[ "${{image}}" == *@sha256:* ]]; then
+    echo "${{image##*@}}"
+    return
+  fi
+  registry="${{image%%/*}}"
+  repository="${{image#*/}}"
+  tag="latest"
+  if [[ "${{repository##*/}}" == *:* ]]; then
+    tag="${{repository##*:}}"
+    repository="${{repository%:*}}"
+  fi
+  if [[ "${{registry}}" != "gcr.io" ]] && \
+      [[ "${{registry}}" != *.gcr.io ]]; then
+    return
+  fi
+
+  metadata_url="http://metadata.google.internal/computeMetadata/v1"
+  access_token=$(curl -sf -H "Metadata-Flavor: Google" \
+    "${{metadata_url}}/instance/service-accounts/default/token" \
+    | grep -o '"access_token":"[^"]*"' | cut -d '"' -f 4)
+  registry_token=$(curl -sf -u "oauth2accesstoken:${{access_token}}" \
+    "https://${{registry}}/v2/token?scope=repository:${{repository}}:pull" \
+    | grep -o '"token":"[^"]*"' | cut -d '"' -f 4)
+  curl -sfI -H "Authorization: Bearer ${{registry_token}}" \
+    -H "Accept: application/vnd.docker.distribution.manifest.v2+json" \
+    -H "Accept: application/vnd.docker.distribution.manifest.list.v2+json" \
+    "https://${{registry}}/v2/${{repository}}/manifests/${{tag}}" \
+    | tr -d '\\r' | grep -i '^docker-content-digest:' | cut -d ' ' -f 2
+}}
+
+read_image_cache_index() {{
+  # The index holds the name, registry digest, and ID of the saved image.
+  cached_name=""
+  cached_digest=""
+  cached_id=""
+  if [ -f "${{IMAGE_CACHE_INDEX}}" ]; then
+    read -r cached_name cached_digest cached_id < "${{IMAGE_CACHE_INDEX}}"
+  fi
+}}
+
+preloaded_docker_image() {{
+  # Check whether the boot disk was baked with the image already pulled,
+  # in which case it is used as is, without checking the registry.
+  [ "$(cat "${{BAKED_IMAGE_FILE}}" 2>/dev/null)" == "{0}" ] && \
+    docker image inspect "{0}" > /dev/null 2>&1
+}}
+
+load_cached_docker_image() {{
+  # A recreated instance starts out without the image, but a previous
+  # instance may have left a copy of it on the persistent disk.
+  read_image_cache_index
+  if [ "${{cached_name}}" != "{0}" ] || [ ! -f "${{IMAGE_CACHE_FILE}}" ]; then
+    return
+  fi
+  echo "Loading the image {0} from ${{IMAGE_CACHE_FILE}}"
+  if ! docker load --input "${{IMAGE_CACHE_FILE}}"; then
+    echo "Failed to load the cached image; removing it"
+    rm -f "${{IMAGE_CACHE_FILE}}" "${{IMAGE_CACHE_INDEX}}"
+  fi
+}}
 
 download_docker_image() {{
+  if preloaded_docker_image; then
+    echo "Using the image {0} preloaded on the boot disk"
+    return
+  fi
+
   # Since /root/.docker is not writable on the default image,
   # we need to set HOME to be a writable directory. This same
   # directory is used later on by the datalab.service.
@@ -76,11 +291,109 @@ download_docker_image() {{
   export HOME=/home/datalab
   echo "Getting Docker credentials"
   docker-credential-gcr configure-docker
-  echo "Pulling latest image: {0}"
-  docker pull {0}
+  if ! docker image inspect "{0}" > /dev/null 2>&1; then
+    load_cached_docker_image
+  fi
+
+  # Not every image is published to the regional registries, so the
+  # global registry is used unless the regional one has the image.
+  source_image="{0}"
+  remote_digest=$(remote_image_digest "{0}")
+  if [ -z "${{remote_digest}}" ] && [ "{14}" != "{0}" ]; then
+    source_image="{14}"
+    remote_digest=$(remote_image_digest "{14}")
+  fi
+
+  # Only pull the image if the registry has a different version of it.
+  local_digest=$(local_image_digest)
+  if [ -n "${{local_digest}}" ] && \
+      [ "${{local_digest}}" == "${{remote_digest}}" ]; then
+    echo "The image {0} is up to date at ${{local_digest}}"
+  else
+    pull_docker_image "${{source_image}}"
+  fi
   export HOME=$OLD_HOME
 }}
 
+pull_docker_image() {{
+  # Pull the image from the given registry, and tag it with its own
+  # name, which the service runs.
+  image="{0}"
+  source_image="$1"
+
+  # Prefer the project's pull-through mirror, if there is one.
+  mirror="{13}"
+  if [ -n "${{mirror}}" ]; then
+    mirrored_image="${{mirror}}/${{image#*/}}"
+    docker-credential-gcr configure-docker \
+      --registries="${{mirror%%/*}}" || true
+    echo "Pulling ${{mirrored_image}}"
+    if docker pull "${{mirrored_image}}" && \
+        docker tag "${{mirrored_image}}" "${{image}}"; then
+      return
+    fi
+    echo "Failed to pull the image through the mirror ${{mirror}}"
+  fi
+
+  echo "Pulling latest image: ${{source_image}}"
+  if docker pull "${{source_image}}"; then
+    if [ "${{source_image}}" != "${{image}}" ]; then
+      docker tag "${{source_image}}" "${{image}}"
+    fi
+    return
+  fi
+
+  # The regional registry may still fail to serve an image that it
+  # lists, so fall back to the global one.
+  fallback_image="{14}"
+  if [ "${{fallback_image}}" != "${{source_image}}" ]; then
+    echo "Pulling ${{fallback_image}} instead"
+    docker pull "${{fallback_image}}" && \
+      docker tag "${{fallback_image}}" "${{image}}"
+  fi
+}}
+
+save_docker_image() {{
+  # Keep a copy of the image on the persistent disk, so that an
+  # instance recreated with the same disk does not have to pull it.
+  if [ "{4}" == "false" ] || preloaded_docker_image; then
+    rm -rf "${{IMAGE_CACHE_DIR}}"
+    return
+  fi
+  image_id=$(docker image inspect --format '{{{{.Id}}}}' "{0}" 2>/dev/null)
+  digest=$(local_image_digest)
+  if [ -z "${{image_id}}" ] || [ -z "${{digest}}" ]; then
+    return
+  fi
+  read_image_cache_index
+  if [ -f "${{IMAGE_CACHE_FILE}}" ] && \
+      [ "${{cached_name}} ${{cached_digest}} ${{cached_id}}" == \
+        "{0} ${{digest}} ${{image_id}}" ]; then
+    echo "The cached image is up to date"
+    return
+  fi
+
+  # Only cache the image if that leaves plenty of room for notebooks.
+  image_bytes=$(docker image inspect --format '{{{{.Size}}}}' "{0}")
+  image_kb=`expr ${{image_bytes}} / 1024`
+  disk_kb_cutoff=`expr 4 "*" ${{image_kb}}`
+  disk_kb_available=`df --output=avail ${{MOUNT_DIR}} | tail -n 1`
+  if [ "${{disk_kb_available}}" -lt "${{disk_kb_cutoff}}" ]; then
+    echo "Not enough free space to cache the image on the persistent disk"
+    return
+  fi
+
+  echo "Saving the image {0} to ${{IMAGE_CACHE_FILE}}"
+  mkdir -p "${{IMAGE_CACHE_DIR}}"
+  rm -f "${{IMAGE_CACHE_INDEX}}"
+  if docker save --output "${{IMAGE_CACHE_FILE}}.partial" "{0}"; then
+    mv "${{IMAGE_CACHE_FILE}}.partial" "${{IMAGE_CACHE_FILE}}"
+    echo "{0} ${{digest}} ${{image_id}}" > "${{IMAGE_CACHE_INDEX}}"
+  else
+    rm -f "${{IMAGE_CACHE_FILE}}.partial" "${{IMAGE_CACHE_FILE}}"
+  fi
+}}
+
 clone_repo() {{
   echo "Creating the datalab directory"
   mkdir -p ${{MOUNT_DIR}}/content/datalab
@@ -113,9 +426,12 @@ populate_repo() {{
 format_disk() {{
   echo "Formatting the persistent disk"
   mkfs.ext4 -F \
-    -E lazy_itable_init=0,lazy_journal_init=0,discard \
+    -E {9} \
     ${{PERSISTENT_DISK_DEV}}
   ${{MOUNT_CMD}}
+  # The image is needed to clone the repo, and there is no cached copy
+  # of it on a freshly formatted disk.
+  download_docker_image
   clone_repo
   if ! repo_is_populated; then
     populate_repo
@@ -135,6 +451,32 @@ checked_format_disk() {{
   fi
 }}
 
+tune_disk() {{
+  readahead_kb="{11}"
+  if [ "${{readahead_kb}}" != "0" ]; then
+    echo "Setting the readahead of the persistent disk to ${{readahead_kb}}KB"
+    blockdev --setra `expr 2 "*" ${{readahead_kb}}` "${{PERSISTENT_DISK_DEV}}"
+  fi
+
+  # Trimming the disk periodically, rather than on every delete, keeps
+  # deletes of many small files fast.
+  if [ "{12}" == "true" ]; then
+    echo "Scheduling a daily trim of the persistent disk"
+    systemctl stop datalab-fstrim.timer 2>/dev/null
+    systemd-run --unit=datalab-fstrim --on-active=1h --on-unit-active=1d \
+      fstrim -v "${{MOUNT_DIR}}"
+  fi
+}}
+
+grow_file_system() {{
+  # The disk may have been resized since it was formatted, e.g. by
+  # `datalab resize`, so grow the file system to fill it. This is done
+  # online, and does nothing if the file system already fills the disk.
+  if ! resize2fs "${{PERSISTENT_DISK_DEV}}"; then
+    echo "Failed to grow the file system on the persistent disk"
+  fi
+}}
+
 mount_and_prepare_disk() {{
   echo "Trying to mount the persistent disk"
   mkdir -p "${{MOUNT_DIR}}"
@@ -145,6 +487,8 @@ mount_and_prepare_disk() {{
     reboot now
   fi
 
+  grow_file_system
+  tune_disk
   chmod a+w "${{MOUNT_DIR}}"
   mkdir -p "${{MOUNT_DIR}}/content"
 
@@ -159,13 +503,23 @@ mount_and_prepare_disk() {{
   fi
 }}
 
-configure_swap() {{
-  if [ "{2}" == "false" ]; then
-    return
+swap_size_kb() {{
+  # Compute the size of the swap space from the memory size, according
+  # to the swap size policy: either a percentage of memory, or a fixed
+  # number of megabytes. The size is rounded down to whole megabytes.
+  memory_kb="$1"
+  policy="{5}"
+  if [[ "${{policy}}" == *% ]]; then
+    size_mb=`expr ${{memory_kb}} "*" ${{policy%\\%}} / 100 / 1024`
+  else
+    size_mb="${{policy%M}}"
   fi
-  mem_total_line=`cat /proc/meminfo | grep MemTotal`
-  mem_total_value=`echo "${{mem_total_line}}" | cut -d ':' -f 2`
-  memory_kb=`echo "${{mem_total_value}}" | cut -d 'k' -f 1 | tr -d '[:space:]'`
+  expr ${{size_mb}} "*" 1024
+}}
+
+configure_file_swap() {{
+  swap_kb="$1"
+  memory_kb="$2"
 
   # Before proceeding, check if we have more disk than memory.
   # Specifically, if the free space on disk is not N times the
@@ -175,28 +529,129 @@ configure_swap() {{
   disk_kb_cutoff=`expr 10 "*" ${{memory_kb}}`
   disk_kb_available=`df --output=avail ${{MOUNT_DIR}} | tail -n 1`
   if [ "${{disk_kb_available}}" -lt "${{disk_kb_cutoff}}" ]; then
-    return
+    echo "Not enough free disk space for a swapfile"
+    return 1
   fi
 
   swapfile="${{MOUNT_DIR}}/swapfile"
 
-  # Create the swapfile if it is either missing or not big enough
+  # Create the swapfile if it is either missing or not the right size.
+  # The space is allocated with fallocate, which unlike writing zeros
+  # takes time independent of the size, with dd as a fallback for file
+  # systems that do not support it.
   current_size="0"
   if [ -e "${{swapfile}}" ]; then
     current_size=`ls -s ${{swapfile}} | cut -d ' ' -f 1`
   fi
-  if [ "${{memory_kb}}" -gt "${{current_size}}" ]; then
-    echo "Creating a ${{memory_kb}} kilobyte swapfile at ${{swapfile}}"
-    dd if=/dev/zero of="${{swapfile}}" bs=1024 count="${{memory_kb}}"
+  if [ "${{swap_kb}}" != "${{current_size}}" ]; then
+    echo "Creating a ${{swap_kb}} kilobyte swapfile at ${{swapfile}}"
+    rm -f "${{swapfile}}"
+    if ! fallocate -l "${{swap_kb}}KiB" "${{swapfile}}"; then
+      dd if=/dev/zero of="${{swapfile}}" bs=1M count=`expr ${{swap_kb}} / 1024`
+    fi
   fi
   chmod 0600 "${{swapfile}}"
   mkswap "${{swapfile}}"
 
-  # Enable swap
   sysctl vm.disk_based_swap=1
   swapon "${{swapfile}}"
 }}
 
+configure_zram_swap() {{
+  swap_kb="$1"
+
+  # A zram device keeps compressed pages in memory, so it is only worth
+  # the CPU time if the data compresses well, which is usually the case
+  # for the numeric arrays of a notebook.
+  if ! modprobe zram num_devices=1; then
+    echo "The kernel does not support zram"
+    return 1
+  fi
+  zram_dev="/dev/zram0"
+  swapoff "${{zram_dev}}" 2>/dev/null
+  echo 1 > /sys/block/zram0/reset
+  echo lz4 > /sys/block/zram0/comp_algorithm || true
+  echo "${{swap_kb}}K" > /sys/block/zram0/disksize || return 1
+  mkswap "${{zram_dev}}"
+  swapon -p 100 "${{zram_dev}}"
+}}
+
+local_ssd_device() {{
+  # Print the device of the first attached local SSD, if any.
+  for ssd in /dev/disk/by-id/google-local-nvme-ssd-0 \
+             /dev/disk/by-id/google-local-ssd-0; do
+    if [ -e "${{ssd}}" ]; then
+      echo "${{ssd}}"
+      return
+    fi
+  done
+}}
+
+configure_local_ssd_swap() {{
+  swap_kb="$1"
+  ssd=$(local_ssd_device)
+  if [ -z "${{ssd}}" ]; then
+    echo "No local SSD is attached"
+    return 1
+  fi
+
+  # The contents of local SSDs do not survive the instance being
+  # stopped, so the swap partition has to be recreated on each boot.
+  swap_partition="${{ssd}}-part1"
+  if [ "$(blkid -o value -s TYPE ${{swap_partition}})" != "swap" ]; then
+    echo "Creating a ${{swap_kb}} kilobyte swap partition on ${{ssd}}"
+    # The rest of the SSD is left in a second partition for scratch space.
+    printf ",${{swap_kb}}KiB,S\\n,,L\\n" | \
+      sfdisk --label gpt "${{ssd}}" || return 1
+    udevadm settle
+    mkswap "${{swap_partition}}" || return 1
+  fi
+
+  sysctl vm.disk_based_swap=1
+  swapon -d "${{swap_partition}}"
+}}
+
+configure_swap() {{
+  swap_mode="{2}"
+  if [ "${{swap_mode}}" == "none" ]; then
+    return
+  fi
+  swap_start=`date +%s`
+  mem_total_line=`cat /proc/meminfo | grep MemTotal`
+  mem_total_value=`echo "${{mem_total_line}}" | cut -d ':' -f 2`
+  memory_kb=`echo "${{mem_total_value}}" | cut -d 'k' -f 1 | tr -d '[:space:]'`
+  swap_kb=`swap_size_kb ${{memory_kb}}`
+  if [ "${{swap_kb}}" -le 0 ]; then
+    return
+  fi
+
+  case "${{swap_mode}}" in
+    zram)
+      configure_zram_swap "${{swap_kb}}"
+      ;;
+    local-ssd)
+      configure_local_ssd_swap "${{swap_kb}}"
+      ;;
+    *)
+      configure_file_swap "${{swap_kb}}" "${{memory_kb}}"
+      ;;
+  esac
+  swap_status="$?"
+  if [ "${{swap_status}}" != "0" ] && [ "${{swap_mode}}" != "file" ]; then
+    echo "Failed to set up ${{swap_mode}} swap; falling back to a swapfile"
+    swap_mode="file"
+    configure_file_swap "${{swap_kb}}" "${{memory_kb}}"
+    swap_status="$?"
+  fi
+  swap_end=`date +%s`
+  if [ "${{swap_status}}" == "0" ]; then
+    echo "Set up ${{swap_kb}} kilobytes of ${{swap_mode}} swap" \
+      "in `expr ${{swap_end}} - ${{swap_start}}` seconds"
+  else
+    echo "Swap was not enabled"
+  fi
+}}
+
 cleanup_tmp() {{
   tmpdir="${{MOUNT_DIR}}/tmp"
 
@@ -213,17 +668,135 @@ cleanup_tmp() {{
   find "${{tmpdir}}/" -mindepth 1 -delete
 }}
 
+local_ssd_scratch_devices() {{
+  # Print the local SSD devices, or partitions of them, that are free to
+  # be used for scratch space.
+  for ssd in /dev/disk/by-id/google-local-nvme-ssd-* \
+             /dev/disk/by-id/google-local-ssd-*; do
+    if [ ! -e "${{ssd}}" ] || [[ "${{ssd}}" == *-part* ]]; then
+      continue
+    fi
+    if [ -e "${{ssd}}-part1" ]; then
+      # The first partition holds the swap space, and the second
+      # one the rest of the SSD.
+      if [ -e "${{ssd}}-part2" ]; then
+        echo "${{ssd}}-part2"
+      fi
+    else
+      echo "${{ssd}}"
+    fi
+  done
+}}
+
+prepare_scratch() {{
+  # Set up scratch space on the local SSDs, striping them together when
+  # there is more than one. Since files left behind before a reboot are
+  # not wanted, the file system is recreated on every boot, which is far
+  # faster than deleting them.
+  devices=( $(local_ssd_scratch_devices) )
+  if [ "${{#devices[@]}}" == "0" ]; then
+    echo "No local SSDs are available for scratch space"
+    return 1
+  fi
+  scratch_dev="${{devices[0]}}"
+  if [ "${{#devices[@]}}" -gt 1 ]; then
+    if which mdadm > /dev/null; then
+      echo "Striping the local SSDs ${{devices[@]}}"
+      mdadm --stop --scan
+      mdadm --create /dev/md0 --run --force --level=0 \
+        --raid-devices=${{#devices[@]}} "${{devices[@]}}" \
+        && scratch_dev="/dev/md0"
+    else
+      echo "mdadm is not available; only using ${{scratch_dev}}"
+    fi
+  fi
+
+  echo "Formatting ${{scratch_dev}} for scratch space"
+  mkfs.ext4 -F -q -m 0 \
+    -E lazy_itable_init=1,lazy_journal_init=1,nodiscard \
+    "${{scratch_dev}}" || return 1
+  mkdir -p "${{SCRATCH_DIR}}"
+  mount -o discard,noatime "${{scratch_dev}}" "${{SCRATCH_DIR}}" || return 1
+  mkdir -p "${{SCRATCH_DIR}}/tmp" "${{SCRATCH_DIR}}/scratch"
+  chmod 1777 "${{SCRATCH_DIR}}/tmp"
+  chmod a+w "${{SCRATCH_DIR}}/scratch"
+}}
+
+prepare_tmp() {{
+  # The Datalab service waits for the temporary directory on the
+  # persistent disk to exist, whichever storage backs the container's
+  # `/tmp` directory.
+  mkdir -p "${{MOUNT_DIR}}/tmp"
+  if [ "{6}" == "true" ] && ! prepare_scratch; then
+    echo "Falling back to the persistent disk for scratch space"
+    mkdir -p "${{MOUNT_DIR}}/scratch" "${{SCRATCH_DIR}}"
+    mount --bind "${{MOUNT_DIR}}" "${{SCRATCH_DIR}}"
+    cleanup_tmp
+  elif [ "{7}" == "persistent-disk" ]; then
+    cleanup_tmp
+  fi
+}}
+
 """
 
 _DATALAB_STARTUP_SCRIPT = _DATALAB_BASE_STARTUP_SCRIPT + """
-download_docker_image
+report_phase disk
 mount_and_prepare_disk
+report_phase image-pull
+download_docker_image
+report_phase swap
 configure_swap
-cleanup_tmp
+report_phase tmp-cleanup
+prepare_tmp
+report_phase startup-done
+save_docker_image
 
 journalctl -u google-startup-scripts --no-pager > /var/log/startupscript.log
 """
 
+# The startup script of the builder instance used by `bake-image`. This
+# leaves the image, and if needed a build of the GPU driver, on the boot
+# disk, and records the image so that instances booted from the baked
+# disk skip pulling it.
+_DATALAB_BAKE_SCRIPT = _DATALAB_BASE_STARTUP_SCRIPT + """
+install_gpu_driver() {{
+  mkdir -p /etc/datalab
+  cat > /etc/nvidia-installer-env <<'EOF'
+{17}EOF
+  cat > /etc/datalab/install-gpu-driver.sh <<'EOF'
+{18}EOF
+  source /etc/nvidia-installer-env
+  mkdir -p "${{NVIDIA_INSTALL_DIR_HOST}}" && \\
+    mount --bind "${{NVIDIA_INSTALL_DIR_HOST}}" \\
+      "${{NVIDIA_INSTALL_DIR_HOST}}" && \\
+    mount -o remount,exec "${{NVIDIA_INSTALL_DIR_HOST}}" && \\
+    /bin/bash /etc/datalab/install-gpu-driver.sh
+}}
+
+bake() {{
+  mkdir -p /home/datalab
+  report_phase image-pull
+  download_docker_image
+  if ! docker image inspect "{0}" > /dev/null 2>&1; then
+    echo "Failed to pull the image {0}"
+    return 1
+  fi
+  if [ "{16}" == "true" ]; then
+    report_phase gpu-driver
+    install_gpu_driver || return 1
+  fi
+  mkdir -p "$(dirname "${{BAKED_IMAGE_FILE}}")"
+  echo "{0}" > "${{BAKED_IMAGE_FILE}}"
+  sync
+}}
+
+if bake; then
+  report_phase bake-done
+else
+  report_phase bake-failed
+fi
+"""
+
 _DATALAB_CLOUD_CONFIG = """
 #cloud-config
 
@@ -249,7 +822,7 @@ write_files:
     User=root
     Type=oneshot
     RemainAfterExit=true
-    ExecStart=/bin/bash -c 'while [ ! -e /mnt/disks/datalab-pd/tmp ]; do \
+    ExecStart=/bin/bash -c 'while [ ! -e {7} ]; do \
         sleep 1; \
         done'
 
@@ -267,11 +840,14 @@ write_files:
     [Service]
     Environment="HOME=/home/datalab"
     ExecStartPre=/usr/bin/docker-credential-gcr configure-docker
+    ExecStartPre=/bin/bash -c 'echo "{5} container-start $(date +%%s)" \
+        > /dev/ttyS0 || true'
     ExecStart=/usr/bin/docker run --rm -u 0 \
        --name=datalab \
        -p 127.0.0.1:8080:8080 \
        -v /mnt/disks/datalab-pd/content:/content \
-       -v /mnt/disks/datalab-pd/tmp:/tmp \
+       {6} \
+       {8} \
        --env=HOME=/content \
        --env=DATALAB_ENV=GCE \
        --env=DATALAB_DEBUG=true \
@@ -334,6 +910,29 @@ class CancelledException(Exception):
         super(CancelledException, self).__init__(CancelledException._MESSAGE)
 
 
+class DiskExistsException(Exception):
+
+    _MESSAGE = (
+        'The disk {0} already exists, so it cannot be created from the '
+        'snapshot {1}.'
+        '\n\n'
+        'Use `--disk-name` to choose the name of a new disk.')
+
+    def __init__(self, disk_name, snapshot):
+        super(DiskExistsException, self).__init__(
+            DiskExistsException._MESSAGE.format(disk_name, snapshot))
+
+
+class InvalidContainerResourcesException(Exception):
+
+    _MESSAGE = 'Invalid container resources for the machine type {}: {}'
+
+    def __init__(self, machine_type, reason):
+        super(InvalidContainerResourcesException, self).__init__(
+            InvalidContainerResourcesException._MESSAGE.format(
+                machine_type, reason))
+
+
 def flags(parser):
     """Add command line flags for the `create` subcommand.
 
@@ -344,15 +943,19 @@ def flags(parser):
         'instance',
         metavar='NAME',
         help='a name for the newly created instance')
+    image_flags(parser)
     parser.add_argument(
-        '--image-name',
-        dest='image_name',
-        default='gcr.io/cloud-datalab/datalab:latest',
-        help=(
-            'name of the Datalab image to run.'
-            '\n\n'
-            'If not specified, this defaults to the most recently\n'
-            'published image.'))
+        '--from-baked-image',
+        dest='baked_image_family',
+        metavar='FAMILY',
+        nargs='?',
+        const='',
+        default=None,
+        help=('boot the instance from the latest image in the given family '
+              'of images saved by `bake-image`, which defaults to `{}` '
+              '(`{}` for GPU instances). The Datalab image preloaded on '
+              'it is not pulled again.'.format(
+                  _BAKED_IMAGE_FAMILY, _BAKED_GPU_IMAGE_FAMILY)))
     parser.add_argument(
         '--disk-name',
         dest='disk_name',
@@ -368,6 +971,33 @@ def flags(parser):
         dest='disk_size_gb',
         default=_DATALAB_DEFAULT_DISK_SIZE_GB,
         help='size of the persistent disk in GB.')
+    parser.add_argument(
+        '--from-snapshot',
+        dest='from_snapshot',
+        metavar='SNAPSHOT',
+        default=None,
+        help=('create the persistent disk from a snapshot taken by '
+              '`datalab snapshot`, rather than empty. The disk is at '
+              'least as large as the snapshotted one, and can be in any '
+              'zone.'))
+    parser.add_argument(
+        '--disk-type',
+        dest='disk_type',
+        choices=_DATALAB_DISK_TYPES,
+        default=_DATALAB_DEFAULT_DISK_TYPE,
+        help=('type of the persistent disk, if it is created. Defaults '
+              'to `{}`.'.format(_DATALAB_DEFAULT_DISK_TYPE)))
+    parser.add_argument(
+        '--disk-profile',
+        dest='disk_profile',
+        choices=sorted(_DISK_PROFILES),
+        default=_DEFAULT_DISK_PROFILE,
+        help=('how the persistent disk is formatted and mounted. '
+              '`standard` formats the disk lazily, mounts it without '
+              'access times, and trims it daily rather than on every '
+              'delete. `throughput` also increases the readahead for '
+              'large sequential reads, and `legacy` formats the disk '
+              'eagerly and mounts it with online discard.'))
     parser.add_argument(
         '--network-name',
         dest='network_name',
@@ -404,6 +1034,14 @@ def flags(parser):
         default=False,
         help='do not connect to the newly created instance')
 
+    parser.add_argument(
+        '--async',
+        dest='async_create',
+        action='store_true',
+        default=False,
+        help=('return as soon as the instance has started being created. '
+              'Use the `wait` command to wait for it to be ready.'))
+
     parser.add_argument(
         '--no-swap',
         dest='no_swap',
@@ -411,6 +1049,98 @@ def flags(parser):
         default=False,
         help='do not enable swap on the newly created instance')
 
+    parser.add_argument(
+        '--swap-mode',
+        dest='swap_mode',
+        choices=_SWAP_MODES,
+        default='file',
+        help=('where to put the swap space: a preallocated file on the '
+              'persistent disk (the default), a compressed in-memory zram '
+              'device, or a partition on an attached local SSD. If the '
+              'chosen mode cannot be set up, a file is used instead.'))
+
+    parser.add_argument(
+        '--swap-size',
+        dest='swap_size',
+        type=swap_size_policy,
+        default=swap_size_policy(_DEFAULT_SWAP_SIZE),
+        help=('the size of the swap space, as either `auto` (the size '
+              'of memory), a percentage (`50%%`) or multiple (`1.5x`) '
+              'of memory, or an absolute size such as `8G` or `512M`. '
+              'Defaults to `auto`.'))
+
+    parser.add_argument(
+        '--shm-size',
+        dest='shm_size',
+        type=memory_size_policy,
+        default=_DEFAULT_SHM_SIZE,
+        help=('the size of the container\'s `/dev/shm`, as either a '
+              'percentage of the machine\'s memory or an absolute size '
+              'such as `2G`. Defaults to `{}`.'.format(
+                  _DEFAULT_SHM_SIZE.replace('%', '%%'))))
+
+    parser.add_argument(
+        '--memory-limit',
+        dest='memory_limit',
+        type=memory_size_policy,
+        default=None,
+        help=('the maximum memory that the container can use, as either '
+              'a percentage of the machine\'s memory or an absolute size. '
+              'By default the container\'s memory is not limited.'))
+
+    parser.add_argument(
+        '--memory-swap-limit',
+        dest='memory_swap_limit',
+        type=memory_size_policy,
+        default=None,
+        help=('the maximum memory plus swap that the container can use. '
+              'Requires `--memory-limit`.'))
+
+    parser.add_argument(
+        '--cpuset',
+        dest='cpuset',
+        default=None,
+        help=('the CPUs on which the container may run, such as `0-3` or '
+              '`0,2`. By default the container can use every CPU.'))
+
+    parser.add_argument(
+        '--ulimit',
+        dest='ulimits',
+        type=ulimit,
+        action='append',
+        default=[],
+        help=('a resource limit for the container, as NAME=SOFT[:HARD], '
+              'such as `nofile=65536:65536`. May be repeated.'))
+
+    parser.add_argument(
+        '--local-ssd-count',
+        dest='local_ssd_count',
+        type=int,
+        default=0,
+        help=('the number of NVMe local SSDs to attach for scratch space. '
+              'They are striped together, and mounted in the container '
+              'at `/scratch` as well as at `/tmp` unless `--tmp-storage` '
+              'says otherwise. The contents of local SSDs are lost when '
+              'the instance is stopped.'))
+
+    parser.add_argument(
+        '--tmp-storage',
+        dest='tmp_storage',
+        choices=_TMP_STORAGE_TYPES,
+        default=None,
+        help=('the storage backing the container\'s `/tmp` directory. '
+              'Defaults to `local-ssd` if any local SSDs are attached, '
+              'and `persistent-disk` otherwise. `tmpfs` keeps temporary '
+              'files in memory, which suits small workloads.'))
+
+    parser.add_argument(
+        '--no-image-cache',
+        dest='no_image_cache',
+        action='store_true',
+        default=False,
+        help=('do not keep a copy of the Datalab image on the persistent '
+              'disk for use when the instance is recreated'))
+
     parser.add_argument(
         '--no-backups',
         dest='no_backups',
@@ -461,6 +1191,512 @@ def flags(parser):
     return
 
 
+def image_flags(parser):
+    """Add the command line flags that select the Datalab image to run.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        '--image-name',
+        dest='image_name',
+        default=_DATALAB_IMAGE,
+        help=(
+            'name of the Datalab image to run.'
+            '\n\n'
+            'If not specified, this defaults to the most recently\n'
+            'published image.'))
+    parser.add_argument(
+        '--image-registry-region',
+        dest='image_registry_region',
+        choices=_REGISTRY_REGIONS,
+        default='auto',
+        help=(
+            'the Container Registry region from which to pull a gcr.io '
+            'image. By default, the published Datalab images are pulled '
+            'from the regional registry nearest to the instance\'s zone '
+            'if it has them, and other images from the registry that they '
+            'name. Images that a regional registry does not have are '
+            'pulled from gcr.io.'))
+    parser.add_argument(
+        '--registry-mirror',
+        dest='registry_mirror',
+        default=None,
+        help=(
+            'a pull-through mirror of the image\'s registry, such as an '
+            'Artifact Registry remote repository '
+            '(`europe-docker.pkg.dev/PROJECT/REPOSITORY`). The image is '
+            'pulled through the mirror when possible.'))
+    return
+
+
+def swap_size_policy(value):
+    """Parse the value of the `--swap-size` flag.
+
+    Args:
+      value: The value given on the command line
+    Returns:
+      The swap size policy understood by the startup script; either a
+      percentage of memory such as '150%', or a size in megabytes such
+      as '8192M'.
+    Raises:
+      argparse.ArgumentTypeError: If the value is not a valid size.
+    """
+    if value.strip().lower() == 'auto':
+        return '100%'
+    return memory_size_policy(value)
+
+
+def memory_size_policy(value):
+    """Parse a size given either absolutely or relative to memory.
+
+    Args:
+      value: The value given on the command line, such as '50%', '1.5x',
+        '512M' or '8G'. Sizes without a unit are in gigabytes.
+    Returns:
+      Either a percentage of memory such as '150%', or a size in
+      megabytes such as '8192M'.
+    Raises:
+      argparse.ArgumentTypeError: If the value is not a valid size.
+    """
+    size = value.strip().lower()
+    try:
+        if size.endswith('%'):
+            percent = int(size[:-1])
+        elif size.endswith('x'):
+            percent = int(round(float(size[:-1]) * 100))
+        elif size.endswith('m'):
+            megabytes = int(size[:-1])
+            percent = None
+        else:
+            megabytes = int(float(size.rstrip('g')) * 1024)
+            percent = None
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid size: {}'.format(value))
+    if percent is not None:
+        if percent < 0:
+            raise argparse.ArgumentTypeError(
+                'invalid size: {}'.format(value))
+        return '{}%'.format(percent)
+    if megabytes < 0:
+        raise argparse.ArgumentTypeError(
+            'invalid size: {}'.format(value))
+    return '{}M'.format(megabytes)
+
+
+def ulimit(value):
+    """Parse the value of the `--ulimit` flag.
+
+    Args:
+      value: The value given on the command line, such as 'nofile=1024'
+    Returns:
+      The value in the form accepted by `docker run --ulimit`.
+    Raises:
+      argparse.ArgumentTypeError: If the value is not a valid limit.
+    """
+    name, _, limits = value.partition('=')
+    name = name.strip()
+    try:
+        soft, _, hard = limits.partition(':')
+        soft = int(soft)
+        hard = int(hard) if hard else soft
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid ulimit: {}'.format(value))
+    if name not in _ULIMIT_NAMES:
+        raise argparse.ArgumentTypeError(
+            'unknown ulimit {}; expected one of {}'.format(
+                name, ', '.join(_ULIMIT_NAMES)))
+    if hard != -1 and (soft == -1 or soft > hard):
+        raise argparse.ArgumentTypeError(
+            'the soft limit exceeds the hard limit: {}'.format(value))
+    return '{}={}:{}'.format(name, soft, hard)
+
+
+def machine_type_resources(args, gcloud_compute):
+    """Look up the CPUs and memory of the instance's machine type.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Returns:
+      A tuple of the number of CPUs and the memory in megabytes, or None
+      if they could not be looked up.
+    """
+    # Custom machine types spell out their resources in their names,
+    # e.g. 'custom-4-16384' or 'n2-custom-8-32768-ext'.
+    parts = args.machine_type.split('-')
+    if 'custom' in parts:
+        try:
+            index = parts.index('custom')
+            return int(parts[index + 1]), int(parts[index + 2])
+        except (IndexError, ValueError):
+            return None
+    if not args.zone:
+        return None
+    describe_cmd = [
+        'machine-types', 'describe', args.machine_type,
+        '--zone', args.zone, '--format', 'json']
+    with tempfile.TemporaryFile() as stdout, \
+            tempfile.TemporaryFile() as stderr:
+        try:
+            gcloud_compute(args, describe_cmd, stdout=stdout, stderr=stderr)
+            stdout.seek(0)
+            machine_type = json.loads(stdout.read().decode('utf-8'))
+            return (int(machine_type['guestCpus']),
+                    int(machine_type['memoryMb']))
+        except (subprocess.CalledProcessError, ValueError, KeyError):
+            return None
+
+
+def _size_mb(policy, memory_mb):
+    # Resolve a size returned by `memory_size_policy`.
+    if policy.endswith('%'):
+        if memory_mb is None:
+            return None
+        return memory_mb * int(policy[:-1]) // 100
+    return int(policy[:-1])
+
+
+def _cpu_ids(cpuset):
+    # Expand a cpuset such as '0-3,6' into the CPU IDs it contains.
+    ids = set()
+    for part in cpuset.split(','):
+        first, _, last = part.strip().partition('-')
+        ids.update(range(int(first), int(last or first) + 1))
+    return ids
+
+
+def container_resource_flags(args, machine_resources):
+    """Get the `docker run` flags that limit the container's resources.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      machine_resources: The tuple returned by `machine_type_resources`
+    Returns:
+      The flags, joined into a single string.
+    Raises:
+      InvalidContainerResourcesException: If the requested resources do
+        not fit the machine type, or are percentages of memory that could
+        not be looked up.
+    """
+    cpus, memory_mb = machine_resources or (None, None)
+
+    def invalid(reason):
+        return InvalidContainerResourcesException(args.machine_type, reason)
+
+    if memory_mb is None:
+        # Without the machine's memory, percentages cannot be resolved.
+        # A memory limit that was asked for is not silently dropped, but
+        # the container can make do with Docker's default /dev/shm.
+        for flag, policy in [('--memory-limit', args.memory_limit),
+                             ('--memory-swap-limit', args.memory_swap_limit)]:
+            if policy and policy.endswith('%'):
+                raise invalid('its memory could not be looked up, so {} '
+                              'must be an absolute size'.format(flag))
+        if args.shm_size.endswith('%') and \
+                utils.print_warning_messages(args):
+            print('Could not look up the memory of the machine type {}; '
+                  'ignoring --shm-size={}.'.format(
+                      args.machine_type, args.shm_size))
+
+    resource_flags = []
+    memory_limit_mb = None
+    if args.memory_limit:
+        memory_limit_mb = _size_mb(args.memory_limit, memory_mb)
+        if memory_mb is not None and memory_limit_mb > memory_mb:
+            raise invalid('the memory limit of {} MB exceeds the machine\'s '
+                          '{} MB of memory'.format(memory_limit_mb, memory_mb))
+        if memory_limit_mb is not None:
+            resource_flags.append('--memory={}m'.format(memory_limit_mb))
+    if args.memory_swap_limit:
+        if not args.memory_limit:
+            raise invalid('a memory and swap limit requires a memory limit')
+        memory_swap_mb = _size_mb(args.memory_swap_limit, memory_mb)
+        if memory_swap_mb is not None and memory_limit_mb is not None:
+            if memory_swap_mb < memory_limit_mb:
+                raise invalid('the memory and swap limit is less than the '
+                              'memory limit')
+            resource_flags.append('--memory-swap={}m'.format(memory_swap_mb))
+
+    shm_mb = _size_mb(args.shm_size, memory_mb)
+    if shm_mb is not None:
+        available_mb = memory_limit_mb or memory_mb
+        if available_mb is not None and shm_mb > available_mb:
+            raise invalid('the shared memory size of {} MB exceeds the {} MB '
+                          'of memory available'.format(shm_mb, available_mb))
+        if shm_mb > 0:
+            resource_flags.append('--shm-size={}m'.format(shm_mb))
+
+    if args.cpuset:
+        try:
+            cpu_ids = _cpu_ids(args.cpuset)
+        except ValueError:
+            raise invalid('invalid cpuset {}'.format(args.cpuset))
+        if cpus is not None and max(cpu_ids) >= cpus:
+            raise invalid('the cpuset {} includes CPUs beyond the machine\'s '
+                          '{} CPUs'.format(args.cpuset, cpus))
+        resource_flags.append('--cpuset-cpus={}'.format(args.cpuset))
+
+    for limit in args.ulimits:
+        resource_flags.append('--ulimit {}'.format(limit))
+    return ' '.join(resource_flags)
+
+
+def expected_disk_performance(disk_type, size_gb):
+    """Estimate the performance of a persistent disk.
+
+    Args:
+      disk_type: The type of the disk, e.g. 'pd-ssd'
+      size_gb: The size of the disk in GB
+    Returns:
+      A tuple of the expected read IOPS, write IOPS, read throughput
+      in MB/s, and write throughput in MB/s.
+    """
+    performance = _DISK_PERFORMANCE[disk_type]
+    return tuple(
+        int(min(baseline + per_gb * size_gb, maximum))
+        for baseline, per_gb, maximum in zip(
+            performance['baseline'], performance['per-gb'],
+            performance['max']))
+
+
+def tmp_storage(args):
+    """Get the type of storage to use for the container's `/tmp`.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      One of the supported `--tmp-storage` types.
+    """
+    if args.tmp_storage:
+        return args.tmp_storage
+    if args.local_ssd_count > 0:
+        return 'local-ssd'
+    return 'persistent-disk'
+
+
+def local_ssd_count(args):
+    """Get the number of local SSDs to attach to the instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      The number of local SSDs, which is at least one if swap or `/tmp`
+      are to be put on a local SSD.
+    """
+    count = max(args.local_ssd_count, 0)
+    if (args.swap_mode == 'local-ssd' and not args.no_swap) or (
+            tmp_storage(args) == 'local-ssd'):
+        count = max(count, 1)
+    return count
+
+
+def container_volume_flags(args):
+    """Get the `docker run` flags for the container's scratch storage.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      The flags, joined into a single string.
+    """
+    storage = tmp_storage(args)
+    if storage == 'tmpfs':
+        volume_flags = ['--tmpfs /tmp:rw,exec,mode=1777']
+    elif storage == 'local-ssd':
+        volume_flags = ['-v {}/tmp:/tmp'.format(_DATALAB_SCRATCH_DIR)]
+    else:
+        volume_flags = ['-v {}/tmp:/tmp'.format(_DATALAB_PD_MOUNT_DIR)]
+    if local_ssd_count(args) > 0:
+        volume_flags.append(
+            '-v {}/scratch:/scratch'.format(_DATALAB_SCRATCH_DIR))
+    return ' '.join(volume_flags)
+
+
+def startup_ready_path(args):
+    """Get the path whose existence signals that storage is ready.
+
+    The Datalab service waits for this path to exist before starting
+    the container, so that its volumes are mounted first.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      The path of the directory that backs the container's `/tmp`.
+    """
+    if tmp_storage(args) == 'local-ssd':
+        return _DATALAB_SCRATCH_DIR + '/tmp'
+    return _DATALAB_PD_MOUNT_DIR + '/tmp'
+
+
+def _registry_region(args):
+    if args.image_registry_region != 'auto':
+        return args.image_registry_region
+    area = (args.zone or '').split('-', 1)[0]
+    return _AREA_REGISTRY_REGIONS.get(area, 'global')
+
+
+def regional_image_name(args):
+    """Get the name of the image to run, in the chosen registry.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      The image name, with its gcr.io host replaced by that of the
+      chosen regional registry if there is one. The startup script
+      only pulls from that registry once it finds the image there, and
+      otherwise uses the global registry.
+    """
+    host, _, path = args.image_name.partition('/')
+    if host != _GLOBAL_REGISTRY:
+        return args.image_name
+    if (args.image_registry_region == 'auto' and
+            args.image_name not in _DATALAB_DEFAULT_IMAGES):
+        return args.image_name
+    region = _registry_region(args)
+    if region not in _REGIONAL_REGISTRIES:
+        return args.image_name
+    return _REGIONAL_REGISTRIES[region] + '/' + path
+
+
+def _global_image_name(image_name):
+    host, _, path = image_name.partition('/')
+    if host in _REGIONAL_REGISTRIES.values():
+        return _GLOBAL_REGISTRY + '/' + path
+    return image_name
+
+
+def startup_script(args):
+    """Generate the startup script for a new Datalab instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      The contents of the startup script.
+    """
+    swap_mode = 'none' if args.no_swap else args.swap_mode
+    enable_image_cache = "false" if args.no_image_cache else "true"
+    enable_scratch = "true" if local_ssd_count(args) > 0 else "false"
+    disk_profile = _DISK_PROFILES[args.disk_profile]
+    periodic_trim = "true" if disk_profile['periodic-trim'] else "false"
+    return _DATALAB_STARTUP_SCRIPT.format(
+        args.image_name, _DATALAB_NOTEBOOKS_REPOSITORY, swap_mode,
+        connect.BOOT_PHASE_MARKER, enable_image_cache, args.swap_size,
+        enable_scratch, tmp_storage(args), _DATALAB_SCRATCH_DIR,
+        disk_profile['format-options'], disk_profile['mount-options'],
+        disk_profile['readahead-kb'], periodic_trim,
+        (args.registry_mirror or '').rstrip('/'),
+        _global_image_name(args.image_name), _BAKED_IMAGE_FILE)
+
+
+def bake_startup_script(args, gpu_driver_files=None):
+    """Generate the startup script for a `bake-image` builder instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gpu_driver_files: If the GPU driver should be built into the boot
+        disk, a tuple of the contents of the driver installer's
+        environment file and of its script.
+    Returns:
+      The contents of the startup script.
+    """
+    disk_profile = _DISK_PROFILES[_DEFAULT_DISK_PROFILE]
+    driver_env, driver_script = gpu_driver_files or ('', '')
+    return _DATALAB_BAKE_SCRIPT.format(
+        args.image_name, _DATALAB_NOTEBOOKS_REPOSITORY, 'none',
+        connect.BOOT_PHASE_MARKER, 'false', '0M', 'false',
+        'persistent-disk', _DATALAB_SCRATCH_DIR,
+        disk_profile['format-options'], disk_profile['mount-options'],
+        disk_profile['readahead-kb'], 'false',
+        (args.registry_mirror or '').rstrip('/'),
+        _global_image_name(args.image_name), _BAKED_IMAGE_FILE,
+        'true' if gpu_driver_files else 'false', driver_env, driver_script)
+
+
+def baked_image_description(image_name):
+    """Get the description of a boot image preloaded with a Datalab image.
+
+    Args:
+      image_name: The name of the preloaded Datalab image
+    Returns:
+      The description, from which `preloaded_image_name` recovers the
+      name of the Datalab image.
+    """
+    return _BAKED_IMAGE_DESCRIPTION.format(image_name)
+
+
+def preloaded_image_name(image_json):
+    """Get the name of the Datalab image preloaded on a baked boot image.
+
+    Args:
+      image_json: The decoded boot image resource
+    Returns:
+      The name of the preloaded Datalab image, or None if the boot image
+      was not baked by `bake-image`.
+    """
+    prefix = _BAKED_IMAGE_DESCRIPTION.format('')
+    description = image_json.get('description') or ''
+    if not description.startswith(prefix):
+        return None
+    return description[len(prefix):].strip() or None
+
+
+def boot_image_flags(args, gcloud_compute, default_family):
+    """Get the `instances create` flags for the instance's boot disk.
+
+    If the `--from-baked-image` flag was specified, then the latest image
+    in the baked image family is used, and if it was preloaded with the
+    Datalab image that is to be run, then the name of the image is
+    changed to match the preloaded one, so that it is not pulled again.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      default_family: The baked image family to use if none was named
+    Returns:
+      A list of command line flags.
+    Raises:
+      subprocess.CalledProcessError: If the image family does not exist
+    """
+    if args.baked_image_family is None:
+        return ['--image-family', 'cos-stable', '--image-project', 'cos-cloud']
+    family = args.baked_image_family or default_family
+    get_cmd = ['images', 'describe-from-family', '--format=json', family]
+    with tempfile.TemporaryFile() as stdout:
+        try:
+            gcloud_compute(args, get_cmd, stdout=stdout)
+        except subprocess.CalledProcessError:
+            print('Failed to find a baked image in the family {}. '
+                  'Run `datalab bake-image` to create one.'.format(family))
+            raise
+        stdout.seek(0)
+        image_json = json.loads(stdout.read().decode('utf-8'))
+    preloaded = preloaded_image_name(image_json)
+    if preloaded and (_global_image_name(preloaded) ==
+                      _global_image_name(args.image_name)):
+        args.image_name = preloaded
+    elif preloaded:
+        print('The baked image {} is preloaded with {} rather than {}, '
+              'which will be pulled when the instance boots.'.format(
+                  image_json['name'], preloaded, args.image_name))
+    return ['--image', image_json['name']]
+
+
+def local_ssd_flags(args):
+    """Get the `instances create` flags for the local SSDs to attach.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      A list of command line flags, which is empty if no local SSDs
+      are needed.
+    """
+    flags = []
+    for _ in range(local_ssd_count(args)):
+        flags.extend(['--local-ssd', 'interface=NVME'])
+    return flags
+
+
 def create_network(args, gcloud_compute, network_name):
     """Create the specified network.
 
@@ -480,21 +1716,36 @@ def create_network(args, gcloud_compute, network_name):
     return
 
 
-def ensure_network_exists(args, gcloud_compute, network_name):
-    """Create the specified network if it does not already exist.
+def network_exists(args, gcloud_compute, network_name):
+    """Check whether or not the specified network exists.
 
     Args:
       args: The Namespace returned by argparse
       gcloud_compute: Function that can be used for invoking `gcloud compute`
       network_name: The name of the network
-    Raises:
-      subprocess.CalledProcessError: If the `gcloud` command fails
+    Returns:
+      True iff the network exists.
     """
     get_cmd = ['networks', 'describe', '--format', 'value(name)', network_name]
     try:
         utils.call_gcloud_quietly(
             args, gcloud_compute, get_cmd, report_errors=False)
     except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def ensure_network_exists(args, gcloud_compute, network_name):
+    """Create the specified network if it does not already exist.
+
+    Args:
+      args: The Namespace returned by argparse
+      gcloud_compute: Function that can be used for invoking `gcloud compute`
+      network_name: The name of the network
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` command fails
+    """
+    if not network_exists(args, gcloud_compute, network_name):
         create_network(args, gcloud_compute, network_name)
     return
 
@@ -521,23 +1772,41 @@ def create_firewall_rule(args, gcloud_compute, network_name, rule_name):
     return
 
 
-def has_unexpected_firewall_rules(args, gcloud_compute, network_name):
-    rule_name = _DATALAB_FIREWALL_RULE_TEMPLATE.format(network_name)
+def list_firewall_rules(args, gcloud_compute, network_name):
+    """List the names of the firewall rules for the given network.
+
+    Args:
+      args: The Namespace returned by argparse
+      gcloud_compute: Function that can be used for invoking `gcloud compute`
+      network_name: The name of the network
+    Returns:
+      The list of firewall rule names; this is empty if the network
+      does not exist.
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` command fails
+    """
     list_cmd = [
         'firewall-rules', 'list',
-        '--filter', 'network~.^*{0}$'.format(network_name),
+        '--filter', 'network~\'(^|/){0}$\''.format(network_name),
         '--format', 'value(name)']
     with tempfile.TemporaryFile() as tf:
         gcloud_compute(args, list_cmd, stdout=tf)
         tf.seek(0)
-        matching_rules = tf.read().decode('utf-8').strip()
-        if matching_rules and (matching_rules != rule_name):
-            return True
-    return False
+        return tf.read().decode('utf-8').strip().splitlines()
+
+
+def has_unexpected_firewall_rules(args, gcloud_compute, network_name,
+                                  rule_names=None):
+    rule_name = _DATALAB_FIREWALL_RULE_TEMPLATE.format(network_name)
+    if rule_names is None:
+        rule_names = list_firewall_rules(args, gcloud_compute, network_name)
+    return any(name != rule_name for name in rule_names)
 
 
-def prompt_on_unexpected_firewall_rules(args, gcloud_compute, network_name):
-    if has_unexpected_firewall_rules(args, gcloud_compute, network_name):
+def prompt_on_unexpected_firewall_rules(args, gcloud_compute, network_name,
+                                        rule_names=None):
+    if has_unexpected_firewall_rules(args, gcloud_compute, network_name,
+                                     rule_names=rule_names):
         warning = _DATALAB_UNEXPECTED_FIREWALLS_WARNING_TEMPLATE.format(
             network_name)
         print(warning)
@@ -583,23 +1852,54 @@ def create_disk(args, gcloud_compute, disk_name):
     create_cmd = ['disks', 'create']
     if args.zone:
         create_cmd.extend(['--zone', args.zone])
+    size_gb = args.disk_size_gb
+    if args.from_snapshot:
+        # The disk cannot be smaller than the one that was snapshotted.
+        size_gb = max(size_gb, snapshot_disk_size_gb(
+            args, gcloud_compute, args.from_snapshot))
+        create_cmd.extend(['--source-snapshot', args.from_snapshot])
     create_cmd.extend([
-        '--size', str(args.disk_size_gb) + 'GB',
+        '--size', str(size_gb) + 'GB',
+        '--type', args.disk_type,
         '--description', _DATALAB_DISK_DESCRIPTION,
         disk_name])
     utils.call_gcloud_quietly(args, gcloud_compute, create_cmd)
+    if utils.print_info_messages(args):
+        print(_DISK_PERFORMANCE_MESSAGE.format(
+            size_gb, args.disk_type, disk_name,
+            *expected_disk_performance(args.disk_type, size_gb)))
     return
 
 
-def ensure_disk_exists(args, gcloud_compute, disk_name):
-    """Create the given persistent disk if it does not already exist.
+def snapshot_disk_size_gb(args, gcloud_compute, snapshot):
+    """Get the size of the disk from which the given snapshot was taken.
 
     Args:
       args: The Namespace returned by argparse
       gcloud_compute: Function that can be used for invoking `gcloud compute`
-      disk_name: The name of the persistent disk
+      snapshot: The name of the snapshot
+    Returns:
+      The size of the snapshotted disk in GB.
     Raises:
-      subprocess.CalledProcessError: If the `gcloud` command fails
+      subprocess.CalledProcessError: If the snapshot does not exist
+    """
+    get_cmd = ['snapshots', 'describe', '--format=json', snapshot]
+    with tempfile.TemporaryFile() as stdout:
+        gcloud_compute(args, get_cmd, stdout=stdout)
+        stdout.seek(0)
+        snapshot_json = json.loads(stdout.read().decode('utf-8'))
+    return int(snapshot_json.get('diskSizeGb', 0))
+
+
+def disk_exists(args, gcloud_compute, disk_name):
+    """Check whether or not the given persistent disk exists.
+
+    Args:
+      args: The Namespace returned by argparse
+      gcloud_compute: Function that can be used for invoking `gcloud compute`
+      disk_name: The name of the persistent disk
+    Returns:
+      True iff the disk exists.
     """
     get_cmd = [
         'disks', 'describe', disk_name, '--format', 'value(name)']
@@ -609,6 +1909,21 @@ def ensure_disk_exists(args, gcloud_compute, disk_name):
         utils.call_gcloud_quietly(
             args, gcloud_compute, get_cmd, report_errors=False)
     except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+def ensure_disk_exists(args, gcloud_compute, disk_name):
+    """Create the given persistent disk if it does not already exist.
+
+    Args:
+      args: The Namespace returned by argparse
+      gcloud_compute: Function that can be used for invoking `gcloud compute`
+      disk_name: The name of the persistent disk
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` command fails
+    """
+    if not disk_exists(args, gcloud_compute, disk_name):
         create_disk(args, gcloud_compute, disk_name)
     return
 
@@ -631,14 +1946,16 @@ def create_repo(args, gcloud_repos, repo_name):
     utils.call_gcloud_quietly(args, gcloud_repos, create_cmd)
 
 
-def ensure_repo_exists(args, gcloud_repos, repo_name):
-    """Create the given repository if it does not already exist.
+def repo_exists(args, gcloud_repos, repo_name):
+    """Check whether or not the given repository exists.
 
     Args:
       args: The Namespace returned by argparse
       gcloud_repos: Function that can be used for invoking
         `gcloud source repos`
       repo_name: The name of the repository to check
+    Returns:
+      True iff the repository exists.
     Raises:
       subprocess.CalledProcessError: If the `gcloud` command fails
     """
@@ -649,16 +1966,46 @@ def ensure_repo_exists(args, gcloud_repos, repo_name):
         gcloud_repos(args, list_cmd, stdout=tf)
         tf.seek(0)
         matching_repos = tf.read().decode('utf-8').strip()
-        if not matching_repos:
-            try:
-                create_repo(args, gcloud_repos, repo_name)
-            except Exception:
-                raise RepositoryException(repo_name)
+        return bool(matching_repos)
+
+
+def ensure_repo_exists(args, gcloud_repos, repo_name, exists=None):
+    """Create the given repository if it does not already exist.
+
+    Args:
+      args: The Namespace returned by argparse
+      gcloud_repos: Function that can be used for invoking
+        `gcloud source repos`
+      repo_name: The name of the repository to check
+      exists: Whether or not the repository is already known to exist,
+        or None if that should be checked.
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` command fails
+      RepositoryException: If the repository could not be created
+    """
+    if exists is None:
+        exists = repo_exists(args, gcloud_repos, repo_name)
+    if not exists:
+        try:
+            create_repo(args, gcloud_repos, repo_name)
+        except Exception:
+            raise RepositoryException(repo_name)
 
 
 def prepare(args, gcloud_compute, gcloud_repos):
     """Run preparation steps for VM creation.
 
+    The checks for the network, the firewall rules, the disk, and the
+    repository are independent of each other, so they all run at once.
+    Nothing is created until the user has had the chance to reject a
+    network with unexpected firewall rules, and the SSH firewall rule
+    is only created once its network exists.
+
+    Listing the network's firewall rules also tells us whether the
+    network and the SSH rule already exist, since rules can only exist
+    in an existing network, so in the common case where both do, this
+    saves describing them separately.
+
     Args:
       args: The Namespace instance returned by argparse
       gcloud_compute: Function that can be used to invoke `gcloud compute`
@@ -668,22 +2015,110 @@ def prepare(args, gcloud_compute, gcloud_repos):
       The disk config
     Raises:
       subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      CancelledException: If the user rejects the network
+      DiskExistsException: If the disk to create from a snapshot exists
     """
     network_name = args.network_name
-    ensure_network_exists(args, gcloud_compute, network_name)
-    prompt_on_unexpected_firewall_rules(args, gcloud_compute, network_name)
-    ensure_firewall_rule_exists(args, gcloud_compute, network_name)
-
+    rule_name = _DATALAB_FIREWALL_RULE_TEMPLATE.format(network_name)
     disk_name = args.disk_name or '{0}-pd'.format(args.instance)
-    ensure_disk_exists(args, gcloud_compute, disk_name)
+
+    def check_network(deps):
+        rule_names = deps['firewall-rules']
+        if not rule_names:
+            ensure_network_exists(args, gcloud_compute, network_name)
+
+    def confirm_network(deps):
+        prompt_on_unexpected_firewall_rules(
+            args, gcloud_compute, network_name,
+            rule_names=deps['firewall-rules'])
+
+    def check_firewall_rule(deps):
+        if rule_name not in deps['firewall-rules']:
+            ensure_firewall_rule_exists(args, gcloud_compute, network_name)
+
+    def create_missing_disk(deps):
+        if not deps['disk-exists']:
+            create_disk(args, gcloud_compute, disk_name)
+        elif args.from_snapshot:
+            raise DiskExistsException(disk_name, args.from_snapshot)
+
+    tasks = {
+        'firewall-rules': (
+            lambda unused_deps: list_firewall_rules(
+                args, gcloud_compute, network_name), []),
+        'confirm-network': (confirm_network, ['firewall-rules']),
+        'network': (check_network, ['firewall-rules', 'confirm-network']),
+        'firewall-rule': (
+            check_firewall_rule,
+            ['firewall-rules', 'confirm-network', 'network']),
+        'disk-exists': (
+            lambda unused_deps: disk_exists(
+                args, gcloud_compute, disk_name), []),
+        'disk': (create_missing_disk, ['disk-exists', 'confirm-network']),
+    }
+    if not args.no_create_repository:
+        tasks['repo-exists'] = (
+            lambda unused_deps: repo_exists(
+                args, gcloud_repos, _DATALAB_NOTEBOOKS_REPOSITORY), [])
+        tasks['repo'] = (
+            lambda deps: ensure_repo_exists(
+                args, gcloud_repos, _DATALAB_NOTEBOOKS_REPOSITORY,
+                exists=deps['repo-exists']),
+            ['repo-exists', 'confirm-network'])
+    utils.run_tasks(tasks)
+
     disk_cfg = (
         'auto-delete=no,boot=no,device-name=datalab-pd,mode=rw,name=' +
         disk_name)
+    return disk_cfg
 
-    if not args.no_create_repository:
-        ensure_repo_exists(args, gcloud_repos, _DATALAB_NOTEBOOKS_REPOSITORY)
 
-    return disk_cfg
+def create_instance(args, gcloud_surface, cmd, user_email):
+    """Run the given `instances create` command.
+
+    If the `--async` flag was specified, then this only starts creating
+    the instance, and records the resulting operation so that the `wait`
+    command can wait for it.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_surface: Function that can be used to invoke `gcloud compute`
+      cmd: The `instances create` command to run
+      user_email: The user for whom the instance is being created
+    Returns:
+      True iff the instance has finished being created.
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` call fails
+    """
+    if not args.async_create:
+        gcloud_surface(args, cmd)
+        inventory.record_instance(
+            args, args.instance, args.zone, 'PROVISIONING',
+            for_user=user_email)
+        return True
+
+    async_cmd = [arg for arg in cmd if arg != '--format=none']
+    async_cmd.extend(['--async', '--format=json'])
+    with tempfile.TemporaryFile() as stdout:
+        gcloud_surface(args, async_cmd, stdout=stdout)
+        stdout.seek(0)
+        operations = json.loads(stdout.read().decode('utf-8') or '[]')
+    if isinstance(operations, dict):
+        operations = [operations]
+    for operation in operations:
+        zone = utils.instance_zone(operation) or args.zone
+        inventory.record_instance(
+            args, args.instance, zone, 'PROVISIONING', for_user=user_email)
+        try:
+            wait.record_operation(args, args.instance, operation)
+        except (IOError, OSError) as e:
+            print('Could not record the operation {}: {}'.format(
+                operation.get('name'), e))
+            continue
+        print('Started creating {} with the operation {}'.format(
+            args.instance, operation.get('name')))
+    print('Run `datalab wait` to wait for the instance to be ready.')
+    return False
 
 
 def run(args, gcloud_compute, gcloud_repos,
@@ -709,14 +2144,20 @@ def run(args, gcloud_compute, gcloud_repos,
         args.zone = gcloud_zone
     if (not args.zone) and (not args.quiet):
         args.zone = utils.prompt_for_zone(args, gcloud_compute)
+    resource_flags = container_resource_flags(
+        args, machine_type_resources(args, gcloud_compute))
+    args.image_name = regional_image_name(args)
+    boot_flags = boot_image_flags(
+        args, gcloud_compute, _BAKED_IMAGE_FAMILY)
     disk_cfg = prepare(args, gcloud_compute, gcloud_repos)
 
     print('Creating the instance {0}'.format(args.instance))
     cmd = ['instances', 'create']
     if args.zone:
         cmd.extend(['--zone', args.zone])
+    cmd.extend(local_ssd_flags(args))
+    cmd.extend(boot_flags)
 
-    enable_swap = "false" if args.no_swap else "true"
     enable_backups = "false" if args.no_backups else "true"
     idle_timeout = args.idle_timeout
     console_log_level = args.log_level or "warn"
@@ -739,12 +2180,13 @@ def run(args, gcloud_compute, gcloud_repos,
             tempfile.NamedTemporaryFile(mode='w', delete=False) \
             as datalab_version_file:
         try:
-            startup_script_file.write(_DATALAB_STARTUP_SCRIPT.format(
-                args.image_name, _DATALAB_NOTEBOOKS_REPOSITORY, enable_swap))
+            startup_script_file.write(startup_script(args))
             startup_script_file.close()
             user_data_file.write(_DATALAB_CLOUD_CONFIG.format(
                 args.image_name, enable_backups,
-                console_log_level, escaped_email, initial_user_settings))
+                console_log_level, escaped_email, initial_user_settings,
+                connect.BOOT_PHASE_MARKER, container_volume_flags(args),
+                startup_ready_path(args), resource_flags))
             user_data_file.close()
             for_user_file.write(user_email)
             for_user_file.close()
@@ -773,8 +2215,6 @@ def run(args, gcloud_compute, gcloud_repos,
                 '--format=none',
                 '--boot-disk-size=20GB',
                 '--network', args.network_name,
-                '--image-family', 'cos-stable',
-                '--image-project', 'cos-cloud',
                 '--machine-type', args.machine_type,
                 '--metadata-from-file', metadata_from_file,
                 '--tags', 'datalab',
@@ -782,8 +2222,9 @@ def run(args, gcloud_compute, gcloud_repos,
                 '--service-account', service_account,
                 '--scopes', 'cloud-platform',
                 args.instance])
-            gcloud_compute(args, cmd)
+            created = create_instance(args, gcloud_compute, cmd, user_email)
         finally:
+            utils.invalidate_instance_record(args, args.instance)
             os.remove(startup_script_file.name)
             os.remove(user_data_file.name)
             os.remove(for_user_file.name)
@@ -791,6 +2232,6 @@ def run(args, gcloud_compute, gcloud_repos,
             os.remove(sdk_version_file.name)
             os.remove(datalab_version_file.name)
 
-    if (not args.no_connect) and (not args.for_user):
+    if created and (not args.no_connect) and (not args.for_user):
         connect.connect(args, gcloud_compute, email, in_cloud_shell)
     return
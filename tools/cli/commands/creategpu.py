@@ -20,7 +20,7 @@ import json
 import os
 import tempfile
 
-from . import create, connect, utils
+from . import accelerators, create, connect, utils
 
 
 description = ("""`{0} {1}` creates a new Datalab instance running in a Google
@@ -35,7 +35,83 @@ created instance. You can disable that behavior by passing in the
 _THIRD_PARTY_SOFTWARE_DIALOG = (
     """By accepting below, you will download and install the
 following third-party software onto your managed GCE instances:
-    NVidia GPU Driver: NVIDIA-Linux-x86_64-390.46""")
+    NVidia GPU Driver: NVIDIA-Linux-x86_64-{0}""")
+
+# Where builds of the GPU driver are kept on the persistent disk, so
+# that they can be reused by a recreated instance.
+_GPU_DRIVER_CACHE_DIR = '/mnt/disks/datalab-pd/gpu-driver-cache'
+
+# The environment of the GPU driver installer, and the script that
+# runs it, which are formatted with the driver version and with the
+# directory in which to cache driver builds, respectively. These are
+# written by both the cloud config and the `bake-image` startup script.
+_NVIDIA_INSTALLER_ENV = """NVIDIA_DRIVER_VERSION={0}
+COS_NVIDIA_INSTALLER_CONTAINER=gcr.io/cos-cloud/cos-gpu-installer:latest
+NVIDIA_INSTALL_DIR_HOST=/var/lib/nvidia
+NVIDIA_INSTALL_DIR_CONTAINER=/usr/local/nvidia
+ROOT_MOUNT_DIR=/root
+"""
+
+_GPU_DRIVER_INSTALL_SCRIPT = """#!/bin/bash
+# Install the NVIDIA driver. Building it takes minutes, so a build
+# for the running kernel and requested driver version is reused if
+# one is found on either the boot disk or the persistent disk.
+source /etc/nvidia-installer-env
+start_time=`date +%s`
+cache_key="$(uname -r)-${{NVIDIA_DRIVER_VERSION}}"
+cache_root="{0}"
+cache_dir="${{cache_root}}/${{cache_key}}"
+stamp="${{NVIDIA_INSTALL_DIR_HOST}}/.datalab-driver-key"
+
+load_driver() {{
+  drivers="${{NVIDIA_INSTALL_DIR_HOST}}/drivers"
+  bin="${{NVIDIA_INSTALL_DIR_HOST}}/bin"
+  if ! grep -q "^nvidia " /proc/modules; then
+    insmod "${{drivers}}/nvidia.ko" || return 1
+  fi
+  if ! grep -q "^nvidia_uvm " /proc/modules; then
+    insmod "${{drivers}}/nvidia-uvm.ko" || return 1
+  fi
+  # Create the device files that the container expects.
+  "${{bin}}/nvidia-smi" && "${{bin}}/nvidia-modprobe" -c0 -u
+}}
+
+save_driver() {{
+  if [ -z "${{cache_root}}" ]; then
+    return
+  fi
+  rm -rf "${{cache_root}}"
+  mkdir -p "${{cache_root}}"
+  if cp -a "${{NVIDIA_INSTALL_DIR_HOST}}/." "${{cache_dir}}.partial"; then
+    mv "${{cache_dir}}.partial" "${{cache_dir}}"
+  else
+    rm -rf "${{cache_root}}"
+  fi
+}}
+
+if [ "$(cat ${{stamp}} 2>/dev/null)" == "${{cache_key}}" ] && \
+    load_driver; then
+  source="the boot disk cache"
+elif [ -d "${{cache_dir}}" ] && \
+    cp -a "${{cache_dir}}/." "${{NVIDIA_INSTALL_DIR_HOST}}/" && \
+    load_driver; then
+  source="the persistent disk cache"
+else
+  source="a fresh build"
+  rm -f "${{stamp}}"
+  /usr/bin/docker run --privileged --net=host --pid=host \
+    --volume \
+    "${{NVIDIA_INSTALL_DIR_HOST}}":"${{NVIDIA_INSTALL_DIR_CONTAINER}}" \
+    --volume /dev:/dev --volume "/":"${{ROOT_MOUNT_DIR}}" \
+    --env-file /etc/nvidia-installer-env \
+    "${{COS_NVIDIA_INSTALLER_CONTAINER}}" || exit 1
+  save_driver
+fi
+echo "${{cache_key}}" > "${{stamp}}"
+end_time=`date +%s`
+echo "Installed the GPU driver ${{cache_key}} from ${{source}}" \
+  "in `expr ${{end_time}} - ${{start_time}}` seconds"
+"""
 
 # The config for the 'cos-gpu-installer.service'
 # services comes from the 'GoogleCloudPlatform/cos-gpu-installer' project
@@ -67,7 +143,7 @@ write_files:
     Type=oneshot
     RemainAfterExit=true
     ExecStartPre=docker-credential-gcr configure-docker
-    ExecStart=/bin/bash -c 'while [ ! -e /mnt/disks/datalab-pd/tmp ]; do \
+    ExecStart=/bin/bash -c 'while [ ! -e {8} ]; do \
         sleep 1; \
         done'
 
@@ -75,12 +151,12 @@ write_files:
   permissions: 0755
   owner: root
   content: |
-    NVIDIA_DRIVER_VERSION=390.46
-    COS_NVIDIA_INSTALLER_CONTAINER=gcr.io/cos-cloud/cos-gpu-installer:latest
-    NVIDIA_INSTALL_DIR_HOST=/var/lib/nvidia
-    NVIDIA_INSTALL_DIR_CONTAINER=/usr/local/nvidia
-    ROOT_MOUNT_DIR=/root
-
+{9}
+- path: /etc/datalab/install-gpu-driver.sh
+  permissions: 0755
+  owner: root
+  content: |
+{10}
 - path: /etc/systemd/system/cos-gpu-installer.service
   permissions: 0755
   owner: root
@@ -102,12 +178,7 @@ write_files:
         mount --bind "${{NVIDIA_INSTALL_DIR_HOST}}" \
         "${{NVIDIA_INSTALL_DIR_HOST}}" && \
         mount -o remount,exec "${{NVIDIA_INSTALL_DIR_HOST}}"'
-    ExecStart=/usr/bin/docker run --privileged --net=host --pid=host \
-        --volume \
-        "${{NVIDIA_INSTALL_DIR_HOST}}":"${{NVIDIA_INSTALL_DIR_CONTAINER}}" \
-        --volume /dev:/dev --volume "/":"${{ROOT_MOUNT_DIR}}" \
-        --env-file /etc/nvidia-installer-env \
-        "${{COS_NVIDIA_INSTALLER_CONTAINER}}"
+    ExecStart=/bin/bash /etc/datalab/install-gpu-driver.sh
     StandardOutput=journal+console
     StandardError=journal+console
 
@@ -125,10 +196,13 @@ write_files:
     [Service]
     Environment="HOME=/home/datalab"
     ExecStartPre=docker-credential-gcr configure-docker
+    ExecStartPre=/bin/bash -c 'echo "{6} container-start $(date +%%s)" \
+        > /dev/ttyS0 || true'
     ExecStart=/usr/bin/docker run --restart always \
        -p '127.0.0.1:8080:8080' \
        -v /mnt/disks/datalab-pd/content:/content \
-       -v /mnt/disks/datalab-pd/tmp:/tmp \
+       {7} \
+       {11} \
        --volume /var/lib/nvidia:/usr/local/nvidia \
        {5} \
        --device /dev/nvidia-uvm:/dev/nvidia-uvm \
@@ -178,6 +252,26 @@ runcmd:
 """
 
 
+def _indent(contents):
+    return ''.join('    ' + line if line.strip() else line
+                   for line in contents.splitlines(True))
+
+
+def gpu_driver_files(driver_version, cache_dir):
+    """Generate the files that install the GPU driver.
+
+    Args:
+      driver_version: The version of the NVIDIA driver to install
+      cache_dir: The directory in which to keep a copy of the driver
+        build, or an empty string to not keep one
+    Returns:
+      A tuple of the contents of the driver installer's environment
+      file and of the script that runs the installer.
+    """
+    return (_NVIDIA_INSTALLER_ENV.format(driver_version),
+            _GPU_DRIVER_INSTALL_SCRIPT.format(cache_dir))
+
+
 def flags(parser):
     """Add command line flags for the `create` subcommand.
 
@@ -185,23 +279,23 @@ def flags(parser):
       parser: The argparse parser to which to add the flags.
     """
     create.flags(parser)
-    parser.set_defaults(image_name='gcr.io/cloud-datalab/datalab-gpu:latest')
+    parser.set_defaults(image_name=create._DATALAB_GPU_IMAGE)
 
     parser.add_argument(
         '--accelerator-type',
         dest='accelerator_type',
+        choices=sorted(accelerators.SUPPORTED_ACCELERATORS),
         default='nvidia-tesla-k80',
         help=(
             'the accelerator type of the instance.'
             '\n\n'
-            'Datalab currently only supports nvidia-tesla-k80.'
-            '\n\n'
-            'If not specified, the default type is none.'))
+            'If not specified, the default type is nvidia-tesla-k80.'))
 
     parser.add_argument(
         '--accelerator-count',
         dest='accelerator_count',
         type=int,
+        choices=accelerators.VALID_ACCELERATOR_COUNTS,
         default=1,
         help=(
             'the accelerator count of the instance, used if '
@@ -229,10 +323,13 @@ def run(args, gcloud_beta_compute, gcloud_repos,
       datalab_version: The version of the datalab CLI being used
     Raises:
       subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      accelerators.UnavailableAcceleratorException: If the zone does not
+        offer the requested accelerators
     """
+    driver_version = accelerators.driver_version(args.accelerator_type)
     if not utils.prompt_for_confirmation(
             args=args,
-            message=_THIRD_PARTY_SOFTWARE_DIALOG,
+            message=_THIRD_PARTY_SOFTWARE_DIALOG.format(driver_version),
             question='Do you accept',
             accept_by_default=False):
         print('Installation not accepted; Exiting.')
@@ -242,17 +339,28 @@ def run(args, gcloud_beta_compute, gcloud_repos,
         args.zone = gcloud_zone
     if (not args.zone) and (not args.quiet):
         args.zone = utils.prompt_for_zone(args, gcloud_beta_compute)
+    accelerators.check_availability(
+        args, gcloud_beta_compute, args.accelerator_type,
+        args.accelerator_count)
+    resource_flags = create.container_resource_flags(
+        args, create.machine_type_resources(args, gcloud_beta_compute))
+    args.image_name = create.regional_image_name(args)
+    boot_flags = create.boot_image_flags(
+        args, gcloud_beta_compute, create._BAKED_GPU_IMAGE_FAMILY)
     disk_cfg = create.prepare(args, gcloud_beta_compute, gcloud_repos)
 
     print('Creating the instance {0}'.format(args.instance))
     print('\n\nDue to GPU Driver installation, please note that '
-          'Datalab GPU instances take significantly longer to '
-          'startup compared to non-GPU instances.')
+          'the first startup of a Datalab GPU instance takes '
+          'significantly longer than that of a non-GPU instance. '
+          'Later startups reuse the installed driver until the '
+          'instance\'s kernel is updated.')
     cmd = ['instances', 'create']
     if args.zone:
         cmd.extend(['--zone', args.zone])
+    cmd.extend(create.local_ssd_flags(args))
+    cmd.extend(boot_flags)
 
-    enable_swap = "false" if args.no_swap else "true"
     enable_backups = "false" if args.no_backups else "true"
     idle_timeout = args.idle_timeout
     console_log_level = args.log_level or "warn"
@@ -263,6 +371,8 @@ def run(args, gcloud_beta_compute, gcloud_repos,
     for i in range(min(args.accelerator_count, 32)):
         device_mapping += (" --device /dev/nvidia" + str(i) +
                            ":/dev/nvidia" + str(i) + " ")
+    driver_env, driver_script = gpu_driver_files(
+        driver_version, _GPU_DRIVER_CACHE_DIR)
     # We have to escape the user's email before using it in the YAML template.
     escaped_email = user_email.replace("'", "''")
     initial_user_settings = json.dumps({"idleTimeoutInterval": idle_timeout}) \
@@ -280,14 +390,15 @@ def run(args, gcloud_beta_compute, gcloud_repos,
             tempfile.NamedTemporaryFile(mode='w', delete=False) \
             as datalab_version_file:
         try:
-            startup_script_file.write(create._DATALAB_STARTUP_SCRIPT.format(
-                args.image_name, create._DATALAB_NOTEBOOKS_REPOSITORY,
-                enable_swap))
+            startup_script_file.write(create.startup_script(args))
             startup_script_file.close()
             user_data_file.write(_DATALAB_CLOUD_CONFIG.format(
                 args.image_name, enable_backups,
                 console_log_level, escaped_email, initial_user_settings,
-                device_mapping))
+                device_mapping, connect.BOOT_PHASE_MARKER,
+                create.container_volume_flags(args),
+                create.startup_ready_path(args), _indent(driver_env),
+                _indent(driver_script), resource_flags))
             user_data_file.close()
             for_user_file.write(user_email)
             for_user_file.close()
@@ -316,8 +427,6 @@ def run(args, gcloud_beta_compute, gcloud_repos,
                 '--format=none',
                 '--boot-disk-size=20GB',
                 '--network', args.network_name,
-                '--image-family', 'cos-stable',
-                '--image-project', 'cos-cloud',
                 '--machine-type', args.machine_type,
                 '--accelerator',
                 'type=' + args.accelerator_type + ',count='
@@ -329,8 +438,10 @@ def run(args, gcloud_beta_compute, gcloud_repos,
                 '--service-account', service_account,
                 '--scopes', 'cloud-platform',
                 args.instance])
-            gcloud_beta_compute(args, cmd)
+            created = create.create_instance(
+                args, gcloud_beta_compute, cmd, user_email)
         finally:
+            utils.invalidate_instance_record(args, args.instance)
             os.remove(startup_script_file.name)
             os.remove(user_data_file.name)
             os.remove(for_user_file.name)
@@ -338,6 +449,6 @@ def run(args, gcloud_beta_compute, gcloud_repos,
             os.remove(sdk_version_file.name)
             os.remove(datalab_version_file.name)
 
-    if (not args.no_connect) and (not args.for_user):
+    if created and (not args.no_connect) and (not args.for_user):
         connect.connect(args, gcloud_beta_compute, email, in_cloud_shell)
     return
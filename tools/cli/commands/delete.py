@@ -16,11 +16,15 @@
 
 from __future__ import absolute_import
 
-from . import utils
+from . import inventory, utils
 
 
-description = ("""`{0} {1}` deletes the given Datalab instance's
-Google Compute Engine VM.
+description = ("""`{0} {1}` deletes the given Datalab instances'
+Google Compute Engine VMs.
+
+Instances can be selected by name, by shell-style patterns such as
+`alice-*`, or with a `list`-style filter. All of the selected instances
+are deleted concurrently, after a single confirmation.
 
 By default, the persistent disk's auto-delete configuration determines
 whether or not that disk is also deleted.
@@ -33,6 +37,21 @@ https://cloud.google.com/compute/docs/disks/persistent-disks#updateautodelete
 """)
 
 
+examples = ("""
+To delete the instance 'my-instance', keeping its notebooks disk:
+
+    $ {0} {1} --keep-disk my-instance
+
+To delete every instance whose name starts with 'team-':
+
+    $ {0} {1} 'team-*'
+
+To delete every stopped instance in the project:
+
+    $ {0} {1} --filter 'status=TERMINATED'
+""")
+
+
 _DELETE_DISK_HELP = ("""Whether or not to delete the instance's persistent disk
 regardless of the disks' auto-delete configuration.""")
 
@@ -41,6 +60,10 @@ _KEEP_DISK_HELP = ("""Whether or not to keep the instance's persistent disk
 regardless of the disks' auto-delete configuration.""")
 
 
+_FILTER_HELP = ("""Delete every Datalab instance that matches the given
+filter EXPRESSION, as accepted by the `list` command.""")
+
+
 _DELETE_BASE_PROMPT = ("""The following instance will be deleted:
  - [{}] in [{}]
 
@@ -48,6 +71,14 @@ The corresponding notebooks disk {}.
 """)
 
 
+_DELETE_MULTIPLE_PROMPT = ("""The following instances will be deleted:
+{}
+""")
+
+
+_DELETE_TARGET = ' - [{}] in [{}]: the notebooks disk {}'
+
+
 def flags(parser):
     """Add command line flags for the `delete` subcommand.
 
@@ -55,9 +86,15 @@ def flags(parser):
       parser: The argparse parser to which to add the flags.
     """
     parser.add_argument(
-        'instance',
+        'instances',
         metavar='NAME',
-        help='name of the instance to delete')
+        nargs='*',
+        help='names of, or patterns matching, the instances to delete')
+    parser.add_argument(
+        '--filter',
+        dest='filter',
+        default=None,
+        help=_FILTER_HELP)
 
     auto_delete_override = parser.add_mutually_exclusive_group()
     auto_delete_override.add_argument(
@@ -73,43 +110,58 @@ def flags(parser):
     return
 
 
-def run(args, gcloud_compute, gcloud_zone=None, **unused_kwargs):
+def _notebooks_disk_fate(args, instance_json):
+    """Describe what will happen to the notebooks disk of an instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      instance_json: The decoded instance resource
+    Returns:
+      A phrase describing the fate of the disk.
+    """
+    if args.delete_disk:
+        return 'will be deleted'
+    elif args.keep_disk:
+        return 'will not be deleted'
+    disk_cfg = utils.notebook_disk_config(instance_json)
+    if not disk_cfg:
+        return 'is not attached'
+    elif disk_cfg['autoDelete']:
+        return 'will be deleted'
+    return 'will not be deleted'
+
+
+def run(args, gcloud_compute, **unused_kwargs):
     """Implementation of the `datalab delete` subcommand.
 
     Args:
       args: The Namespace instance returned by argparse
       gcloud_compute: Function that can be used to invoke `gcloud compute`
-      gcloud_zone: The zone that gcloud is configured to use
     Raises:
       subprocess.CalledProcessError: If a nested `gcloud` calls fails
     """
-    instance = args.instance
-    utils.maybe_prompt_for_zone(args, gcloud_compute, instance)
+    instances = utils.resolve_instances(
+        args, gcloud_compute, args.instances, args.filter)
+    if not instances:
+        print('No matching instances found.')
+        return
 
     base_cmd = ['instances', 'delete', '--quiet']
-    if args.zone:
-        base_cmd.extend(['--zone', args.zone])
-        instance_zone = args.zone
-    else:
-        instance_zone = gcloud_zone
-
     if args.delete_disk:
         base_cmd.extend(['--delete-disks', 'data'])
-        notebooks_disk_message_part = 'will be deleted'
     elif args.keep_disk:
         base_cmd.extend(['--keep-disks', 'data'])
-        notebooks_disk_message_part = 'will not be deleted'
+
+    if len(instances) == 1:
+        message = _DELETE_BASE_PROMPT.format(
+            instances[0]['name'], utils.instance_zone(instances[0]),
+            _notebooks_disk_fate(args, instances[0]))
     else:
-        disk_cfg = utils.instance_notebook_disk(args, gcloud_compute, instance)
-        if not disk_cfg:
-            notebooks_disk_message_part = 'is not attached'
-        elif disk_cfg['autoDelete']:
-            notebooks_disk_message_part = 'will be deleted'
-        else:
-            notebooks_disk_message_part = 'will not be deleted'
-
-    message = _DELETE_BASE_PROMPT.format(
-        instance, instance_zone, notebooks_disk_message_part)
+        message = _DELETE_MULTIPLE_PROMPT.format('\n'.join(
+            _DELETE_TARGET.format(
+                instance_json['name'], utils.instance_zone(instance_json),
+                _notebooks_disk_fate(args, instance_json))
+            for instance_json in instances))
     if not utils.prompt_for_confirmation(
             args=args,
             message=message,
@@ -117,6 +169,9 @@ def run(args, gcloud_compute, gcloud_zone=None, **unused_kwargs):
         print('Deletion aborted by user; Exiting.')
         return
 
-    print('Deleting {0}'.format(instance))
-    gcloud_compute(args, base_cmd + [instance])
+    print('Deleting {0}'.format(
+        ', '.join(instance_json['name'] for instance_json in instances)))
+    utils.run_on_instances(
+        args, gcloud_compute, base_cmd, instances,
+        on_success=inventory.remove_instance)
     return
@@ -0,0 +1,181 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent, per-user inventory of known Datalab instances.
+
+The inventory records the zone, status, and user of every instance that
+this tool has created, listed, or described, so that the zone of a known
+instance can be resolved without listing instances across all zones.
+
+Entries are only hints: callers must be prepared for an instance to have
+been deleted or recreated elsewhere since it was recorded.
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+
+from . import localstate
+
+
+_INVENTORY_FILE = 'inventory.json'
+
+# Entries older than this are not used to resolve zones.
+_MAX_ENTRY_AGE_SECONDS = 7 * 24 * 60 * 60
+
+
+def _inventory_path():
+    return os.path.join(localstate.datalab_config_dir(), _INVENTORY_FILE)
+
+
+def _basename(value):
+    return (value or '').rstrip('/').rsplit('/', 1)[-1]
+
+
+def project_key(args):
+    """Get the project under which the args' instances are recorded.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      The explicitly specified project, or else the default project.
+    """
+    return args.project or getattr(args, 'gcloud_project', None) or ''
+
+
+def _update(update_fn):
+    """Apply the given function to the stored inventory.
+
+    Failures to read or write the inventory are ignored, since it is
+    only used as a cache.
+    """
+    try:
+        localstate.update_json_file(_inventory_path(), update_fn)
+    except (IOError, OSError):
+        pass
+
+
+def _entry(instance_json):
+    for_user = ''
+    for item in instance_json.get('metadata', {}).get('items', []):
+        if item.get('key') == 'for-user':
+            for_user = item.get('value', '')
+    return {
+        'zone': _basename(instance_json.get('zone')),
+        'status': instance_json.get('status', 'UNKNOWN'),
+        'for-user': for_user,
+        'updated': time.time(),
+    }
+
+
+def record_instance(args, name, zone, status, for_user=None):
+    """Record the zone and status of the given instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      name: The name of the instance
+      zone: The zone of the instance
+      status: The status of the instance
+      for_user: The user for whom the instance was created, if known
+    """
+    if not zone:
+        return
+
+    def update(contents):
+        instances = contents.setdefault(project_key(args), {})
+        entry = instances.get(name, {})
+        if entry.get('zone') != zone:
+            entry = {}
+        entry.update({'zone': zone, 'status': status, 'updated': time.time()})
+        if for_user is not None:
+            entry['for-user'] = for_user
+        instances[name] = entry
+
+    _update(update)
+
+
+def record_described_instance(args, instance_json):
+    """Record an instance from the result of `instances describe`.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      instance_json: The decoded instance resource
+    """
+    name = instance_json.get('name')
+    if not name or not instance_json.get('zone'):
+        return
+
+    def update(contents):
+        contents.setdefault(project_key(args), {})[name] = _entry(
+            instance_json)
+
+    _update(update)
+
+
+def record_listed_instances(args, instances, complete=False):
+    """Record the instances returned by `instances list`.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      instances: The list of decoded instance resources
+      complete: Whether the list includes every Datalab instance in the
+        project, in which case any other recorded instances are removed.
+    """
+    def update(contents):
+        project = project_key(args)
+        recorded = {} if complete else contents.get(project, {})
+        for instance_json in instances:
+            if instance_json.get('name') and instance_json.get('zone'):
+                recorded[instance_json['name']] = _entry(instance_json)
+        contents[project] = recorded
+
+    _update(update)
+
+
+def remove_instance(args, name):
+    """Remove the given instance from the inventory.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      name: The name of the instance
+    """
+    def update(contents):
+        contents.get(project_key(args), {}).pop(name, None)
+
+    _update(update)
+
+
+def lookup_zone(args, name):
+    """Look up the zone of the given instance in the inventory.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      name: The name of the instance
+    Returns:
+      The recorded zone, or None if the instance is not recorded or its
+      entry is too old to be trusted.
+    """
+    try:
+        contents = localstate.read_json_file(_inventory_path(), default={})
+    except (IOError, OSError):
+        return None
+    if not isinstance(contents, dict):
+        return None
+    entry = contents.get(project_key(args), {}).get(name)
+    if not entry:
+        return None
+    if time.time() - entry.get('updated', 0) > _MAX_ENTRY_AGE_SECONDS:
+        return None
+    return entry.get('zone') or None
@@ -14,6 +14,12 @@
 
 """Methods for implementing the `datalab list` command."""
 
+from __future__ import absolute_import
+
+import sys
+
+from . import inventory, utils
+
 
 _FILTER_HELP = ("""Apply a Boolean filter EXPRESSION to each resource item
 to be listed.
@@ -76,16 +82,10 @@ def _filter(args):
     Returns:
       A string suitable for passing to the `gcloud` command
     """
-    filter_expr = 'tags.items=\'{0}\''.format('datalab')
     zones = args.zones or []
     if args.zone:
         zones.append(args.zone)
-    if zones:
-        zones_filter = "zone:({0})".format(" ".join(zones))
-        filter_expr = '({0}) ({1})'.format(filter_expr, zones_filter)
-    if args.filter:
-        filter_expr = '({0}) ({1})'.format(filter_expr, args.filter)
-    return filter_expr
+    return utils.instances_filter(zones, args.filter)
 
 
 def run(args, gcloud_compute, **unused_kwargs):
@@ -97,6 +97,53 @@ def run(args, gcloud_compute, **unused_kwargs):
     Raises:
       subprocess.CalledProcessError: If a nested `gcloud` calls fails
     """
-    filter_expr = _filter(args)
-    base_cmd = ['instances', 'list']
-    gcloud_compute(args, base_cmd + ['--filter', filter_expr])
+    complete = not (args.filter or args.zones or args.zone)
+    instances = utils.list_instances(args, gcloud_compute, _filter(args))
+
+    # Every Datalab instance in the project is listed unless the results
+    # were narrowed down, in which case only the listed ones are updated.
+    inventory.record_listed_instances(args, instances, complete=complete)
+    _print_instances(instances)
+
+
+def _basename(value):
+    return (value or '').rstrip('/').rsplit('/', 1)[-1]
+
+
+def _instance_row(instance):
+    internal_ips = []
+    external_ips = []
+    for interface in instance.get('networkInterfaces', []):
+        if interface.get('networkIP'):
+            internal_ips.append(interface['networkIP'])
+        for access_config in interface.get('accessConfigs', []):
+            if access_config.get('natIP'):
+                external_ips.append(access_config['natIP'])
+    preemptible = instance.get('scheduling', {}).get('preemptible')
+    return [
+        instance.get('name', ''),
+        _basename(instance.get('zone')),
+        _basename(instance.get('machineType')),
+        'true' if preemptible else '',
+        ','.join(internal_ips),
+        ','.join(external_ips),
+        instance.get('status', ''),
+    ]
+
+
+def _print_instances(instances):
+    """Print the given instances in the same table layout as gcloud.
+
+    Args:
+      instances: The list of decoded instance resources
+    """
+    if not instances:
+        sys.stderr.write('Listed 0 items.\n')
+        return
+    rows = [['NAME', 'ZONE', 'MACHINE_TYPE', 'PREEMPTIBLE', 'INTERNAL_IP',
+             'EXTERNAL_IP', 'STATUS']]
+    rows.extend(_instance_row(instance) for instance in instances)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(
+            value.ljust(width) for value, width in zip(row, widths)).rstrip())
@@ -0,0 +1,120 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Location and storage of the CLI's per-user local state."""
+
+from __future__ import absolute_import
+
+import json
+import os
+import tempfile
+import threading
+
+
+# Serializes the read-modify-write cycles of `update_json_file`.
+_update_lock = threading.Lock()
+
+
+def datalab_config_dir():
+    """Get the per-user directory in which the CLI keeps its local state.
+
+    This defaults to a `datalab` directory next to the one used by gcloud,
+    but can be overridden with the DATALAB_CONFIG_DIR environment variable.
+    The directory is created if it does not already exist.
+
+    Returns:
+      The path of the directory.
+    """
+    config_dir = os.environ.get('DATALAB_CONFIG_DIR')
+    if not config_dir:
+        if os.name == 'nt' and os.environ.get('APPDATA'):
+            base_dir = os.environ['APPDATA']
+        else:
+            base_dir = os.path.join(os.path.expanduser('~'), '.config')
+        config_dir = os.path.join(base_dir, 'datalab')
+    if not os.path.isdir(config_dir):
+        try:
+            os.makedirs(config_dir)
+        except OSError:
+            # Another invocation may have created it concurrently.
+            if not os.path.isdir(config_dir):
+                raise
+    return config_dir
+
+
+def write_json_file(path, contents):
+    """Atomically replace the given file with the JSON encoding of `contents`.
+
+    The contents are first written to a temporary file in the same
+    directory, so that concurrent invocations of the CLI never observe
+    a partially written file.
+
+    Args:
+      path: The path of the file to write.
+      contents: A JSON-serializable object.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(contents, tmp_file, indent=2, sort_keys=True)
+        try:
+            os.replace(tmp_path, path)
+        except AttributeError:
+            # Python 2 has no os.replace, and os.rename will not
+            # overwrite an existing file on Windows.
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_json_file(path, default=None):
+    """Read the JSON contents of the given file.
+
+    Args:
+      path: The path of the file to read.
+      default: The value to return if the file is missing or malformed.
+    Returns:
+      The decoded contents of the file, or `default`.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def update_json_file(path, update_fn):
+    """Apply the given function to the JSON dictionary stored in a file.
+
+    A missing or malformed file is treated as an empty dictionary.
+
+    Args:
+      path: The path of the file to update.
+      update_fn: A function that takes the decoded dictionary and
+        modifies it in place.
+    Raises:
+      IOError: If the updated file cannot be written.
+      OSError: If the updated file cannot be written.
+    """
+    with _update_lock:
+        contents = read_json_file(path, default={})
+        if not isinstance(contents, dict):
+            contents = {}
+        update_fn(contents)
+        write_json_file(path, contents)
@@ -0,0 +1,129 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab port-forward` command."""
+
+from __future__ import absolute_import
+
+from . import connect, tunnel, utils
+
+
+description = ("""`{0} {1}` adds port forwards to, or removes them from,
+a running connection to a Datalab instance.
+
+The connection may be held either by `{0} connect` or by the background
+tunnel agent. The forwards share its SSH connection, so no new SSH
+session is started, and they are restored whenever the connection is
+re-established, until they are removed or the connection is closed.
+
+Each port is given either as PORT, to forward a local port to the same
+port on the instance, or as LOCAL_PORT:REMOTE_PORT.
+
+This is not supported on Windows.""")
+
+
+examples = ("""
+To reach TensorBoard and a Dask dashboard running on 'my-instance':
+
+    $ {0} {1} my-instance 6006 8787
+
+To reach port 4040 of the instance on local port 14040:
+
+    $ {0} {1} my-instance 14040:4040
+
+To remove the forward again:
+
+    $ {0} {1} --remove my-instance 14040:4040
+""")
+
+
+class NoConnectionException(Exception):
+
+    _MESSAGE = ('There is no running connection to {0}; start one with '
+                '`datalab connect {0}` first.')
+
+    def __init__(self, instance):
+        super(NoConnectionException, self).__init__(
+            NoConnectionException._MESSAGE.format(instance))
+
+
+class RemoveForwardFailedException(Exception):
+
+    _MESSAGE = ('Could not stop forwarding local port {1} to port {2} of '
+                '{0}; the port may not be forwarded')
+
+    def __init__(self, instance, local_port, remote_port):
+        super(RemoveForwardFailedException, self).__init__(
+            RemoveForwardFailedException._MESSAGE.format(
+                instance, local_port, remote_port))
+
+
+def flags(parser):
+    """Add command line flags for the `port-forward` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        'instance',
+        metavar='NAME',
+        help='name of the instance with a running connection')
+    parser.add_argument(
+        'forwards',
+        metavar='PORT',
+        nargs='+',
+        type=connect.forward,
+        help='port, or LOCAL_PORT:REMOTE_PORT, to forward')
+    parser.add_argument(
+        '--remove',
+        dest='remove',
+        action='store_true',
+        default=False,
+        help='remove the given forwards rather than adding them')
+    return
+
+
+def run(args, gcloud_compute, **unused_kwargs):
+    """Implementation of the `datalab port-forward` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      NoConnectionException: If there is no running connection to the
+        instance
+      tunnel.ForwardFailedException: If a forward could not be added
+      RemoveForwardFailedException: If a forward could not be removed
+    """
+    if not tunnel.multiplexing_supported():
+        raise NoConnectionException(args.instance)
+    # This resolves the zone, which identifies the connection.
+    utils.get_instance_record(args, gcloud_compute, args.instance)
+    ssh_tunnel = tunnel.Tunnel(args, gcloud_compute, args.instance, [])
+    if not ssh_tunnel.master_alive():
+        raise NoConnectionException(args.instance)
+    for local_port, remote_port in args.forwards:
+        if args.remove:
+            if not ssh_tunnel.remove_forward(local_port, remote_port):
+                raise RemoveForwardFailedException(
+                    args.instance, local_port, remote_port)
+            print('Stopped forwarding local port {0}'.format(local_port))
+        elif ssh_tunnel.add_forward(local_port, remote_port):
+            print('Forwarding local port {0} to port {1} of {2}'.format(
+                local_port, remote_port, args.instance))
+        else:
+            raise tunnel.ForwardFailedException(
+                args.instance, local_port, remote_port)
+    return
@@ -0,0 +1,261 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab resize` command."""
+
+from __future__ import absolute_import
+
+import json
+import tempfile
+import time
+
+from . import connect, inventory, stop, utils
+
+
+description = ("""`{0} {1}` changes the machine type of a Datalab instance,
+the size of its notebooks disk, or both.
+
+The instance is stopped, and its machine type changed, while the disk is
+grown at the same time. The instance is then started, and its startup
+script grows the file system on the disk to fill it, before this
+reconnects to it. The time taken by each step is reported.
+
+Disks can only be grown, not shrunk. The contents of any local SSDs
+attached to the instance are discarded when it is stopped.
+
+Instances created by an earlier version of this tool do not grow the
+file system when they start; run `sudo resize2fs
+/dev/disk/by-id/google-datalab-pd` on such an instance instead.""")
+
+
+examples = ("""
+To move the instance 'my-instance' to a larger machine type:
+
+    $ {0} {1} my-instance --machine-type n1-highmem-8
+
+To also grow its notebooks disk to 500GB:
+
+    $ {0} {1} my-instance --machine-type n1-highmem-8 --disk-size-gb 500
+""")
+
+
+_RESIZE_PROMPT = ("""The following changes will be made:
+{}
+""")
+
+_STEP_DESCRIPTIONS = {
+    'stop': 'stop the instance [{0}]',
+    'resize-disk': 'grow the disk [{1}] from {2}GB to {3}GB',
+    'set-machine-type': 'change the machine type of [{0}] from {4} to {5}',
+    'start': 'start the instance [{0}]',
+}
+
+# The order in which the steps are reported.
+_STEPS = ['stop', 'resize-disk', 'set-machine-type', 'start']
+
+
+class NoResizeSpecifiedException(Exception):
+
+    _MESSAGE = 'Specify a new --machine-type, --disk-size-gb, or both.'
+
+    def __init__(self):
+        super(NoResizeSpecifiedException, self).__init__(
+            NoResizeSpecifiedException._MESSAGE)
+
+
+class DiskShrinkException(Exception):
+
+    _MESSAGE = 'The disk {} is {}GB, and cannot be shrunk to {}GB.'
+
+    def __init__(self, disk_name, size_gb, requested_gb):
+        super(DiskShrinkException, self).__init__(
+            DiskShrinkException._MESSAGE.format(
+                disk_name, size_gb, requested_gb))
+
+
+def flags(parser):
+    """Add command line flags for the `resize` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        'instance',
+        metavar='NAME',
+        help='name of the instance to resize')
+    parser.add_argument(
+        '--machine-type',
+        dest='machine_type',
+        default=None,
+        help='the new machine type of the instance')
+    parser.add_argument(
+        '--disk-size-gb',
+        type=int,
+        dest='disk_size_gb',
+        default=None,
+        help='the new size of the notebooks disk in GB')
+    parser.add_argument(
+        '--no-connect',
+        dest='no_connect',
+        action='store_true',
+        default=False,
+        help='do not connect to the instance once it has been resized')
+    parser.add_argument(
+        '--no-user-checking',
+        dest='no_user_checking',
+        action='store_true',
+        default=False,
+        help='do not check if the current user matches the Datalab instance')
+
+    connect.connection_flags(parser)
+    return
+
+
+def _disk_size_gb(args, gcloud_compute, disk_name):
+    get_cmd = ['disks', 'describe', '--zone', args.zone,
+               '--format', 'json(sizeGb)', disk_name]
+    with tempfile.TemporaryFile() as stdout:
+        gcloud_compute(args, get_cmd, stdout=stdout)
+        stdout.seek(0)
+        return int(json.loads(stdout.read().decode('utf-8'))['sizeGb'])
+
+
+def plan(args, gcloud_compute, instance_json):
+    """Work out the steps needed to resize the instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      instance_json: The decoded instance resource
+    Returns:
+      A tuple of a dictionary mapping the name of each step to the
+      `gcloud compute` command that carries it out (or None if the step
+      is not needed), and a list of descriptions of the steps.
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      DiskShrinkException: If the disk would be shrunk
+    """
+    name = instance_json['name']
+    zone_flag = ['--zone', args.zone]
+    steps = {}
+    machine_type = instance_json.get('machineType', '').rsplit('/', 1)[-1]
+    if args.machine_type and args.machine_type != machine_type:
+        steps['set-machine-type'] = ['instances', 'set-machine-type'] + (
+            zone_flag + ['--machine-type', args.machine_type, name])
+    disk_cfg = utils.notebook_disk_config(instance_json)
+    disk_name = (disk_cfg or {}).get('source', '').rsplit('/', 1)[-1]
+    size_gb = None
+    if args.disk_size_gb and disk_name:
+        size_gb = _disk_size_gb(args, gcloud_compute, disk_name)
+        if args.disk_size_gb < size_gb:
+            raise DiskShrinkException(disk_name, size_gb, args.disk_size_gb)
+        if args.disk_size_gb > size_gb:
+            steps['resize-disk'] = ['disks', 'resize', '--quiet'] + (
+                zone_flag + ['--size', '{}GB'.format(args.disk_size_gb),
+                             disk_name])
+    if not steps:
+        return steps, []
+
+    # The instance is restarted even if only the disk is grown, so that
+    # its startup script grows the file system.
+    if instance_json.get('status') != connect._STATUS_RUNNING:
+        steps['stop'] = None
+    elif stop._has_local_ssds(instance_json):
+        steps['stop'] = ['instances', 'stop', '--discard-local-ssd=true'] + (
+            zone_flag + [name])
+    else:
+        steps['stop'] = ['instances', 'stop'] + zone_flag + [name]
+    steps['start'] = ['instances', 'start'] + zone_flag + [name]
+
+    descriptions = [
+        ' - ' + _STEP_DESCRIPTIONS[step].format(
+            name, disk_name, size_gb, args.disk_size_gb, machine_type,
+            args.machine_type)
+        for step in _STEPS if steps.get(step)]
+    return steps, descriptions
+
+
+def run(args, gcloud_compute, email='', in_cloud_shell=False,
+        **unused_kwargs):
+    """Implementation of the `datalab resize` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      email: The user's email address
+      in_cloud_shell: Whether or not the command is being run in the
+        Google Cloud Shell
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      NoResizeSpecifiedException: If neither a machine type nor a disk
+        size was given
+      DiskShrinkException: If the disk would be shrunk
+    """
+    if not (args.machine_type or args.disk_size_gb):
+        raise NoResizeSpecifiedException()
+    name = args.instance
+    _, metadata_items = utils.describe_instance(args, gcloud_compute, name)
+    for_user = metadata_items.get('for-user', '')
+    if (not args.no_user_checking) and for_user and (for_user != email):
+        print(connect.wrong_user_message_template.format(for_user, email))
+        return
+    instance_json = utils.get_instance_record(args, gcloud_compute, name)
+
+    steps, descriptions = plan(args, gcloud_compute, instance_json)
+    if not steps:
+        print('The instance {} already has the requested size'.format(name))
+    elif not utils.prompt_for_confirmation(
+            args=args,
+            message=_RESIZE_PROMPT.format('\n'.join(descriptions)),
+            accept_by_default=True):
+        print('Resize aborted by user; Exiting.')
+        return
+    else:
+        timings = {}
+
+        def timed(step):
+            def run_step(unused_deps):
+                start = time.time()
+                try:
+                    if steps[step]:
+                        utils.call_gcloud_quietly(
+                            args, gcloud_compute, steps[step])
+                finally:
+                    utils.invalidate_instance_record(args, name)
+                timings[step] = time.time() - start
+            return run_step
+
+        # The disk can be grown while the instance is running, so that
+        # happens at the same time as stopping it.
+        tasks = {}
+        for step in steps:
+            deps = []
+            if step == 'set-machine-type':
+                deps = ['stop']
+            elif step == 'start':
+                deps = [other for other in steps if other != 'start']
+            tasks[step] = (timed(step), deps)
+        print('Resizing the instance {}'.format(name))
+        utils.run_tasks(tasks)
+        inventory.record_instance(
+            args, name, args.zone, connect._STATUS_RUNNING)
+
+        print('\nThe resize took the following time in each step:')
+        for step in _STEPS:
+            if steps.get(step):
+                print(' {:<18} {:>6.0f}s'.format(step, timings[step]))
+
+    if not args.no_connect:
+        connect.connect(args, gcloud_compute, email, in_cloud_shell)
+    return
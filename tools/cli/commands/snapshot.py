@@ -0,0 +1,182 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab snapshot` command."""
+
+from __future__ import absolute_import
+
+import copy
+import time
+
+from . import utils
+
+
+description = ("""`{0} {1}` takes a snapshot of the notebooks disk of each
+of the given Datalab instances.
+
+Snapshots are incremental, so only the blocks that changed since the
+previous snapshot of the same disk are stored. The snapshots of several
+instances are taken concurrently.
+
+A new instance with a copy of the notebooks disk, in any zone, can then
+be created with `{0} create --from-snapshot SNAPSHOT`.
+
+The snapshot is taken while the instance keeps running, so it only has
+what has been written to the disk; stop the instance first for a copy
+that is guaranteed to be consistent.""")
+
+
+examples = ("""
+To snapshot the notebooks disk of the instance 'my-instance':
+
+    $ {0} {1} my-instance
+
+To snapshot every instance whose name starts with 'team-':
+
+    $ {0} {1} 'team-*'
+
+To create a copy of the instance from the snapshot:
+
+    $ {0} create --from-snapshot my-instance-20180601-120000 my-copy
+""")
+
+
+_FILTER_HELP = ("""Snapshot every Datalab instance that matches the given
+filter EXPRESSION, as accepted by the `list` command.""")
+
+_SNAPSHOT_NAME_HELP = ("""The name of the snapshot, if only one instance is
+selected. Defaults to the name of the instance followed by the time.""")
+
+_SNAPSHOT_DESCRIPTION = 'Notebooks disk of the Datalab instance {}'
+_SNAPSHOT_LABEL = 'datalab-instance'
+
+# Snapshot names, like those of instances, are limited to 63 characters.
+_MAX_NAME_LENGTH = 63
+
+# Maximum number of snapshots that are taken at once.
+_MAX_CONCURRENT_SNAPSHOTS = 8
+
+
+class SnapshotNameException(Exception):
+
+    _MESSAGE = ('A snapshot name can only be given when a single instance '
+                'is selected, but {} were.')
+
+    def __init__(self, count):
+        super(SnapshotNameException, self).__init__(
+            SnapshotNameException._MESSAGE.format(count))
+
+
+def flags(parser):
+    """Add command line flags for the `snapshot` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        'instances',
+        metavar='NAME',
+        nargs='*',
+        help='names of, or patterns matching, the instances to snapshot')
+    parser.add_argument(
+        '--filter',
+        dest='filter',
+        default=None,
+        help=_FILTER_HELP)
+    parser.add_argument(
+        '--snapshot-name',
+        dest='snapshot_name',
+        default=None,
+        help=_SNAPSHOT_NAME_HELP)
+    return
+
+
+def default_snapshot_name(instance, timestamp):
+    """Get the default name of a snapshot of an instance's notebooks disk.
+
+    Args:
+      instance: The name of the instance
+      timestamp: The time at which the snapshot is taken, in seconds
+    Returns:
+      The instance name followed by the UTC time, shortened if necessary.
+    """
+    suffix = time.strftime('-%Y%m%d-%H%M%S', time.gmtime(timestamp))
+    prefix = instance[:_MAX_NAME_LENGTH - len(suffix)].rstrip('-')
+    return prefix + suffix
+
+
+def snapshot_instance(args, gcloud_compute, instance_json, snapshot_name):
+    """Take a snapshot of the notebooks disk of the given instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      instance_json: The decoded instance resource
+      snapshot_name: The name of the snapshot to take
+    Returns:
+      The name of the snapshot, or None if the instance has no
+      notebooks disk attached.
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` call fails
+    """
+    name = instance_json['name']
+    disk_cfg = utils.notebook_disk_config(instance_json)
+    if not disk_cfg:
+        print('The instance {} has no notebooks disk to snapshot'.format(
+            name))
+        return None
+    disk_name = disk_cfg.get('source', '').rstrip('/').rsplit('/', 1)[-1]
+    disk_args = copy.copy(args)
+    disk_args.zone = utils.instance_zone(instance_json)
+    print('Snapshotting the disk {} of {} as {}'.format(
+        disk_name, name, snapshot_name))
+    utils.call_gcloud_quietly(disk_args, gcloud_compute, [
+        'disks', 'snapshot', '--zone', disk_args.zone,
+        '--snapshot-names', snapshot_name,
+        '--description', _SNAPSHOT_DESCRIPTION.format(name),
+        '--labels', '{}={}'.format(_SNAPSHOT_LABEL, name),
+        disk_name])
+    print('Created the snapshot {}'.format(snapshot_name))
+    return snapshot_name
+
+
+def run(args, gcloud_compute, **unused_kwargs):
+    """Implementation of the `datalab snapshot` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      SnapshotNameException: If a snapshot name was given for more than
+        one instance
+    """
+    instances = utils.resolve_instances(
+        args, gcloud_compute, args.instances, filter_expr=args.filter)
+    if not instances:
+        print('No matching instances found')
+        return
+    if args.snapshot_name and len(instances) > 1:
+        raise SnapshotNameException(len(instances))
+
+    timestamp = time.time()
+    utils.run_concurrently(
+        dict((instance_json['name'],
+              lambda instance_json=instance_json: snapshot_instance(
+                  args, gcloud_compute, instance_json,
+                  args.snapshot_name or default_snapshot_name(
+                      instance_json['name'], timestamp)))
+             for instance_json in instances),
+        max_workers=_MAX_CONCURRENT_SNAPSHOTS)
+    return
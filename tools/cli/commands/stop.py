@@ -16,11 +16,46 @@
 
 from __future__ import absolute_import
 
-from . import utils
+from . import inventory, utils
 
 
-description = ("""`{0} {1}` stops the given Datalab instance's
-Google Compute Engine VM.""")
+description = ("""`{0} {1}` stops the given Datalab instances'
+Google Compute Engine VMs.
+
+Instances can be selected by name, by shell-style patterns such as
+`alice-*`, or with a `list`-style filter. All of the selected instances
+are stopped concurrently.
+
+The contents of any local SSDs attached to the instances are discarded.""")
+
+
+examples = ("""
+To stop the instance 'my-instance':
+
+    $ {0} {1} my-instance
+
+To stop every instance whose name starts with 'team-':
+
+    $ {0} {1} 'team-*'
+
+To stop every running instance in the zone 'us-central1-a':
+
+    $ {0} {1} --zone us-central1-a --filter 'status=RUNNING'
+""")
+
+
+_FILTER_HELP = ("""Stop every Datalab instance that matches the given
+filter EXPRESSION, as accepted by the `list` command.""")
+
+
+_STOP_PROMPT = ("""The following instances will be stopped:
+{}
+""")
+
+
+def _has_local_ssds(instance_json):
+    return any(disk.get('type') == 'SCRATCH'
+               for disk in instance_json.get('disks', []))
 
 
 def flags(parser):
@@ -30,9 +65,15 @@ def flags(parser):
       parser: The argparse parser to which to add the flags.
     """
     parser.add_argument(
-        'instance',
+        'instances',
         metavar='NAME',
-        help='name of the instance to stop')
+        nargs='*',
+        help='names of, or patterns matching, the instances to stop')
+    parser.add_argument(
+        '--filter',
+        dest='filter',
+        default=None,
+        help=_FILTER_HELP)
     return
 
 
@@ -45,12 +86,42 @@ def run(args, gcloud_compute, **unused_kwargs):
     Raises:
       subprocess.CalledProcessError: If a nested `gcloud` calls fails
     """
-    instance = args.instance
-    utils.maybe_prompt_for_zone(args, gcloud_compute, instance)
-
-    print('Stopping {0}'.format(instance))
-    base_cmd = ['instances', 'stop']
-    if args.zone:
-        base_cmd.extend(['--zone', args.zone])
-    gcloud_compute(args, base_cmd + [instance])
+    instances = utils.resolve_instances(
+        args, gcloud_compute, args.instances, args.filter)
+    if not instances:
+        print('No matching instances found.')
+        return
+
+    names = [instance_json['name'] for instance_json in instances]
+    if len(instances) > 1:
+        targets = '\n'.join(
+            ' - [{}] in [{}]'.format(
+                instance_json['name'], utils.instance_zone(instance_json))
+            for instance_json in instances)
+        if not utils.prompt_for_confirmation(
+                args=args,
+                message=_STOP_PROMPT.format(targets),
+                accept_by_default=True):
+            print('Stop aborted by user; Exiting.')
+            return
+
+    print('Stopping {0}'.format(', '.join(names)))
+
+    def record_stopped(instance_args, name):
+        inventory.record_instance(
+            instance_args, name, instance_args.zone, 'TERMINATED')
+
+    # Instances with local SSDs can only be stopped if it is made
+    # explicit that the contents of the SSDs will be lost.
+    with_ssds = [i for i in instances if _has_local_ssds(i)]
+    without_ssds = [i for i in instances if not _has_local_ssds(i)]
+    if without_ssds:
+        utils.run_on_instances(
+            args, gcloud_compute, ['instances', 'stop'], without_ssds,
+            on_success=record_stopped)
+    if with_ssds:
+        utils.run_on_instances(
+            args, gcloud_compute,
+            ['instances', 'stop', '--discard-local-ssd=true'], with_ssds,
+            on_success=record_stopped)
     return
@@ -0,0 +1,591 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Multiplexed SSH tunnels to Datalab instances.
+
+A tunnel is an SSH master connection, in the sense of OpenSSH's
+ControlMaster, that runs in the background and carries the port
+forwards. Once a master is running, forwards are added and checked over
+its control socket, which takes milliseconds rather than the seconds of
+a new SSH handshake.
+
+The first master for an instance is opened with `gcloud compute ssh`,
+which takes care of the user's SSH keys and of the instance's host key.
+When a master that has been running is lost, a new one is opened by
+running ssh directly against the instance's address, with the key and
+host key that gcloud set up, and gcloud is only used again if that
+fails.
+
+Forwards can be added to and removed from the running master by any
+invocation of the CLI. These are recorded in a file next to the control
+socket, so that they are restored whenever the master is reopened, and
+are dropped when the tunnel is closed.
+
+This relies on OpenSSH, so on other platforms the tunnel is simply a
+`gcloud compute ssh` command that runs for as long as it is open.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from . import inventory, localstate, utils
+
+
+_SSH_USER = 'datalab'
+
+# The remote port on which Datalab listens.
+DATALAB_PORT = 8080
+
+# The key and the known hosts file that `gcloud compute ssh` sets up, and
+# the alias under which it records the host key of each instance.
+_GCLOUD_SSH_KEY_FILE = os.path.join('~', '.ssh', 'google_compute_engine')
+_GCLOUD_KNOWN_HOSTS_FILE = os.path.join(
+    '~', '.ssh', 'google_compute_known_hosts')
+_HOST_KEY_ALIAS_TEMPLATE = 'compute.{}'
+
+# The directory, under the per-user config directory, that holds the
+# control sockets of the master connections.
+_CONTROL_DIR = 'ssh'
+
+# The SSH settings for the kinds of network that a tunnel may cross.
+#
+# Each profile sets how often the master sends a keepalive, and how many
+# may go unanswered before it gives up; on a LAN or a typical WAN a dead
+# connection is thus noticed within about 10 seconds, while lossy, slow
+# links get more slack. The AEAD ciphers (chacha20-poly1305 is fastest
+# without AES instructions, AES-GCM with them) need no separate MAC; the
+# MACs only apply to aes128-ctr, which is listed for older servers.
+#
+# OpenSSH has no setting for the size of its channel windows, so the
+# profiles instead set the IP type of service that it asks the network
+# for: low delay for interactive use, or high throughput.
+TUNNEL_PROFILES = {
+    'lan': {
+        'Compression': 'no',
+        'Ciphers': ('aes128-gcm@openssh.com,chacha20-poly1305@openssh.com,'
+                    'aes128-ctr'),
+        'MACs': 'umac-64-etm@openssh.com,hmac-sha2-256-etm@openssh.com',
+        'IPQoS': 'throughput',
+        'ServerAliveInterval': '5',
+        'ServerAliveCountMax': '2',
+    },
+    'wan': {
+        'Compression': 'no',
+        'Ciphers': ('chacha20-poly1305@openssh.com,aes128-gcm@openssh.com,'
+                    'aes128-ctr'),
+        'MACs': 'umac-64-etm@openssh.com,hmac-sha2-256-etm@openssh.com',
+        'IPQoS': 'lowdelay',
+        'ServerAliveInterval': '5',
+        'ServerAliveCountMax': '2',
+    },
+    'lowbandwidth': {
+        'Compression': 'yes',
+        'Ciphers': ('chacha20-poly1305@openssh.com,aes128-gcm@openssh.com,'
+                    'aes128-ctr'),
+        'MACs': 'umac-64-etm@openssh.com,hmac-sha2-256-etm@openssh.com',
+        'IPQoS': 'lowdelay',
+        'ServerAliveInterval': '15',
+        'ServerAliveCountMax': '4',
+    },
+}
+DEFAULT_TUNNEL_PROFILE = 'wan'
+
+# How long, in seconds, to wait for a direct SSH connection.
+_CONNECT_TIMEOUT_SECONDS = 10
+
+# How often, in seconds, to check that the master is still running.
+_CHECK_INTERVAL_SECONDS = 1
+
+# How a tunnel was (re)opened, as reported by `Tunnel.open`.
+VIA_MASTER = 'the existing master connection'
+VIA_DIRECT = 'a direct SSH connection'
+VIA_GCLOUD = 'gcloud'
+
+
+class InvalidForwardException(ValueError):
+
+    _MESSAGE = ('Invalid port forward "{}"; expected PORT or '
+                'LOCAL_PORT:REMOTE_PORT, with ports from 1 to 65535.')
+
+    def __init__(self, spec):
+        super(InvalidForwardException, self).__init__(
+            InvalidForwardException._MESSAGE.format(spec))
+
+
+class ForwardFailedException(Exception):
+
+    _MESSAGE = ('Could not forward local port {1} to port {2} of {0}; the '
+                'local port may be in use')
+
+    def __init__(self, instance, local_port, remote_port):
+        super(ForwardFailedException, self).__init__(
+            ForwardFailedException._MESSAGE.format(
+                instance, local_port, remote_port))
+
+
+class TunnelClosedException(Exception):
+
+    _MESSAGE = 'The SSH connection to {} was closed'
+
+    def __init__(self, instance):
+        super(TunnelClosedException, self).__init__(
+            TunnelClosedException._MESSAGE.format(instance))
+
+
+def multiplexing_supported():
+    """Check whether SSH master connections can be used on this platform."""
+    return os.name == 'posix'
+
+
+def port_mapping(local_port, remote_port):
+    """Get the `-L` argument that forwards a local port to a remote one."""
+    return 'localhost:{}:localhost:{}'.format(local_port, remote_port)
+
+
+def parse_forward(spec):
+    """Parse a port forward, given as PORT or LOCAL_PORT:REMOTE_PORT.
+
+    Args:
+      spec: The string to parse
+    Returns:
+      A (local port, remote port) tuple.
+    Raises:
+      InvalidForwardException: If the string is not a valid forward
+    """
+    parts = spec.split(':')
+    if len(parts) == 1:
+        parts = parts * 2
+    try:
+        ports = tuple(int(part) for part in parts)
+    except ValueError:
+        raise InvalidForwardException(spec)
+    if len(ports) != 2 or not all(0 < port < 65536 for port in ports):
+        raise InvalidForwardException(spec)
+    return ports
+
+
+def instance_endpoint(instance_json):
+    """Get the address and host key alias for connecting to an instance.
+
+    Args:
+      instance_json: The decoded instance resource
+    Returns:
+      A tuple of the instance's external IP address and the alias under
+      which gcloud records its host key, or None if it has no external
+      address.
+    """
+    for interface in instance_json.get('networkInterfaces', []):
+        for access_config in interface.get('accessConfigs', []):
+            if access_config.get('natIP') and instance_json.get('id'):
+                return (access_config['natIP'],
+                        _HOST_KEY_ALIAS_TEMPLATE.format(instance_json['id']))
+    return None
+
+
+class Tunnel(object):
+    """An SSH tunnel to a Datalab instance, carrying some port forwards.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      instance: The name of the instance
+      forwards: A list of (local port, remote port) tuples that the
+        tunnel is opened with
+      owns_master: Whether `close` should stop a master that was opened
+        by another tunnel, as the agent does with the masters handed
+        over to it. Otherwise, such a master is left running.
+    """
+
+    def __init__(self, args, gcloud_compute, instance, forwards,
+                 owns_master=False):
+        self._args = args
+        self._gcloud_compute = gcloud_compute
+        self._instance = instance
+        self._forwards = [tuple(forward) for forward in forwards]
+        self._endpoint = None
+        self._owns_master = owns_master
+        # Whether a master has been running, in which case gcloud has
+        # set up the keys needed to connect directly.
+        self._master_seen = False
+
+    @property
+    def control_path(self):
+        """The path of the control socket of the tunnel's master."""
+        # Unix socket paths are limited to about 100 characters, so the
+        # instance is identified by a hash rather than by name.
+        key = '{}/{}/{}'.format(
+            inventory.project_key(self._args), self._args.zone or '',
+            self._instance)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        control_dir = os.path.join(
+            localstate.datalab_config_dir(), _CONTROL_DIR)
+        if not os.path.isdir(control_dir):
+            os.makedirs(control_dir, 0o700)
+        return os.path.join(control_dir, digest)
+
+    @property
+    def _added_forwards_path(self):
+        return self.control_path + '.forwards.json'
+
+    @property
+    def added_forwards(self):
+        """The forwards added to the running master, in the order added."""
+        contents = localstate.read_json_file(
+            self._added_forwards_path, default={})
+        if not isinstance(contents, dict):
+            return []
+        return [tuple(forward) for forward in contents.get('forwards', [])]
+
+    @property
+    def forwards(self):
+        """Every (local port, remote port) tuple that the tunnel carries."""
+        forwards = list(self._forwards)
+        for forward in self.added_forwards:
+            if forward not in forwards:
+                forwards.append(forward)
+        return forwards
+
+    def _record_added_forward(self, forward, added):
+        def update(contents):
+            forwards = [tuple(f) for f in contents.get('forwards', [])]
+            if forward in forwards:
+                forwards.remove(forward)
+            if added:
+                forwards.append(forward)
+            contents['forwards'] = forwards
+
+        localstate.update_json_file(self._added_forwards_path, update)
+
+    @property
+    def profile(self):
+        """The name of the tunnel profile that the tunnel is opened with."""
+        return self._args.tunnel_profile
+
+    def _profile_options(self):
+        profile = TUNNEL_PROFILES[self.profile]
+        options = []
+        for name in sorted(profile):
+            options.extend(['-o', '{}={}'.format(name, profile[name])])
+        return options
+
+    def _master_options(self):
+        return [
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPath=' + self.control_path,
+            '-o', 'ExitOnForwardFailure=yes',
+            '-o', 'LogLevel=' + self._args.ssh_log_level,
+        ] + self._profile_options()
+
+    def _forward_options(self):
+        options = []
+        for local_port, remote_port in self.forwards:
+            options.extend(['-L', port_mapping(local_port, remote_port)])
+        return options
+
+    def _control(self, command, *options):
+        """Send a command to the master over its control socket.
+
+        Returns:
+          True iff the command succeeded.
+        """
+        cmd = ['ssh', '-O', command, '-o', 'ControlPath=' + self.control_path]
+        cmd.extend(options)
+        cmd.append('{}@{}'.format(_SSH_USER, self._instance))
+        with open(os.devnull, 'w') as devnull:
+            try:
+                return subprocess.call(
+                    cmd, stdout=devnull, stderr=devnull) == 0
+            except OSError:
+                return False
+
+    def remote_command(self, command):
+        """Get the ssh command that runs a command over the master.
+
+        Each such command is a new session of the master connection, so
+        several can run at once without any further SSH handshakes.
+
+        Args:
+          command: The shell command to run on the instance
+        Returns:
+          The command line to run locally.
+        """
+        return ['ssh', '-T',
+                '-o', 'ControlPath=' + self.control_path,
+                '-o', 'BatchMode=yes',
+                '-o', 'LogLevel=' + self._args.ssh_log_level,
+                '{}@{}'.format(_SSH_USER, self._instance),
+                command]
+
+    def master_alive(self):
+        """Check whether the tunnel's master connection is running."""
+        return self._control('check')
+
+    def add_forward(self, local_port, remote_port):
+        """Add a port forward to the running master connection.
+
+        The forward is also restored whenever the master is reopened,
+        until it is removed or the tunnel is closed.
+
+        Returns:
+          True iff the forward was added.
+        """
+        if not self._control('forward', '-L',
+                             port_mapping(local_port, remote_port)):
+            return False
+        if (local_port, remote_port) not in self._forwards:
+            self._record_added_forward((local_port, remote_port), True)
+        return True
+
+    def remove_forward(self, local_port, remote_port):
+        """Remove a port forward from the running master connection.
+
+        Returns:
+          True iff the forward was removed.
+        """
+        self._record_added_forward((local_port, remote_port), False)
+        return self._control(
+            'cancel', '-L', port_mapping(local_port, remote_port))
+
+    def _open_direct(self):
+        if not self._master_seen:
+            return False
+        if not self._endpoint:
+            try:
+                self._endpoint = instance_endpoint(utils.get_instance_record(
+                    self._args, self._gcloud_compute, self._instance))
+            except (subprocess.CalledProcessError, ValueError,
+                    utils.NoSuchInstanceException):
+                return False
+        if not self._endpoint:
+            return False
+        address, host_key_alias = self._endpoint
+        cmd = ['ssh', '-4', '-f', '-N',
+               '-i', os.path.expanduser(_GCLOUD_SSH_KEY_FILE),
+               '-o', 'IdentitiesOnly=yes',
+               '-o', 'BatchMode=yes',
+               '-o', 'CheckHostIP=no',
+               '-o', 'StrictHostKeyChecking=yes',
+               '-o', 'HostKeyAlias=' + host_key_alias,
+               '-o', 'UserKnownHostsFile=' + os.path.expanduser(
+                   _GCLOUD_KNOWN_HOSTS_FILE),
+               '-o', 'ConnectTimeout={}'.format(_CONNECT_TIMEOUT_SECONDS)]
+        cmd.extend(self._master_options())
+        cmd.extend(self._forward_options())
+        cmd.append('{}@{}'.format(_SSH_USER, address))
+        with open(os.devnull, 'w') as devnull:
+            try:
+                return subprocess.call(cmd, stderr=devnull) == 0
+            except OSError:
+                return False
+
+    def _gcloud_ssh_cmd(self, ssh_flags):
+        cmd = ['ssh']
+        if self._args.zone:
+            cmd.extend(['--zone', self._args.zone])
+        cmd.extend('--ssh-flag=' + flag for flag in ssh_flags)
+        cmd.append('{}@{}'.format(_SSH_USER, self._instance))
+        return cmd
+
+    def _open_gcloud(self):
+        self._gcloud_compute(self._args, self._gcloud_ssh_cmd(
+            ['-4', '-f', '-N'] + self._master_options() +
+            self._forward_options()))
+        # The address may have changed, e.g. if the instance was
+        # restarted, so look it up again when next needed.
+        self._endpoint = None
+
+    def open(self, use_gcloud=True):
+        """Open the tunnel, reusing whatever is left of a previous one.
+
+        Args:
+          use_gcloud: Whether to fall back to `gcloud compute ssh`, which
+            may prompt the user, if the tunnel cannot be opened otherwise.
+        Returns:
+          How the tunnel was opened; one of VIA_MASTER, VIA_DIRECT and
+          VIA_GCLOUD, or None if it could not be opened without gcloud.
+        Raises:
+          subprocess.CalledProcessError: If gcloud failed to connect
+          ForwardFailedException: If a forward could not be added to the
+            running master, which is left as it is since other
+            invocations may be sharing it
+        """
+        if self.master_alive():
+            self._master_seen = True
+            for local_port, remote_port in self.forwards:
+                if not self._control('forward', '-L', port_mapping(
+                        local_port, remote_port)):
+                    raise ForwardFailedException(
+                        self._instance, local_port, remote_port)
+            return VIA_MASTER
+        if self._open_direct():
+            self._owns_master = True
+            return VIA_DIRECT
+        if not use_gcloud:
+            return None
+        self._open_gcloud()
+        self._owns_master = True
+        self._master_seen = True
+        return VIA_GCLOUD
+
+    def wait(self):
+        """Block for as long as the tunnel's master connection is running.
+
+        Raises:
+          TunnelClosedException: When the master connection has stopped
+        """
+        while self.master_alive():
+            time.sleep(_CHECK_INTERVAL_SECONDS)
+        raise TunnelClosedException(self._instance)
+
+    def close(self):
+        """Stop the tunnel's master connection, if this tunnel owns it.
+
+        A master that another invocation opened, e.g. the tunnel agent,
+        is shared with it, so it and its forwards are left alone.
+        """
+        if not self._owns_master:
+            return
+        self._control('exit')
+        if os.path.exists(self._added_forwards_path):
+            os.remove(self._added_forwards_path)
+
+    def run_in_foreground(self):
+        """Run the tunnel as a single gcloud command, without a master.
+
+        This is used where OpenSSH is not available, and blocks for as
+        long as the connection is open.
+
+        Raises:
+          subprocess.CalledProcessError: If the connection dies on its own
+        """
+        ssh_flags = []
+        if os.name == 'posix':
+            ssh_flags.extend(['-o', 'LogLevel=' + self._args.ssh_log_level])
+            ssh_flags.extend(self._profile_options())
+        ssh_flags.extend(['-4', '-N'])
+        ssh_flags.extend(self._forward_options())
+        self._gcloud_compute(self._args, self._gcloud_ssh_cmd(ssh_flags))
+
+
+def free_local_port():
+    """Get a local port that nothing is currently listening on."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class CountingProxy(object):
+    """Relays the connections to one local port to another, counting bytes.
+
+    This is used to measure the traffic through a tunnel, which ssh does
+    not report while it is running.
+
+    Args:
+      listen_port: The local port on which to accept connections
+      target_port: The local port to which to relay them
+    """
+
+    _BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, listen_port, target_port):
+        self._target_port = target_port
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._received = 0
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('localhost', listen_port))
+        self._listener.listen(32)
+        accept_thread = threading.Thread(target=self._accept)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    @property
+    def bytes_transferred(self):
+        """A tuple of the bytes sent to and received from the target."""
+        with self._lock:
+            return self._sent, self._received
+
+    def _count(self, sent, received):
+        with self._lock:
+            self._sent += sent
+            self._received += received
+
+    def _pump(self, source, destination, outbound):
+        try:
+            while True:
+                data = source.recv(self._BUFFER_SIZE)
+                if not data:
+                    break
+                destination.sendall(data)
+                if outbound:
+                    self._count(len(data), 0)
+                else:
+                    self._count(0, len(data))
+            # Only pass on the end of this direction, as a client that
+            # has finished sending may still be waiting for a response.
+            destination.shutdown(socket.SHUT_WR)
+        except socket.error:
+            # Stop the other direction as well, as the connection is
+            # broken.
+            for sock in [source, destination]:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def _relay(self, client, target):
+        outbound_thread = threading.Thread(
+            target=self._pump, args=[client, target, True])
+        outbound_thread.daemon = True
+        outbound_thread.start()
+        self._pump(target, client, False)
+        outbound_thread.join()
+        client.close()
+        target.close()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self._listener.accept()
+            except socket.error:
+                return
+            try:
+                target = socket.create_connection(
+                    ('localhost', self._target_port))
+            except socket.error:
+                client.close()
+                continue
+            relay_thread = threading.Thread(
+                target=self._relay, args=[client, target])
+            relay_thread.daemon = True
+            relay_thread.start()
+
+    def close(self):
+        """Stop accepting connections."""
+        try:
+            # This wakes up the thread that is blocked accepting.
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._listener.close()
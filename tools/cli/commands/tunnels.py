@@ -0,0 +1,168 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab tunnels` command."""
+
+from __future__ import absolute_import
+
+from . import agent, connect, inventory
+
+
+description = ("""`{0} {1}` manages the tunnels that the background tunnel
+agent keeps open to Datalab instances.
+
+The agent is started by `{0} connect --daemon` or `{0} {1} open`, and
+keeps running until it is stopped with `{0} {1} stop`. It picks a free
+local port for each instance, re-establishes tunnels that drop, and
+checks that Datalab is reachable through each of them.
+
+The actions are:
+
+    list    list the open tunnels, with their ports and status
+    open    open a tunnel to the instance NAME
+    close   close the tunnel to the instance NAME
+    stop    close every tunnel and stop the agent""")
+
+
+examples = ("""
+To open a tunnel to the instance 'my-instance' in the background:
+
+    $ {0} {1} open my-instance
+
+To see the port of each open tunnel:
+
+    $ {0} {1} list
+
+To close the tunnel again:
+
+    $ {0} {1} close my-instance
+""")
+
+
+_ACTIONS = ['list', 'open', 'close', 'stop']
+
+_LIST_FORMAT = '{:<24} {:<16} {:>5}  {:<12} {}'
+_FORWARD_FORMAT = '{}:{}'
+
+
+class MissingInstanceException(Exception):
+
+    _MESSAGE = 'The {} action requires the name of an instance.'
+
+    def __init__(self, action):
+        super(MissingInstanceException, self).__init__(
+            MissingInstanceException._MESSAGE.format(action))
+
+
+def flags(parser):
+    """Add command line flags for the `tunnels` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        'action',
+        choices=_ACTIONS,
+        help='what to do with the tunnels')
+    parser.add_argument(
+        'instance',
+        metavar='NAME',
+        nargs='?',
+        default=None,
+        help='name of the instance, for the open and close actions')
+    parser.add_argument(
+        '--port',
+        dest='port',
+        type=int,
+        default=None,
+        help=(
+            'local port for the open action.'
+            '\n\n'
+            'Defaults to a free port.'))
+    parser.add_argument(
+        '--no-user-checking',
+        dest='no_user_checking',
+        action='store_true',
+        default=False,
+        help='do not check if the current user matches the Datalab instance')
+    parser.add_argument(
+        '--ssh-log-level',
+        dest='ssh_log_level',
+        choices=['quiet', 'fatal', 'error', 'info', 'verbose',
+                 'debug', 'debug1', 'debug2', 'debug3'],
+        default='error',
+        help='the log level for the SSH commands of the open action.')
+    connect.tunnel_flags(parser)
+    return
+
+
+def print_tunnels(tunnels):
+    """Print a table of the tunnels returned by the agent."""
+    if not tunnels:
+        print('No tunnels are open')
+        return
+    print(_LIST_FORMAT.format(
+        'INSTANCE', 'ZONE', 'PORT', 'STATUS', 'FORWARDS'))
+    for t in tunnels:
+        print(_LIST_FORMAT.format(
+            t['instance'], t['zone'] or '', t['port'], t['status'],
+            ','.join(_FORWARD_FORMAT.format(*forward)
+                     for forward in t['forwards'][1:])))
+
+
+def run(args, gcloud_compute, email='', **unused_kwargs):
+    """Implementation of the `datalab tunnels` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      email: The user's email address
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` calls fails
+      MissingInstanceException: If no instance was named for an action
+        that requires one
+      agent.AgentNotRunningException: If the agent is not running
+      agent.AgentRequestException: If the agent failed to run the action
+    """
+    if args.action in ['open', 'close'] and not args.instance:
+        raise MissingInstanceException(args.action)
+
+    if args.action == 'list':
+        try:
+            print_tunnels(agent.call('list'))
+        except agent.AgentNotRunningException:
+            print_tunnels([])
+    elif args.action == 'open':
+        if connect.check_instance(args, gcloud_compute, email):
+            connect.connect_in_background(args, gcloud_compute)
+    elif args.action == 'close':
+        tunnels = [t for t in agent.call('list')
+                   if t['instance'] == args.instance and
+                   t['project'] == inventory.project_key(args) and
+                   (not args.zone or t['zone'] == args.zone)]
+        if not tunnels:
+            print('No tunnel to {} is open'.format(args.instance))
+        for t in tunnels:
+            agent.call('close', instance=t['instance'],
+                       project=t['project'], zone=t['zone'])
+            print('Closed the tunnel to {} on port {}'.format(
+                t['instance'], t['port']))
+    elif args.action == 'stop':
+        try:
+            result = agent.call('shutdown')
+            print('Stopped the tunnel agent, closing {} tunnels'.format(
+                result['closed']))
+        except agent.AgentNotRunningException:
+            print('The tunnel agent is not running')
+    return
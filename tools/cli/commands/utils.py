@@ -14,10 +14,37 @@
 
 """Utility methods common to multiple commands."""
 
+from __future__ import absolute_import
+
+import copy
+import fnmatch
 import json
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+
+from . import inventory
+
+
+# Full descriptions of the instances fetched during this invocation,
+# keyed by (project, zone, instance name). Each value is a tuple of the
+# time the description was fetched and the decoded description.
+_instance_records = {}
+_instance_records_lock = threading.Lock()
+
+# Serializes interactive prompts made from concurrent lookups.
+_prompt_lock = threading.Lock()
+
+# Maximum number of instances that are looked up at once.
+_MAX_CONCURRENT_LOOKUPS = 8
+
+# Maximum number of zones whose instances are operated on at once.
+_MAX_CONCURRENT_ZONES = 8
+
+# The text with which gcloud reports that a resource does not exist.
+_NOT_FOUND_MESSAGE = 'was not found'
 
 
 try:
@@ -86,6 +113,17 @@ class NoSuchInstanceException(Exception):
             NoSuchInstanceException._MESSAGE.format(instance_name))
 
 
+class NoInstancesSpecifiedException(Exception):
+
+    _MESSAGE = (
+        'You must specify at least one instance name or pattern, '
+        'or the --filter flag.')
+
+    def __init__(self):
+        super(NoInstancesSpecifiedException, self).__init__(
+            NoInstancesSpecifiedException._MESSAGE)
+
+
 class MissingZoneFlagException(Exception):
 
     _DEFAULT_MESSAGE = (
@@ -105,6 +143,19 @@ class MissingZoneFlagException(Exception):
             MissingZoneFlagException.get_message(instance_name))
 
 
+def reported_not_found(stderr):
+    """Check whether a failed `gcloud` call reported a missing resource.
+
+    Args:
+      stderr: The file to which the `gcloud` call wrote its errors
+    Returns:
+      True iff the call failed because the resource does not exist,
+      rather than e.g. because of an authentication or network error.
+    """
+    stderr.seek(0)
+    return _NOT_FOUND_MESSAGE in stderr.read().decode('utf-8', 'replace')
+
+
 def call_gcloud_quietly(args, gcloud_surface, cmd, report_errors=True):
     """Call `gcloud` and silence any output unless it fails.
 
@@ -190,7 +241,11 @@ def prompt_for_zone(args, gcloud_compute, instance=None):
         raise NoSuchInstanceException(instance)
     if args.quiet:
         raise MissingZoneFlagException(instance)
+    with _prompt_lock:
+        return _select_zone(matching_zones)
 
+
+def _select_zone(matching_zones):
     zone_number = 1
     zone_map = {}
     print('Please specify a zone from one of:')
@@ -205,7 +260,7 @@ def prompt_for_zone(args, gcloud_compute, instance=None):
     except Exception:
         if selected not in matching_zones:
             print('Zone {} not recognized'.format(selected))
-            return prompt_for_zone(args, gcloud_compute, instance=instance)
+            return _select_zone(matching_zones)
         return selected
 
 
@@ -258,7 +313,112 @@ def _check_datalab_tag(instance, tags):
     return
 
 
-def describe_instance(args, gcloud_compute, instance):
+def _instance_record_key(args, instance):
+    return (args.project or '', args.zone or '', instance)
+
+
+def get_instance_record(args, gcloud_compute, instance, max_age=None):
+    """Get the full description of the given Google Compute Engine VM.
+
+    The description is only fetched once per invocation of the CLI, and
+    is then shared by every command that needs the status, tags,
+    metadata or disks of the instance. Commands that modify the instance
+    must call `invalidate_instance_record` afterwards.
+
+    If no zone was specified, then the zone recorded in the local
+    instance inventory is tried first. Otherwise, this will prompt the
+    user to select a zone if necessary.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      instance: The name of the instance to describe
+      max_age: If specified, the maximum age, in seconds, of a previously
+        fetched description that may be returned.
+    Returns:
+      The instance resource, as returned by `instances describe`.
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` call fails
+      ValueError: If the result returned by gcloud is not valid JSON
+      NoSuchInstanceException: If the user specified an instance that
+          does not exist in any zone.
+    """
+    key = _instance_record_key(args, instance)
+    with _instance_records_lock:
+        record = _instance_records.get(key)
+    if record and (max_age is None or time.time() - record[0] <= max_age):
+        return record[1]
+
+    instance_json = None
+    if not args.zone:
+        known_zone = inventory.lookup_zone(args, instance)
+        if known_zone:
+            with tempfile.TemporaryFile() as stderr:
+                try:
+                    instance_json = _fetch_instance_json(
+                        args, gcloud_compute, instance, known_zone, stderr)
+                    args.zone = known_zone
+                except subprocess.CalledProcessError:
+                    if not reported_not_found(stderr):
+                        stderr.seek(0)
+                        sys.stderr.write(stderr.read().decode('utf-8'))
+                        raise
+                    # The instance has been deleted or recreated elsewhere
+                    # since it was recorded, so look for it from scratch.
+                    inventory.remove_instance(args, instance)
+
+    if instance_json is None:
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                instance_json = _fetch_instance_json(
+                    args, gcloud_compute, instance, args.zone, stderr)
+            except subprocess.CalledProcessError:
+                if args.zone:
+                    stderr.seek(0)
+                    sys.stderr.write(stderr.read())
+                    raise
+                else:
+                    args.zone = prompt_for_zone(
+                        args, gcloud_compute, instance=instance)
+                    return get_instance_record(
+                        args, gcloud_compute, instance, max_age=max_age)
+    if not args.zone and instance_json.get('zone'):
+        # The configured zone was used, so record it for later commands.
+        args.zone = instance_json['zone'].rsplit('/', 1)[-1]
+    with _instance_records_lock:
+        _instance_records[_instance_record_key(args, instance)] = (
+            time.time(), instance_json)
+    inventory.record_described_instance(args, instance_json)
+    return instance_json
+
+
+def _fetch_instance_json(args, gcloud_compute, instance, zone, stderr):
+    get_cmd = ['instances', 'describe', '--quiet']
+    if zone:
+        get_cmd.extend(['--zone', zone])
+    get_cmd.extend(['--format', 'json', instance])
+    with tempfile.TemporaryFile() as stdout:
+        gcloud_compute(args, get_cmd, stdout=stdout, stderr=stderr)
+        stdout.seek(0)
+        return json.loads(stdout.read().decode('utf-8').strip())
+
+
+def invalidate_instance_record(args, instance):
+    """Forget the description of the instance fetched by this invocation.
+
+    This must be called after any operation that modifies the instance.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      instance: The name of the instance
+    """
+    with _instance_records_lock:
+        for key in list(_instance_records):
+            if key[0] == (args.project or '') and key[2] == instance:
+                del _instance_records[key]
+
+
+def describe_instance(args, gcloud_compute, instance, max_age=None):
     """Get the status and metadata of the given Google Compute Engine VM.
 
     This will prompt the user to select a zone if necessary.
@@ -267,6 +427,8 @@ def describe_instance(args, gcloud_compute, instance):
       args: The Namespace instance returned by argparse
       gcloud_compute: Function that can be used to invoke `gcloud compute`
       instance: The name of the instance to check
+      max_age: If specified, the maximum age, in seconds, of a previously
+        fetched description that may be used.
     Returns:
       A tuple of the string describing the status of the instance
       (e.g. 'RUNNING' or 'TERMINATED'), and the list of metadata items.
@@ -278,35 +440,14 @@ def describe_instance(args, gcloud_compute, instance):
       NoSuchInstanceException: If the user specified an instance that
           does not exist in any zone.
     """
-    get_cmd = ['instances', 'describe', '--quiet']
-    if args.zone:
-        get_cmd.extend(['--zone', args.zone])
-    get_cmd.extend(
-        ['--format', 'json(status,tags.items,metadata.items)', instance])
-    with tempfile.TemporaryFile() as stdout, \
-            tempfile.TemporaryFile() as stderr:
-        try:
-            gcloud_compute(args, get_cmd, stdout=stdout, stderr=stderr)
-            stdout.seek(0)
-            json_result = stdout.read().decode('utf-8').strip()
-            status_tags_and_metadata = json.loads(json_result)
-            tags = status_tags_and_metadata.get('tags', {})
-            _check_datalab_tag(instance, tags)
-
-            status = status_tags_and_metadata.get('status', 'UNKNOWN')
-            metadata = status_tags_and_metadata.get('metadata', {})
-            return (status, flatten_metadata(metadata))
-        except subprocess.CalledProcessError:
-            if args.zone:
-                stderr.seek(0)
-                sys.stderr.write(stderr.read())
-                raise
-            else:
-                args.zone = prompt_for_zone(
-                    args, gcloud_compute, instance=instance)
-                return describe_instance(
-                    args, gcloud_compute, instance)
-    return ('UNKNOWN', [])
+    instance_json = get_instance_record(
+        args, gcloud_compute, instance, max_age=max_age)
+    tags = instance_json.get('tags', {})
+    _check_datalab_tag(instance, tags)
+
+    status = instance_json.get('status', 'UNKNOWN')
+    metadata = instance_json.get('metadata', {})
+    return (status, flatten_metadata(metadata))
 
 
 def instance_notebook_disk(args, gcloud_compute, instance):
@@ -324,28 +465,27 @@ def instance_notebook_disk(args, gcloud_compute, instance):
     Raises:
       subprocess.CalledProcessError: If the `gcloud` call fails
     """
-    get_cmd = ['instances', 'describe', '--quiet']
-    if args.zone:
-        get_cmd.extend(['--zone', args.zone])
-    get_cmd.extend(['--format', 'json', instance])
-    with tempfile.TemporaryFile() as stdout, \
-            tempfile.TemporaryFile() as stderr:
-        try:
-            gcloud_compute(args, get_cmd, stdout=stdout, stderr=stderr)
-            stdout.seek(0)
-            instance_json = json.loads(stdout.read().decode('utf-8').strip())
-            disk_configs = instance_json.get('disks', [])
-            for cfg in disk_configs:
-                if cfg['deviceName'] == 'datalab-pd':
-                    return cfg
-
-            # There is no notebooks disk attached. This can happen
-            # if the user manually detached it.
-            return None
-        except subprocess.CalledProcessError:
-            stderr.seek(0)
-            sys.stderr.write(stderr.read())
-            raise
+    return notebook_disk_config(
+        get_instance_record(args, gcloud_compute, instance))
+
+
+def notebook_disk_config(instance_json):
+    """Get the config for the notebooks disk in an instance resource.
+
+    Args:
+      instance_json: The decoded instance resource
+    Returns:
+      The configuration for attaching the disk to the instance, or None
+      if there is no notebooks disk attached.
+    """
+    disk_configs = instance_json.get('disks', [])
+    for cfg in disk_configs:
+        if cfg['deviceName'] == 'datalab-pd':
+            return cfg
+
+    # There is no notebooks disk attached. This can happen
+    # if the user manually detached it.
+    return None
 
 
 def maybe_prompt_for_zone(args, gcloud_compute, instance):
@@ -368,6 +508,174 @@ def maybe_prompt_for_zone(args, gcloud_compute, instance):
     return
 
 
+def instances_filter(zones=None, filter_expr=None):
+    """Construct a filter expression that matches Datalab instances.
+
+    Args:
+      zones: The list of zones to which to limit the matches, if any
+      filter_expr: An additional filter expression to apply, if any
+    Returns:
+      A string suitable for passing as the `--filter` flag to gcloud
+    """
+    result = 'tags.items=\'{0}\''.format('datalab')
+    if zones:
+        zones_filter = "zone:({0})".format(" ".join(zones))
+        result = '({0}) ({1})'.format(result, zones_filter)
+    if filter_expr:
+        result = '({0}) ({1})'.format(result, filter_expr)
+    return result
+
+
+def list_instances(args, gcloud_compute, filter_expr):
+    """List the instances matching the given filter.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      filter_expr: The filter expression to pass to gcloud
+    Returns:
+      The list of decoded instance resources.
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` call fails
+      ValueError: If the result returned by gcloud is not valid JSON
+    """
+    return list_resources(
+        args, gcloud_compute, 'instances', filter_expr=filter_expr)
+
+
+def list_resources(args, gcloud_compute, resource, filter_expr=None,
+                   resource_format='json'):
+    """List the Compute Engine resources of the given type.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      resource: The `gcloud compute` resource type, e.g. 'disks'
+      filter_expr: The filter expression to pass to gcloud, if any
+      resource_format: The JSON format in which to list the resources,
+        which may project out the fields of interest
+    Returns:
+      The list of decoded resources.
+    Raises:
+      subprocess.CalledProcessError: If the `gcloud` call fails
+      ValueError: If the result returned by gcloud is not valid JSON
+    """
+    list_cmd = [resource, 'list', '--quiet', '--format', resource_format]
+    if filter_expr:
+        list_cmd.extend(['--filter', filter_expr])
+    with tempfile.TemporaryFile() as stdout, \
+            tempfile.TemporaryFile() as stderr:
+        try:
+            gcloud_compute(args, list_cmd, stdout=stdout, stderr=stderr)
+            stdout.seek(0)
+            return json.loads(stdout.read().decode('utf-8').strip() or '[]')
+        except subprocess.CalledProcessError:
+            stderr.seek(0)
+            sys.stderr.write(stderr.read().decode('utf-8'))
+            raise
+
+
+def _is_pattern(name):
+    return any(c in name for c in '*?[')
+
+
+def resolve_instances(args, gcloud_compute, names, filter_expr=None):
+    """Find the Datalab instances matching the given names or patterns.
+
+    If only plain instance names are given, then each one is looked up
+    directly (using the local inventory to find its zone). Otherwise, the
+    Datalab instances are listed once, and those whose names match any of
+    the given shell-style patterns, as well as the filter, are returned.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      names: The list of instance names or patterns
+      filter_expr: A `list`-style filter expression, if any
+    Returns:
+      The list of matching instance resources.
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` call fails
+      InvalidInstanceException: If a named instance was not created by
+          running `datalab create`.
+      NoSuchInstanceException: If a named instance does not exist.
+      NoInstancesSpecifiedException: If no names or filter were given.
+    """
+    if not (names or filter_expr):
+        raise NoInstancesSpecifiedException()
+
+    if not (filter_expr or any(_is_pattern(name) for name in names)):
+        def lookup(name):
+            # Each lookup may resolve a different zone.
+            instance_args = copy.copy(args)
+            describe_instance(instance_args, gcloud_compute, name)
+            return get_instance_record(instance_args, gcloud_compute, name)
+
+        found = run_concurrently(
+            dict((name, lambda name=name: lookup(name)) for name in names),
+            max_workers=_MAX_CONCURRENT_LOOKUPS)
+        return [found[name] for name in sorted(set(names))]
+
+    zones = [args.zone] if args.zone else None
+    listed = list_instances(
+        args, gcloud_compute, instances_filter(zones, filter_expr))
+    inventory.record_listed_instances(args, listed)
+    listed_names = set(i.get('name') for i in listed)
+    for name in names:
+        if (not filter_expr and not _is_pattern(name) and
+                name not in listed_names):
+            raise NoSuchInstanceException(name)
+    return [i for i in sorted(listed, key=lambda i: i.get('name'))
+            if not names or any(fnmatch.fnmatchcase(i.get('name', ''), name)
+                                for name in names)]
+
+
+def instance_zone(instance_json):
+    """Get the name of the zone of the given instance resource."""
+    return instance_json.get('zone', '').rstrip('/').rsplit('/', 1)[-1]
+
+
+def run_on_instances(args, gcloud_compute, cmd, instances, on_success=None):
+    """Run a `gcloud compute` command against several instances.
+
+    The instances are grouped by zone, so that each zone takes a single
+    command whose operations are started together and then waited for
+    together. The commands for different zones run concurrently.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      cmd: The command to run, without the zone or instance names
+      instances: The list of instance resources to run the command on
+      on_success: Optional function called with the args and name of
+        each instance after the command succeeds for its zone.
+    Raises:
+      subprocess.CalledProcessError: If any of the `gcloud` calls fail.
+        This is only raised after all of the calls have finished.
+    """
+    names_by_zone = {}
+    for instance_json in instances:
+        names_by_zone.setdefault(instance_zone(instance_json), []).append(
+            instance_json['name'])
+
+    def run_in_zone(zone, names):
+        zone_args = copy.copy(args)
+        zone_args.zone = zone
+        try:
+            gcloud_compute(zone_args, cmd + ['--zone', zone] + names)
+        finally:
+            for name in names:
+                invalidate_instance_record(zone_args, name)
+        if on_success:
+            for name in names:
+                on_success(zone_args, name)
+
+    run_concurrently(
+        dict((zone, lambda zone=zone, names=names: run_in_zone(zone, names))
+             for zone, names in names_by_zone.items()),
+        max_workers=_MAX_CONCURRENT_ZONES)
+
+
 def print_warning_messages(args):
     """Return whether or not warning messages should be printed.
 
@@ -402,3 +710,116 @@ def print_debug_messages(args):
           debug messages.
     """
     return args.verbosity == 'debug'
+
+
+def format_bytes(count):
+    """Format a number of bytes for display, e.g. as '1.5 MB'."""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if count < 1024:
+            break
+        count /= 1024.0
+    return '{0:.1f} {1}'.format(count, unit)
+
+
+def run_tasks(tasks, max_workers=None):
+    """Run functions concurrently, respecting the dependencies between them.
+
+    Each task is started, in its own thread, as soon as all of the tasks
+    that it depends on have finished successfully. A task whose
+    dependency failed is never started.
+
+    Args:
+      tasks: A dictionary mapping task names to tuples of a function and
+        the list of names of the tasks that it depends on. Each function
+        is called with a dictionary mapping the names of its dependencies
+        to their results.
+      max_workers: The maximum number of tasks to run at once, or None
+        for no limit.
+    Returns:
+      A dictionary mapping each task name to the result of its function.
+    Raises:
+      ValueError: If the dependencies are missing or cyclic.
+      Exception: The first exception raised by any of the functions. This
+        is only raised after all of the running functions have finished.
+    """
+    for name, (unused_fn, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise ValueError(
+                    'Task {} depends on unknown task {}'.format(name, dep))
+
+    results = {}
+    errors = []
+    failed = set()
+    finished = set()
+    running = set()
+    pending = set(tasks)
+    condition = threading.Condition()
+
+    def run_one(name, fn, dep_results):
+        try:
+            result = fn(dep_results)
+            with condition:
+                results[name] = result
+        except Exception as e:
+            with condition:
+                errors.append(e)
+                failed.add(name)
+        finally:
+            with condition:
+                running.discard(name)
+                finished.add(name)
+                condition.notify()
+
+    with condition:
+        while pending or running:
+            for name in sorted(pending):
+                fn, deps = tasks[name]
+                if any(dep in failed for dep in deps):
+                    # Never start a task whose dependency failed.
+                    pending.discard(name)
+                    failed.add(name)
+                    finished.add(name)
+                    continue
+                if not all(dep in finished for dep in deps):
+                    continue
+                if max_workers and len(running) >= max_workers:
+                    break
+                pending.discard(name)
+                running.add(name)
+                dep_results = dict((dep, results[dep]) for dep in deps)
+                thread = threading.Thread(
+                    target=run_one, args=[name, fn, dep_results])
+                thread.daemon = True
+                thread.start()
+            if not running:
+                if pending:
+                    raise ValueError('Cyclic dependencies between the tasks '
+                                     '{}'.format(', '.join(sorted(pending))))
+                break
+            # Wait with a timeout so that the main thread still
+            # receives a KeyboardInterrupt under Python 2.
+            condition.wait(0.1)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run_concurrently(functions, max_workers=None):
+    """Run the given functions concurrently, each in its own thread.
+
+    Args:
+      functions: A dictionary mapping names to functions that take
+        no arguments.
+      max_workers: The maximum number of functions to run at once, or
+        None for no limit.
+    Returns:
+      A dictionary mapping each name to the result of its function.
+    Raises:
+      Exception: The first exception raised by any of the functions. This
+        is only raised after all of the functions have finished.
+    """
+    tasks = dict(
+        (name, (lambda unused_deps, fn=fn: fn(), []))
+        for name, fn in functions.items())
+    return run_tasks(tasks, max_workers=max_workers)
@@ -0,0 +1,247 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Methods for implementing the `datalab wait` command."""
+
+from __future__ import absolute_import
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+from . import computeapi, inventory, localstate, utils
+
+
+description = ("""`{0} {1}` waits for the Datalab instances whose creation
+was started with `{0} create --async` to finish being created.
+
+The pending operations of all of the instances are polled together, and
+the completion of each instance is reported as soon as it happens.""")
+
+
+examples = ("""
+To start creating two instances, and then wait for both of them:
+
+    $ {0} create --async --no-connect first-instance
+    $ {0} create --async --no-connect second-instance
+    $ {0} {1}
+
+To only wait for one of them:
+
+    $ {0} {1} first-instance
+""")
+
+
+_TIMEOUT_HELP = ("""The maximum number of seconds to wait for. If some
+instances are still being created when this runs out, then they can be
+waited for again later.""")
+
+
+_OPERATIONS_FILE = 'operations.json'
+
+_POLL_INITIAL_SECONDS = 1
+_POLL_MAX_SECONDS = 10
+
+# Maximum number of operations that are polled at once.
+_MAX_CONCURRENT_POLLS = 8
+
+# Stands in for an operation whose state could not be checked, e.g.
+# because of a network or authentication error, so that it is polled
+# again in the next round.
+_UNCHECKED_OPERATION = {'status': 'UNKNOWN'}
+
+
+class OperationsFailedException(Exception):
+
+    _MESSAGE = 'Creating the following instances failed: {}'
+
+    def __init__(self, instances):
+        super(OperationsFailedException, self).__init__(
+            OperationsFailedException._MESSAGE.format(', '.join(instances)))
+
+
+def _operations_path():
+    return os.path.join(localstate.datalab_config_dir(), _OPERATIONS_FILE)
+
+
+def record_operation(args, instance, operation):
+    """Record a pending operation so that it can be waited for later.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      instance: The name of the instance that the operation creates
+      operation: The decoded operation resource returned by gcloud
+    Raises:
+      IOError: If the operation cannot be recorded
+      OSError: If the operation cannot be recorded
+    """
+    entry = {
+        'operation': operation['name'],
+        'zone': utils.instance_zone(operation),
+        'started': time.time(),
+    }
+
+    def update(contents):
+        contents.setdefault(inventory.project_key(args), {})[instance] = entry
+
+    localstate.update_json_file(_operations_path(), update)
+
+
+def pending_operations(args):
+    """Get the recorded operations of the current project.
+
+    Args:
+      args: The Namespace instance returned by argparse
+    Returns:
+      A dictionary mapping instance names to their recorded operations.
+    """
+    contents = localstate.read_json_file(_operations_path(), default={})
+    if not isinstance(contents, dict):
+        return {}
+    return contents.get(inventory.project_key(args), {})
+
+
+def _forget_operation(args, instance):
+    def update(contents):
+        contents.get(inventory.project_key(args), {}).pop(instance, None)
+
+    try:
+        localstate.update_json_file(_operations_path(), update)
+    except (IOError, OSError):
+        pass
+
+
+def flags(parser):
+    """Add command line flags for the `wait` subcommand.
+
+    Args:
+      parser: The argparse parser to which to add the flags.
+    """
+    parser.add_argument(
+        'instances',
+        metavar='NAME',
+        nargs='*',
+        help='names of the instances to wait for (default: all of them)')
+    parser.add_argument(
+        '--timeout',
+        dest='timeout',
+        type=int,
+        default=None,
+        help=_TIMEOUT_HELP)
+    return
+
+
+def _describe_operation(args, gcloud_compute, entry):
+    """Fetch the current state of a recorded operation.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+      entry: The recorded operation
+    Returns:
+      The decoded operation resource, None if the operation no longer
+      exists, or _UNCHECKED_OPERATION if it could not be fetched.
+    """
+    cmd = ['operations', 'describe', '--quiet', '--zone', entry['zone'],
+           '--format', 'json', entry['operation']]
+    with tempfile.TemporaryFile() as stdout, \
+            tempfile.TemporaryFile() as stderr:
+        try:
+            gcloud_compute(args, cmd, stdout=stdout, stderr=stderr)
+            stdout.seek(0)
+            return json.loads(stdout.read().decode('utf-8'))
+        except subprocess.CalledProcessError:
+            if utils.reported_not_found(stderr):
+                return None
+            return _UNCHECKED_OPERATION
+        except ValueError:
+            return _UNCHECKED_OPERATION
+
+
+def run(args, gcloud_compute, **unused_kwargs):
+    """Implementation of the `datalab wait` subcommand.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      gcloud_compute: Function that can be used to invoke `gcloud compute`
+    Raises:
+      OperationsFailedException: If creating any of the instances failed
+    """
+    pending = pending_operations(args)
+    if args.instances:
+        for instance in args.instances:
+            if instance not in pending:
+                print('There is no pending operation for {}'.format(
+                    instance))
+        pending = dict((instance, entry)
+                       for instance, entry in pending.items()
+                       if instance in args.instances)
+    if not pending:
+        print('There are no pending operations.')
+        return
+
+    print('Waiting for {0}'.format(', '.join(sorted(pending))))
+    deadline = None
+    if args.timeout is not None:
+        deadline = time.time() + args.timeout
+    delay = _POLL_INITIAL_SECONDS
+    failed = []
+    unchecked = set()
+    while pending:
+        operations = utils.run_concurrently(
+            dict((instance, lambda entry=entry: _describe_operation(
+                args, gcloud_compute, entry))
+                 for instance, entry in pending.items()),
+            max_workers=_MAX_CONCURRENT_POLLS)
+        for instance in sorted(operations):
+            operation = operations[instance]
+            zone = pending[instance]['zone']
+            if operation is None:
+                # Operations are only kept for a limited time, so this
+                # one may have been garbage collected.
+                print('Could not check on {}; run `datalab list` to see '
+                      'its status.'.format(instance))
+            elif operation is _UNCHECKED_OPERATION:
+                if instance not in unchecked:
+                    print('Could not check on {}; will try again.'.format(
+                        instance))
+                    unchecked.add(instance)
+                continue
+            elif operation.get('status') != 'DONE':
+                continue
+            elif computeapi.operation_error(operation):
+                print('Creating {} failed:\n{}'.format(
+                    instance, computeapi.operation_error(operation)))
+                failed.append(instance)
+            else:
+                print('{} is ready in {}'.format(instance, zone))
+                inventory.record_instance(args, instance, zone, 'RUNNING')
+            utils.invalidate_instance_record(args, instance)
+            _forget_operation(args, instance)
+            del pending[instance]
+
+        if not pending:
+            break
+        if deadline is not None and time.time() + delay > deadline:
+            print('Timed out while waiting for {}'.format(
+                ', '.join(sorted(pending))))
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, _POLL_MAX_SECONDS)
+
+    if failed:
+        raise OperationsFailedException(failed)
+    return
@@ -21,7 +21,9 @@ This tool is specific to the use case of running in the Google Cloud Platform.
 
 from __future__ import absolute_import
 
-from commands import create, creategpu, connect, list, stop, delete, utils
+from commands import (
+    apply, bakeimage, cache, computeapi, cp, create, creategpu, connect,
+    list, portforward, resize, snapshot, stop, delete, tunnels, utils, wait)
 
 import argparse
 import json
@@ -46,6 +48,7 @@ _SUBCOMMANDS = {
     'connect': {
         'help': 'Connect to an existing Datalab instance',
         'description': connect.description,
+        'examples': connect.examples,
         'flags': connect.flags,
         'run': connect.run,
         'require-zone': True,
@@ -59,19 +62,85 @@ _SUBCOMMANDS = {
         'require-zone': False,
     },
     'stop': {
-        'help': 'Stop an existing Datalab instance',
+        'help': 'Stop one or more existing Datalab instances',
         'description': stop.description,
+        'examples': stop.examples,
         'flags': stop.flags,
         'run': stop.run,
-        'require-zone': True,
+        'require-zone': False,
     },
     'delete': {
-        'help': 'Delete an existing Datalab instance',
+        'help': 'Delete one or more existing Datalab instances',
         'description': delete.description,
+        'examples': delete.examples,
         'flags': delete.flags,
         'run': delete.run,
+        'require-zone': False,
+    },
+    'resize': {
+        'help': 'Change the machine type or disk size of a Datalab instance',
+        'description': resize.description,
+        'examples': resize.examples,
+        'flags': resize.flags,
+        'run': resize.run,
+        'require-zone': True,
+    },
+    'snapshot': {
+        'help': 'Snapshot the notebooks disks of Datalab instances',
+        'description': snapshot.description,
+        'examples': snapshot.examples,
+        'flags': snapshot.flags,
+        'run': snapshot.run,
+        'require-zone': False,
+    },
+    'apply': {
+        'help': 'Make the Datalab instances match a fleet file',
+        'description': apply.description,
+        'examples': apply.examples,
+        'flags': apply.flags,
+        'run': apply.run,
+        'require-zone': True,
+    },
+    'bake-image': {
+        'help': 'Save a boot image with the Datalab image preloaded',
+        'description': bakeimage.description,
+        'examples': bakeimage.examples,
+        'flags': bakeimage.flags,
+        'run': bakeimage.run,
+        'require-zone': True,
+    },
+    'cp': {
+        'help': 'Copy files to and from the notebooks disk of an instance',
+        'description': cp.description,
+        'examples': cp.examples,
+        'flags': cp.flags,
+        'run': cp.run,
+        'require-zone': True,
+    },
+    'port-forward': {
+        'help': 'Forward more ports over a connection to a Datalab instance',
+        'description': portforward.description,
+        'examples': portforward.examples,
+        'flags': portforward.flags,
+        'run': portforward.run,
         'require-zone': True,
     },
+    'tunnels': {
+        'help': 'Manage the tunnels kept open by the tunnel agent',
+        'description': tunnels.description,
+        'examples': tunnels.examples,
+        'flags': tunnels.flags,
+        'run': tunnels.run,
+        'require-zone': True,
+    },
+    'wait': {
+        'help': 'Wait for asynchronously created Datalab instances',
+        'description': wait.description,
+        'examples': wait.examples,
+        'flags': wait.flags,
+        'run': wait.run,
+        'require-zone': False,
+    },
 }
 
 _BETA_SUBCOMMANDS = {
@@ -112,6 +181,16 @@ environment variable CLOUDSDK_COMPUTE_ZONE.
 """)
 
 
+_COMPUTE_BACKEND_HELP = ("""How to run Compute Engine commands.
+
+With "api" (the default), commands are issued directly against the
+Compute Engine API using the credentials of the active gcloud
+account. Any command that cannot be issued that way is run using
+`gcloud compute` instead.
+
+With "gcloud", every command is run using `gcloud compute`.""")
+
+
 # Name of the core Cloud SDK component as reported by gcloud
 sdk_core_component = 'Google Cloud SDK'
 
@@ -125,20 +204,79 @@ version_issues_url = (
     'https://storage.googleapis.com/cloud-datalab/version-issues.js')
 
 
-try:
-    with open(os.devnull, 'w') as dn:
-        subprocess.call(['gcloud', '--version'], stderr=dn, stdout=dn)
-    gcloud_cmd = 'gcloud'
-except Exception:
-    gcloud_cmd = 'gcloud.cmd'
+# Timeout, in seconds, for downloading the known version issues.
+_VERSION_ISSUES_TIMEOUT_SECONDS = 10
+
+
+# Time-to-live, in seconds, of each value in the session cache.
+#
+# Every cached value is also discarded whenever the gcloud
+# configuration (active account, properties, or credentials) changes.
+_VERSIONS_TTL_SECONDS = 24 * 60 * 60
+_ACCOUNT_TTL_SECONDS = 60 * 60
+_PROPERTIES_TTL_SECONDS = 60 * 60
+_VERSION_ISSUES_TTL_SECONDS = 6 * 60 * 60
+
+
+def find_gcloud_cmd():
+    """Find the command to use for invoking gcloud.
+
+    This searches the PATH rather than running gcloud, since starting
+    gcloud takes a noticeable amount of time.
+
+    Returns:
+      Either 'gcloud' or, if that is not runnable, 'gcloud.cmd'.
+    """
+    names = ['gcloud']
+    if os.name == 'nt':
+        # On Windows the extension-less `gcloud` is a bash script.
+        names = ['gcloud.exe']
+    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+        for name in names:
+            path = os.path.join(path_dir, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return 'gcloud'
+    return 'gcloud.cmd'
+
+
+gcloud_cmd = find_gcloud_cmd()
+
 
+def get_component_versions():
+    """Get the versions of the installed Cloud SDK components.
 
-def report_known_issues(sdk_version, datalab_version):
+    Returns:
+      A dictionary mapping component names to their versions.
+    Raises:
+      subprocess.CalledProcessError: If the gcloud command fails
+    """
+    gcloud_version_json = subprocess.check_output([
+        gcloud_cmd, 'version', '--format=json']).decode('utf-8').strip()
+    return json.loads(gcloud_version_json)
+
+
+def get_version_issues():
+    """Download the list of known issues for each released version.
+
+    Returns:
+      The decoded contents of the version issues file, or None if
+      it could not be downloaded.
+    """
     try:
-        version_issues_resp = urlopen(version_issues_url)
-        version_issues = json.loads(version_issues_resp.read().decode('utf-8'))
+        version_issues_resp = urlopen(
+            version_issues_url, timeout=_VERSION_ISSUES_TIMEOUT_SECONDS)
+        return json.loads(version_issues_resp.read().decode('utf-8'))
     except HTTPError as e:
         print('Error downloading the version information: {}'.format(e))
+    except Exception:
+        # Failing to check for known issues (e.g. when offline)
+        # should not prevent the command from running.
+        pass
+    return None
+
+
+def report_known_issues(sdk_version, datalab_version, version_issues):
+    if not version_issues:
         return
 
     sdk_issues = version_issues.get(sdk_core_component, {})
@@ -259,16 +397,75 @@ def get_email_address():
         'value(account)', '--filter', 'status:ACTIVE']).decode('utf-8').strip()
 
 
-def get_gcloud_zone():
-    """Get the zone (if any) that gcloud is configured to use.
+def get_gcloud_properties():
+    """Get the project and zone (if any) that gcloud is configured to use.
 
     Returns:
-      The name of the zone gcloud is configured to use.
+      A dictionary with the keys 'project' and 'zone'.
     """
-    return subprocess.check_output([
+    properties = json.loads(subprocess.check_output([
         gcloud_cmd, 'config', 'config-helper', '--format',
-        'value(configuration.properties.compute.zone)']).decode(
-            'utf-8').strip()
+        'json(configuration.properties.core.project,'
+        'configuration.properties.compute.zone)']).decode('utf-8'))
+    properties = properties.get('configuration', {}).get('properties', {})
+    return {
+        'project': properties.get('core', {}).get('project', ''),
+        'zone': properties.get('compute', {}).get('zone', ''),
+    }
+
+
+def gather_session_info(args, session_cache, require_zone=False):
+    """Look up the information about the local environment used by commands.
+
+    This covers the installed component versions, the active account,
+    the configured project and zone, and the known issues with the
+    installed versions.
+
+    Each of these is served from the per-user session cache when possible,
+    and the ones that are missing are looked up concurrently.
+
+    Args:
+      args: The Namespace instance returned by argparse
+      session_cache: The cache.SessionCache instance to use
+      require_zone: Whether or not the configured zone is needed
+    Returns:
+      A dictionary with the keys 'sdk-version', 'datalab-version',
+      'email', 'gcloud-project', 'gcloud-zone', and 'version-issues'.
+      The 'gcloud-zone' value is empty unless `require_zone` is set.
+    Raises:
+      subprocess.CalledProcessError: If a nested `gcloud` call fails
+    """
+    probes = {
+        'component-versions': lambda: session_cache.get_or_compute(
+            'component-versions', _VERSIONS_TTL_SECONDS,
+            get_component_versions),
+        'email': lambda: session_cache.get_or_compute(
+            'email', _ACCOUNT_TTL_SECONDS, get_email_address),
+        'gcloud-properties': lambda: session_cache.get_or_compute(
+            'gcloud-properties', _PROPERTIES_TTL_SECONDS,
+            get_gcloud_properties),
+    }
+    if utils.print_warning_messages(args):
+        probes['version-issues'] = lambda: session_cache.get_or_compute(
+            'version-issues', _VERSION_ISSUES_TTL_SECONDS,
+            get_version_issues)
+    try:
+        results = utils.run_concurrently(probes)
+    finally:
+        session_cache.save()
+
+    component_versions = results['component-versions']
+    gcloud_properties = results['gcloud-properties']
+    return {
+        'sdk-version': component_versions.get(sdk_core_component, 'UNKNOWN'),
+        'datalab-version': component_versions.get(
+            datalab_component, 'UNKNOWN'),
+        'email': results['email'],
+        'gcloud-project': gcloud_properties['project'] or '',
+        'gcloud-zone': (
+            gcloud_properties['zone'] or '' if require_zone else ''),
+        'version-issues': results.get('version-issues'),
+    }
 
 
 def add_sub_parser(subcommand, command_config, subparsers, prog):
@@ -357,6 +554,12 @@ def run():
         dest='top_level_diagnose_me',
         action='store_true',
         help='Print additional information for diagnosing issues.')
+    parser.add_argument(
+        '--compute-backend',
+        dest='compute_backend',
+        choices=['api', 'gcloud'],
+        default='api',
+        help=_COMPUTE_BACKEND_HELP)
 
     subparsers = parser.add_subparsers(dest='subcommand')
     subparsers.required = True
@@ -385,38 +588,48 @@ def run():
     if args.diagnose_me is None:
         args.diagnose_me = args.top_level_diagnose_me
 
-    gcloud_version_json = subprocess.check_output([
-        gcloud_cmd, 'version', '--format=json']).decode('utf-8').strip()
-    component_versions = json.loads(gcloud_version_json)
-    sdk_version = component_versions.get(sdk_core_component, 'UNKNOWN')
-    datalab_version = component_versions.get(datalab_component, 'UNKNOWN')
-
-    if args.diagnose_me:
-        if args.verbosity is 'default':
-            args.verbosity = 'debug'
-        print('Running with diagnostic messages enabled')
-        print('Using the command "{}" to invoke gcloud'.format(gcloud_cmd))
-        print('The installed gcloud version is:'
-              '\n\tCloud SDK: {}\n\tDatalab: {}'.format(
-                  sdk_version, datalab_version))
-
-    if utils.print_warning_messages(args):
-        report_known_issues(sdk_version, datalab_version)
+    if args.diagnose_me and args.verbosity == 'default':
+        args.verbosity = 'debug'
 
-    gcloud_zone = ""
+    api_version = 'v1'
     if args.subcommand == 'beta':
         subcommand = _BETA_SUBCOMMANDS[args.beta_subcommand]
         compute = gcloud_beta_compute
+        api_version = 'beta'
     else:
         subcommand = _SUBCOMMANDS[args.subcommand]
+    session_cache = cache.session_cache(gcloud_cmd)
+    if args.compute_backend == 'api':
+        compute = computeapi.ComputeBackend(
+            compute, gcloud_cmd, session_cache=session_cache,
+            api_version=api_version)
     try:
-        if subcommand['require-zone']:
-            gcloud_zone = get_gcloud_zone()
+        session = gather_session_info(
+            args, session_cache, require_zone=subcommand['require-zone'])
+        sdk_version = session['sdk-version']
+        # The default project is used to key the local instance inventory.
+        args.gcloud_project = session['gcloud-project']
+        datalab_version = session['datalab-version']
+
+        if args.diagnose_me:
+            print('Running with diagnostic messages enabled')
+            print('Using the command "{}" to invoke gcloud'.format(
+                gcloud_cmd))
+            print('Using the "{}" backend for Compute Engine commands'.format(
+                args.compute_backend))
+            print('The installed gcloud version is:'
+                  '\n\tCloud SDK: {}\n\tDatalab: {}'.format(
+                      sdk_version, datalab_version))
+
+        if utils.print_warning_messages(args):
+            report_known_issues(
+                sdk_version, datalab_version, session['version-issues'])
+
         subcommand['run'](
             args, compute, gcloud_repos=gcloud_repos,
-            email=get_email_address(),
+            email=session['email'],
             in_cloud_shell=('DEVSHELL_CLIENT_PORT' in os.environ),
-            gcloud_zone=gcloud_zone,
+            gcloud_zone=session['gcloud-zone'],
             sdk_version=sdk_version, datalab_version=datalab_version)
     except subprocess.CalledProcessError as e:
         if utils.print_debug_messages(args):
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the GPU availability checks against a local fake of
+# the Compute Engine API.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import accelerators  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestAccelerators(fake_compute.ComputeApiTestCase):
+    def test_accelerator_availability(self):
+        self.api.accelerator_types = {
+            ('us-central1-a', 'nvidia-tesla-k80'): 8,
+            ('us-central1-b', 'nvidia-tesla-v100'): 8,
+            ('us-east1-c', 'nvidia-tesla-v100'): 8,
+            ('europe-west1-b', 'nvidia-tesla-v100'): 8,
+            ('us-west1-a', 'nvidia-tesla-v100'): 2,
+        }
+        self.args.zone = 'us-central1-a'
+        accelerators.check_availability(
+            self.args, self.compute, 'nvidia-tesla-k80', 4)
+        with self.assertRaises(
+                accelerators.UnavailableAcceleratorException) as raised:
+            accelerators.check_availability(
+                self.args, self.compute, 'nvidia-tesla-v100', 4)
+        self.assertIn(
+            'us-central1-b, us-east1-c, europe-west1-b',
+            str(raised.exception))
+        # The catalog is only fetched once.
+        self.assertEqual(1, len(self.api.requests))
+        self.assertEqual([], self.fallback_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the background tunnel agent, using a stand-in for
+# ssh and a local fake of the Compute Engine API.
+
+import copy
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import agent, tunnel  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+_PROJECT = fake_compute.PROJECT
+
+
+class TestAgent(fake_compute.ComputeApiTestCase):
+    @unittest.skipUnless(tunnel.multiplexing_supported(),
+                         'requires OpenSSH')
+    def test_tunnel_agent(self):
+        self.api.add_instance('us-central1-a', 'inst-a')
+        self.api.add_instance('europe-west1-b', 'inst-b')
+        ssh_log = self.fake_ssh()
+        self.args.ssh_log_level = 'error'
+        self.args.tunnel_profile = 'wan'
+        tunnel_agent = agent.Agent(self.args, self.compute)
+        server_thread = threading.Thread(
+            target=tunnel_agent.serve, args=[agent.socket_path()])
+        server_thread.start()
+        try:
+            for _ in range(100):
+                if agent.is_running():
+                    break
+                threading.Event().wait(0.05)
+            # The agent cannot open a tunnel without gcloud until it has
+            # had a master to the instance.
+            self.assertIsNone(agent.call(
+                'open', instance='inst-a', project=_PROJECT,
+                zone='us-central1-a')['via'])
+
+            # So the client opens the master and hands it over, resolving
+            # the project itself.
+            client_args = copy.copy(self.args)
+            client_args.project = None
+            client_args.gcloud_project = _PROJECT
+            client_args.zone = 'us-central1-a'
+            opened = [agent.open_tunnel(client_args, self.compute, 'inst-a')]
+            client_args.zone = 'europe-west1-b'
+            client_args.tunnel_profile = 'lowbandwidth'
+            opened.append(
+                agent.open_tunnel(client_args, self.compute, 'inst-b'))
+            with open(ssh_log) as f:
+                opens = [line for line in f if 'ControlMaster=yes' in line]
+            self.assertIn('Compression=no', opens[0])
+            self.assertIn('Compression=yes', opens[1])
+            self.assertIn('ServerAliveInterval=15', opens[1])
+            self.assertEqual([tunnel.VIA_MASTER] * 2,
+                             [t['via'] for t in opened])
+            self.assertEqual([_PROJECT] * 2, [t['project'] for t in opened])
+            self.assertNotEqual(opened[0]['port'], opened[1]['port'])
+            listed = agent.call('list')
+            self.assertEqual(['inst-a', 'inst-b'],
+                             sorted(t['instance'] for t in listed))
+
+            # Closing a foreground tunnel that shares the agent's master
+            # leaves the master running.
+            foreground = tunnel.Tunnel(client_args, self.compute, 'inst-b', [])
+            self.assertEqual(tunnel.VIA_MASTER, foreground.open())
+            foreground.close()
+            self.assertTrue(foreground.master_alive())
+
+            # The agent reopens the masters handed over to it directly.
+            foreground._control('exit')
+            self.assertEqual(tunnel.VIA_DIRECT, tunnel_agent._tunnels[
+                agent.tunnel_key(_PROJECT, 'europe-west1-b', 'inst-b')][
+                    'tunnel'].open(use_gcloud=False))
+
+            agent.call('close', instance='inst-a', project=_PROJECT,
+                       zone='us-central1-a')
+            self.assertEqual(['inst-b'],
+                             [t['instance'] for t in agent.call('list')])
+            client_args.zone = 'us-central1-a'
+            self.assertFalse(tunnel.Tunnel(
+                client_args, self.compute, 'inst-a', []).master_alive())
+            with self.assertRaises(agent.AgentRequestException):
+                agent.call('bogus')
+        finally:
+            self.assertEqual({'closed': 1}, agent.call('shutdown'))
+            server_thread.join()
+        self.assertFalse(agent.is_running())
+        self.assertEqual(['ssh', 'ssh'], [c[0] for c in self.fallback_calls])
+
+
+if __name__ == '__main__':
+    unittest.main()
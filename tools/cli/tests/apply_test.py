@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `apply` command against a local fake of the
+# Compute Engine API.
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import apply  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestApply(fake_compute.ComputeApiTestCase):
+    def apply_fleet(self, fleet):
+        with tempfile.NamedTemporaryFile(
+                mode='w', suffix='.json', delete=False) as fleet_file:
+            json.dump(fleet, fleet_file)
+        self.addCleanup(os.remove, fleet_file.name)
+        self.args.file = fleet_file.name
+        self.args.dry_run = False
+        self.args.prune = False
+        self.args.max_concurrency = 4
+        apply.run(self.args, self.compute, gcloud_repos=None)
+
+    def test_apply_unchanged_fleet(self):
+        self.api.add_instance('us-central1-a', 'alice')
+        self.api.disks[('us-central1-a', 'alice-pd')] = {
+            'name': 'alice-pd', 'sizeGb': '200'}
+        self.api.networks['datalab-network'] = {'name': 'datalab-network'}
+        self.apply_fleet({
+            'defaults': {'zone': 'us-central1-a'},
+            'instances': [{'name': 'alice'}],
+        })
+        self.assertEqual(
+            ['GET', 'GET', 'GET'], [m for m, _ in self.api.requests])
+        self.assertEqual([], self.fallback_calls)
+
+    def test_apply_default_disk_size(self):
+        self.api.add_instance('us-central1-a', 'alice')
+        live_instances = list(self.api.instances.values())
+        live_disks = [{'name': 'alice-pd', 'zone': 'us-central1-a',
+                       'sizeGb': '500'}]
+        live_networks = [{'name': 'datalab-network'}]
+        desired = {'alice': {'zone': 'us-central1-a'}}
+        self.assertEqual(([], {}, []), apply._plan(
+            self.args, desired, live_instances, live_disks, live_networks,
+            False, None))
+        desired['alice']['disk-size-gb'] = 300
+        _, _, warnings = apply._plan(
+            self.args, desired, live_instances, live_disks, live_networks,
+            False, None)
+        self.assertEqual(
+            ['the disk alice-pd is larger than 300GB, and cannot be shrunk'],
+            warnings)
+
+    def test_apply_default_machine_type(self):
+        self.api.add_instance('us-central1-a', 'alice')
+        instance = self.api.instances[('us-central1-a', 'alice')]
+        instance['machineType'] = instance['machineType'].replace(
+            'n1-standard-1', 'n1-highmem-8')
+        live_instances = list(self.api.instances.values())
+        live_disks = [{'name': 'alice-pd', 'zone': 'us-central1-a',
+                       'sizeGb': '200'}]
+        live_networks = [{'name': 'datalab-network'}]
+        desired = {'alice': {'zone': 'us-central1-a'}}
+        self.assertEqual(([], {}, []), apply._plan(
+            self.args, desired, live_instances, live_disks, live_networks,
+            False, None))
+
+    def test_apply_changed_fleet(self):
+        self.api.add_instance('us-central1-a', 'alice')
+        self.api.add_instance('us-central1-a', 'carol')
+        self.api.disks[('us-central1-a', 'alice-pd')] = {
+            'name': 'alice-pd', 'sizeGb': '200'}
+        self.api.networks['datalab-network'] = {'name': 'datalab-network'}
+        self.apply_fleet({
+            'defaults': {'zone': 'us-central1-a',
+                         'no-create-repository': True},
+            'instances': [
+                {'name': 'alice', 'disk-size-gb': 500,
+                 'status': 'TERMINATED'},
+                {'name': 'bob'},
+            ],
+            'prune': True,
+        })
+        self.assertEqual(
+            'TERMINATED',
+            self.api.instances[('us-central1-a', 'alice')]['status'])
+        self.assertNotIn(('us-central1-a', 'carol'), self.api.instances)
+        self.assertIn(('us-central1-a', 'bob-pd'), self.api.disks)
+        self.assertEqual(
+            '500', self.api.disks[('us-central1-a', 'alice-pd')]['sizeGb'])
+        fallback_commands = sorted(
+            [c for c in cmd if c != '--quiet'][:2]
+            for cmd in self.fallback_calls)
+        self.assertEqual([['instances', 'create']], fallback_commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
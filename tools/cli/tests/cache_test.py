@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the per-user session cache, and that changes to the
+# gcloud configuration, credentials or environment invalidate it.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import cache  # noqa: E402
+
+
+class FakeClock(object):
+    """Stands in for the `time` module, with a time that tests control."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+class TestSessionCache(unittest.TestCase):
+    def setUp(self):
+        self.gcloud_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.gcloud_dir)
+        self.cache_path = os.path.join(self.gcloud_dir, 'session-cache.json')
+        saved_env = dict((name, os.environ.pop(name, None))
+                         for name in cache._GCLOUD_CONFIG_ENV_VARS)
+        self.addCleanup(self.restore_env, saved_env)
+        os.environ['CLOUDSDK_CONFIG'] = self.gcloud_dir
+        os.makedirs(os.path.join(self.gcloud_dir, 'configurations'))
+        for name in ['active_config', 'credentials.db', 'access_tokens.db',
+                     os.path.join('configurations', 'config_default'),
+                     os.path.join('configurations', 'config_work')]:
+            self.touch(name, 1000)
+        self.clock = FakeClock()
+        self.addCleanup(setattr, cache, 'time', time)
+        cache.time = self.clock
+
+    def restore_env(self, saved_env):
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def touch(self, name, mtime):
+        path = os.path.join(self.gcloud_dir, name)
+        with open(path, 'a'):
+            pass
+        os.utime(path, (mtime, mtime))
+
+    def load(self):
+        return cache.SessionCache(
+            self.cache_path, cache.gcloud_config_fingerprint('gcloud'))
+
+    def save(self, key, value):
+        session_cache = self.load()
+        session_cache.put(key, value)
+        session_cache.save()
+
+    def test_persisted(self):
+        self.save('email', 'a@b.c')
+        self.assertEqual('a@b.c', self.load().get('email', 60))
+
+    def test_ttl_expiry(self):
+        self.save('email', 'a@b.c')
+        self.clock.now += 30
+        self.assertEqual('a@b.c', self.load().get('email', 60))
+        self.assertIsNone(self.load().get('email', 10))
+        self.clock.now += 60
+        self.assertIsNone(self.load().get('email', 60))
+
+        # An entry from the future, e.g. after the clock was turned
+        # back, is not trusted either.
+        self.clock.now -= 600
+        self.assertIsNone(self.load().get('email', 60))
+
+    def test_get_or_compute(self):
+        session_cache = self.load()
+        calls = []
+
+        def compute():
+            calls.append(None)
+            return len(calls) if len(calls) > 1 else None
+
+        self.assertIsNone(session_cache.get_or_compute('n', 60, compute))
+        self.assertEqual(2, session_cache.get_or_compute('n', 60, compute))
+        self.assertEqual(2, session_cache.get_or_compute('n', 60, compute))
+        self.assertEqual(2, len(calls))
+
+    def test_active_config_change(self):
+        self.save('email', 'a@b.c')
+        self.touch('active_config', 2000)
+        self.assertIsNone(self.load().get('email', 60))
+
+    def test_configuration_change(self):
+        self.save('email', 'a@b.c')
+        self.touch(os.path.join('configurations', 'config_work'), 2000)
+        self.assertIsNone(self.load().get('email', 60))
+
+    def test_credentials_change(self):
+        self.save('email', 'a@b.c')
+        self.touch('credentials.db', 2000)
+        self.assertIsNone(self.load().get('email', 60))
+
+    def test_access_token_refresh(self):
+        self.save('email', 'a@b.c')
+        self.touch('access_tokens.db', 2000)
+        self.assertEqual('a@b.c', self.load().get('email', 60))
+
+    def test_environment_change(self):
+        self.save('project', 'first')
+        os.environ['CLOUDSDK_CORE_PROJECT'] = 'second'
+        self.assertIsNone(self.load().get('project', 60))
+        self.save('project', 'second')
+        self.assertEqual('second', self.load().get('project', 60))
+        del os.environ['CLOUDSDK_CORE_PROJECT']
+        self.assertIsNone(self.load().get('project', 60))
+
+    def test_gcloud_command_change(self):
+        self.save('email', 'a@b.c')
+        self.assertIsNone(cache.SessionCache(
+            self.cache_path,
+            cache.gcloud_config_fingerprint('gcloud.cmd')).get('email', 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
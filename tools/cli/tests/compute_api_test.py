@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the in-process Compute Engine API backend against a
+# local fake of the Compute Engine API, so it needs neither gcloud nor
+# a GCP project.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import utils  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+_ZONES = fake_compute.ZONES
+
+
+class TestComputeApi(fake_compute.ComputeApiTestCase):
+    def test_describe_instance(self):
+        self.api.add_instance(
+            'us-central1-a', 'inst', metadata={'for-user': 'a@b.c'})
+        self.args.zone = 'us-central1-a'
+        status, metadata = utils.describe_instance(
+            self.args, self.compute, 'inst')
+        self.assertEqual('RUNNING', status)
+        self.assertEqual({'for-user': 'a@b.c'}, metadata)
+        self.assertEqual([], self.fallback_calls)
+
+    def test_instance_record_shared(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        self.args.zone = 'us-central1-a'
+        utils.maybe_prompt_for_zone(self.args, self.compute, 'inst')
+        utils.describe_instance(self.args, self.compute, 'inst')
+        disk = utils.instance_notebook_disk(self.args, self.compute, 'inst')
+        self.assertFalse(disk['autoDelete'])
+        self.assertEqual(1, len(self.api.requests))
+
+        # Modifying the instance forces the next describe to fetch it.
+        self.compute(self.args, [
+            'instances', 'stop', '--zone', 'us-central1-a', 'inst'],
+            stderr=self.stderr)
+        utils.invalidate_instance_record(self.args, 'inst')
+        status, _ = utils.describe_instance(self.args, self.compute, 'inst')
+        self.assertEqual('TERMINATED', status)
+
+    def test_projected_json(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        result = json.loads(self.run_compute([
+            'instances', 'describe', '--zone', 'us-central1-a',
+            '--format', 'json(status,tags.items)', 'inst']))
+        self.assertEqual(
+            {'status': 'RUNNING', 'tags': {'items': ['datalab']}}, result)
+
+    def test_list_with_filter(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        self.api.add_instance('europe-west1-b', 'other')
+        zones = self.run_compute([
+            'instances', 'list', '--quiet', '--filter', 'name=inst',
+            '--format', 'value(zone)'])
+        self.assertEqual('us-central1-a\n', zones)
+        names = self.run_compute([
+            'instances', 'list', '--filter',
+            "(tags.items='datalab') (zone:(europe-west1-b))",
+            '--format=value(name)'])
+        self.assertEqual('other\n', names)
+
+    def test_zones_list(self):
+        zones = self.run_compute(
+            ['zones', '--quiet', 'list', '--format=value(name)'])
+        self.assertEqual(_ZONES, zones.split())
+
+    def test_missing_resource(self):
+        with tempfile.TemporaryFile() as stderr:
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.compute(self.args, [
+                    'instances', 'describe', '--zone', 'us-central1-a',
+                    '--format', 'json', 'missing'], stderr=stderr)
+            stderr.seek(0)
+            self.assertIn('was not found', stderr.read().decode('utf-8'))
+
+    def test_missing_zone(self):
+        self.api.add_instance('europe-west1-b', 'inst')
+        status, _ = utils.describe_instance(self.args, self.compute, 'inst')
+        self.assertEqual('RUNNING', status)
+        self.assertEqual('europe-west1-b', self.args.zone)
+
+    def test_stop_and_start(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        self.compute(self.args, [
+            'instances', 'stop', '--zone', 'us-central1-a', 'inst'],
+            stderr=self.stderr)
+        self.assertEqual(
+            'TERMINATED',
+            self.api.instances[('us-central1-a', 'inst')]['status'])
+        self.compute(self.args, [
+            'instances', 'start', '--zone', 'us-central1-a', 'inst'],
+            stderr=self.stderr)
+        self.assertEqual(
+            'RUNNING',
+            self.api.instances[('us-central1-a', 'inst')]['status'])
+
+    def test_delete_with_disks(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        instance = self.api.instances[('us-central1-a', 'inst')]
+        self.compute(self.args, [
+            'instances', 'delete', '--quiet', '--zone', 'us-central1-a',
+            '--delete-disks', 'data', 'inst'],
+            stderr=self.stderr)
+        self.assertNotIn(('us-central1-a', 'inst'), self.api.instances)
+        self.assertTrue(all(d['autoDelete'] for d in instance['disks']))
+
+    def test_delete_with_other_disks(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        delete_cmds = [
+            ['instances', 'delete', '--quiet', '--zone', 'us-central1-a',
+             flag, disks, 'inst']
+            for flag in ['--delete-disks', '--keep-disks']
+            for disks in ['all', 'boot']]
+        for cmd in delete_cmds:
+            self.compute(self.args, cmd)
+        self.assertEqual(delete_cmds, self.fallback_calls)
+        self.assertEqual([], self.api.requests)
+
+    def test_create_resources_quietly(self):
+        self.args.zone = 'us-central1-a'
+        utils.call_gcloud_quietly(self.args, self.compute, [
+            'disks', 'create', '--zone', 'us-central1-a', '--size', '200GB',
+            '--description', 'notebooks', 'inst-pd'])
+        self.assertEqual(
+            '200', self.api.disks[('us-central1-a', 'inst-pd')]['sizeGb'])
+        utils.call_gcloud_quietly(self.args, self.compute, [
+            'networks', 'create', 'net', '--description', 'network'])
+        self.assertIn('net', self.api.networks)
+        self.assertEqual(
+            'net\n',
+            self.run_compute(['networks', 'describe', '--format',
+                              'value(name)', 'net']))
+
+    def test_fallback(self):
+        ssh_cmd = ['ssh', '--zone', 'us-central1-a', 'datalab@inst']
+        self.compute(self.args, ssh_cmd)
+        table_cmd = ['instances', 'list', '--filter', 'name=inst']
+        self.compute(self.args, table_cmd)
+        create_cmd = ['instances', 'create', '--machine-type', 'n1', 'inst']
+        self.compute(self.args, create_cmd)
+        self.assertEqual([ssh_cmd, table_cmd, create_cmd],
+                         self.fallback_calls)
+        self.assertEqual([], self.api.requests)
+
+    def test_connection_reuse(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        for _ in range(20):
+            self.run_compute([
+                'instances', 'describe', '--zone', 'us-central1-a',
+                '--format', 'value(status)', 'inst'])
+        self.assertEqual(20, len(self.api.requests))
+        self.assertEqual(1, self.api.connections)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the boot progress reporting of the `connect` command
+# against a local fake of the Compute Engine API.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import connect  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestConnect(fake_compute.ComputeApiTestCase):
+    def test_boot_progress(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        instance = self.api.instances[('us-central1-a', 'inst')]
+        instance['serial'] = (
+            'datalab-boot-phase: disk 100\n'
+            'datalab-boot-phase: startup-done 101\n'
+            'Rebooting\n'
+            'datalab-boot-phase: disk 200\n'
+            'datalab-boot-phase: image-pull 230\n')
+        self.args.zone = 'us-central1-a'
+        progress = connect.BootProgress(self.args, self.compute, 'inst')
+        progress.poll()
+        instance['serial'] += (
+            'datalab-boot-phase: swap 240\n'
+            'datalab-boot-phase: tmp-cleanup 245\n'
+            'datalab-boot-phase: container-start 246\n'
+            'datalab-boot-phase: startup-done 247\n')
+        progress.poll()
+        self.assertEqual(
+            [('disk', 30), ('image-pull', 10), ('swap', 5),
+             ('tmp-cleanup', 2), ('container-start', 14)],
+            progress.timings(260))
+        self.assertEqual([], self.fallback_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
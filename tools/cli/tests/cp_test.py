@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `cp` command, using a stand-in for ssh and a
+# local fake of the Compute Engine API.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import cp, tunnel  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestCp(fake_compute.ComputeApiTestCase):
+    @unittest.skipUnless(tunnel.multiplexing_supported(),
+                         'requires OpenSSH')
+    def test_cp_resume(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        ssh_log = self.fake_ssh()
+        content_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, content_dir)
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        self.addCleanup(setattr, cp, '_REMOTE_CONTENT_DIR',
+                        cp._REMOTE_CONTENT_DIR)
+        self.addCleanup(setattr, cp, '_REMOTE_SHELL', cp._REMOTE_SHELL)
+        cp._REMOTE_CONTENT_DIR = content_dir
+        cp._REMOTE_SHELL = 'sh -c'
+        self.addCleanup(os.environ.pop, 'FAKE_SSH_FAIL_MATCH', None)
+
+        # Three 1MB chunks: incompressible, half and half, and zeros.
+        data = os.urandom(1536 * 1024) + b'\0' * (1024 * 1024 + 512)
+        local_path = os.path.join(local_dir, 'data.bin')
+        with open(local_path, 'wb') as f:
+            f.write(data)
+        self.args.ssh_log_level = 'error'
+        self.args.tunnel_profile = 'wan'
+        self.args.chunk_size_mb = 1
+        self.args.streams = 1
+        self.args.compress = 'auto'
+        self.args.source = local_path
+        self.args.destination = 'inst:/content/datasets/'
+        os.makedirs(os.path.join(content_dir, 'datasets'))
+
+        # Interrupt the upload at the third chunk, then resume it.
+        os.environ['FAKE_SSH_FAIL_MATCH'] = 'seek={}'.format(2 * 1024 * 1024)
+        with self.assertRaises(subprocess.CalledProcessError):
+            cp.run(self.args, self.compute)
+        del os.environ['FAKE_SSH_FAIL_MATCH']
+        open(ssh_log, 'w').close()
+        cp.run(self.args, self.compute)
+        with open(ssh_log) as f:
+            sent = [line for line in f if 'oflag=seek_bytes' in line]
+        self.assertEqual(1, len(sent))
+        self.assertIn('gzip -dc', sent[0])
+        remote_path = os.path.join(content_dir, 'datasets', 'data.bin')
+        with open(remote_path, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(['data.bin'],
+                         os.listdir(os.path.join(content_dir, 'datasets')))
+
+        self.args.source = 'inst:datasets/data.bin'
+        self.args.destination = os.path.join(local_dir, 'copy.bin')
+        self.args.compress = 'always'
+        self.args.streams = 3
+        cp.run(self.args, self.compute)
+        with open(self.args.destination, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        self.args.source = 'inst:/etc/passwd'
+        with self.assertRaises(cp.RemotePathException):
+            cp.run(self.args, self.compute)
+        self.args.source = local_path
+        with self.assertRaises(cp.LocationException):
+            cp.run(self.args, self.compute)
+        self.assertEqual(
+            ['ssh'] * 4, [cmd[0] for cmd in self.fallback_calls])
+
+    def test_cp_unsupported(self):
+        self.addCleanup(setattr, tunnel, 'multiplexing_supported',
+                        tunnel.multiplexing_supported)
+        tunnel.multiplexing_supported = lambda: False
+        self.args.source = 'data.bin'
+        self.args.destination = 'inst:datasets/'
+        with self.assertRaises(cp.CopyNotSupportedException):
+            cp.run(self.args, self.compute)
+        self.assertEqual([], self.api.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
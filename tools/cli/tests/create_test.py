@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the preparation and configuration of new instances
+# against a local fake of the Compute Engine API.
+
+import argparse
+import json
+import itertools
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import connect, create, creategpu  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+_PROJECT = fake_compute.PROJECT
+
+
+class TestCreate(fake_compute.ComputeApiTestCase):
+    def test_baked_image(self):
+        self.api.add_instance('us-central1-a', 'datalab-bake-1')
+        instance = self.api.instances[('us-central1-a', 'datalab-bake-1')]
+        instance['serial'] = 'datalab-boot-phase: image-pull 100\n'
+        self.args.zone = 'us-central1-a'
+        progress = connect.BootProgress(
+            self.args, self.compute, 'datalab-bake-1')
+        progress.poll()
+        self.assertFalse(progress.seen('bake-done'))
+        instance['serial'] += 'datalab-boot-phase: bake-done 160\n'
+        progress.poll()
+        self.assertTrue(progress.seen('bake-done'))
+
+        images = {'datalab-baked': {
+            'name': 'datalab-baked-1',
+            'description': create.baked_image_description(
+                'us.gcr.io/cloud-datalab/datalab:latest'),
+        }}
+
+        def gcloud_compute(args, cmd, stdin=None, stdout=None, stderr=None):
+            self.assertEqual(['images', 'describe-from-family'], cmd[:2])
+            stdout.write(json.dumps(images[cmd[-1]]).encode('utf-8'))
+            return 0
+
+        parser = argparse.ArgumentParser()
+        create.flags(parser)
+        args = parser.parse_args(['inst'])
+        self.assertEqual(
+            ['--image-family', 'cos-stable', '--image-project', 'cos-cloud'],
+            create.boot_image_flags(args, gcloud_compute, 'datalab-baked'))
+        args = parser.parse_args(['inst', '--from-baked-image'])
+        self.assertEqual(
+            ['--image', 'datalab-baked-1'],
+            create.boot_image_flags(args, gcloud_compute, 'datalab-baked'))
+        self.assertEqual(
+            'us.gcr.io/cloud-datalab/datalab:latest', args.image_name)
+
+    def test_container_resource_flags(self):
+        parser = argparse.ArgumentParser()
+        create.flags(parser)
+        args = parser.parse_args([
+            'inst', '--memory-limit', '12G', '--cpuset', '0-2',
+            '--ulimit', 'nofile=65536'])
+        args.zone = 'us-central1-a'
+        args.project = _PROJECT
+        args.verbosity = 'error'
+        resources = create.machine_type_resources(args, self.compute)
+        self.assertEqual((4, 15360), resources)
+        self.assertEqual(
+            '--memory=12288m --shm-size=7680m --cpuset-cpus=0-2 '
+            '--ulimit nofile=65536:65536',
+            create.container_resource_flags(args, resources))
+        args.cpuset = '2-4'
+        with self.assertRaises(create.InvalidContainerResourcesException):
+            create.container_resource_flags(args, resources)
+        self.assertEqual([], self.fallback_calls)
+
+    def test_container_resource_flags_unknown_machine_type(self):
+        parser = argparse.ArgumentParser()
+        create.flags(parser)
+        args = parser.parse_args(['inst', '--cpuset', '0-2'])
+        args.zone = None
+        args.verbosity = 'error'
+        resources = create.machine_type_resources(args, self.compute)
+        self.assertIsNone(resources)
+        self.assertEqual(
+            '--cpuset-cpus=0-2',
+            create.container_resource_flags(args, resources))
+        args.memory_limit = '12288M'
+        args.memory_swap_limit = '50%'
+        with self.assertRaises(create.InvalidContainerResourcesException):
+            create.container_resource_flags(args, resources)
+        args.memory_limit = '50%'
+        with self.assertRaises(create.InvalidContainerResourcesException):
+            create.container_resource_flags(args, resources)
+
+    def test_prepare(self):
+        repos_calls = []
+
+        def gcloud_repos(args, cmd, stdin=None, stdout=None, stderr=None):
+            repos_calls.append([c for c in cmd if c != '--quiet'][0])
+            return 0
+
+        self.args.zone = 'us-central1-a'
+        self.args.instance = 'inst'
+        self.args.disk_name = None
+        self.args.network_name = 'datalab-network'
+        self.args.disk_size_gb = 20
+        self.args.disk_type = 'pd-ssd'
+        self.args.from_snapshot = None
+        self.args.no_create_repository = False
+        self.args.verbosity = 'none'
+        create.prepare(self.args, self.compute, gcloud_repos)
+        self.assertIn('datalab-network', self.api.networks)
+        self.assertIn('datalab-network-allow-ssh', self.api.firewalls)
+        self.assertIn(('us-central1-a', 'inst-pd'), self.api.disks)
+        self.assertEqual(
+            'projects/{}/zones/us-central1-a/diskTypes/pd-ssd'.format(
+                _PROJECT),
+            self.api.disks[('us-central1-a', 'inst-pd')]['type'])
+        self.assertEqual(['list', 'create'], repos_calls)
+
+        # Everything exists now, so the second run only needs reads.
+        del self.api.requests[:]
+        create.prepare(self.args, self.compute, gcloud_repos)
+        self.assertEqual(
+            ['GET', 'GET'], sorted(m for m, _ in self.api.requests))
+        self.assertEqual([], self.fallback_calls)
+
+
+class TestStartupScript(unittest.TestCase):
+    def parse_args(self, *flags):
+        parser = argparse.ArgumentParser()
+        create.flags(parser)
+        args = parser.parse_args(['inst'] + list(flags))
+        args.zone = 'us-central1-a'
+        return args
+
+    def check_bash_syntax(self, script):
+        with tempfile.NamedTemporaryFile(
+                mode='w', suffix='.sh', delete=False) as script_file:
+            script_file.write(script)
+        self.addCleanup(os.remove, script_file.name)
+        self.assertEqual(0, subprocess.call(['bash', '-n', script_file.name]))
+
+    def test_regional_image_name(self):
+        for zone, image_name in [
+                ('us-central1-a', 'us.gcr.io/cloud-datalab/datalab:latest'),
+                ('northamerica-northeast1-a',
+                 'us.gcr.io/cloud-datalab/datalab:latest'),
+                ('europe-west1-b', 'eu.gcr.io/cloud-datalab/datalab:latest'),
+                ('me-west1-a', 'eu.gcr.io/cloud-datalab/datalab:latest'),
+                ('australia-southeast1-a',
+                 'asia.gcr.io/cloud-datalab/datalab:latest'),
+                ('mars-north1-a', 'gcr.io/cloud-datalab/datalab:latest'),
+                (None, 'gcr.io/cloud-datalab/datalab:latest')]:
+            args = self.parse_args()
+            args.zone = zone
+            self.assertEqual(image_name, create.regional_image_name(args))
+
+        args = self.parse_args(
+            '--image-name', 'gcr.io/cloud-datalab/datalab-gpu:latest')
+        self.assertEqual('us.gcr.io/cloud-datalab/datalab-gpu:latest',
+                         create.regional_image_name(args))
+
+        # Other images are only moved when a region is chosen, and only
+        # if they are hosted on gcr.io.
+        args = self.parse_args('--image-name', 'gcr.io/my-project/lab:1')
+        self.assertEqual('gcr.io/my-project/lab:1',
+                         create.regional_image_name(args))
+        args.image_registry_region = 'eu'
+        self.assertEqual('eu.gcr.io/my-project/lab:1',
+                         create.regional_image_name(args))
+        args.image_name = 'docker.io/my/lab:1'
+        self.assertEqual('docker.io/my/lab:1',
+                         create.regional_image_name(args))
+        args = self.parse_args('--image-registry-region', 'global')
+        self.assertEqual('gcr.io/cloud-datalab/datalab:latest',
+                         create.regional_image_name(args))
+
+    def test_startup_script_modes(self):
+        swap_flags = [['--swap-mode', mode] for mode in create._SWAP_MODES]
+        swap_flags.append(['--no-swap'])
+        tmp_flags = [['--tmp-storage', storage]
+                     for storage in create._TMP_STORAGE_TYPES]
+        tmp_flags.append([])
+        cache_flags = [[], ['--no-image-cache']]
+        for swap, tmp, cache in itertools.product(
+                swap_flags, tmp_flags, cache_flags):
+            args = self.parse_args(*(swap + tmp + cache))
+            args.image_name = create.regional_image_name(args)
+            script = create.startup_script(args)
+            self.assertIn(
+                'swap_mode="{}"'.format(
+                    'none' if args.no_swap else args.swap_mode), script)
+            self.assertIn(
+                '"{}" == "persistent-disk"'.format(
+                    create.tmp_storage(args)), script)
+            self.assertIn('${PERSISTENT_DISK_DEV}', script)
+            self.assertIn("--format '{{.Id}}'", script)
+            self.check_bash_syntax(script)
+
+        for profile in sorted(create._DISK_PROFILES):
+            args = self.parse_args(
+                '--disk-profile', profile,
+                '--registry-mirror', 'https://mirror.example.com/')
+            args.image_name = create.regional_image_name(args)
+            script = create.startup_script(args)
+            self.assertIn('mirror="https://mirror.example.com"', script)
+            self.assertIn(
+                'fallback_image="gcr.io/cloud-datalab/datalab:latest"',
+                script)
+            self.check_bash_syntax(script)
+
+    def run_image_download(self, script, remote_images, local_digest=''):
+        # Run the script's image download with stand-ins for docker and
+        # the registry, and return the docker commands that it ran.
+        functions = [
+            re.search(r'^{}\(\) {{$.*?^}}$'.format(name), script,
+                      re.MULTILINE | re.DOTALL).group(0)
+            for name in ['download_docker_image', 'pull_docker_image']]
+        stubs = """
+preloaded_docker_image() { return 1; }
+docker-credential-gcr() { :; }
+docker() { [ "$1" == "image" ] || echo "docker $*"; }
+local_image_digest() { echo "%s"; }
+remote_image_digest() {
+  case " %s " in *" $1 "*) echo "sha256:1234";; esac
+}
+""" % (local_digest, ' '.join(remote_images))
+        output = subprocess.check_output(
+            ['bash', '-c', '\n'.join(functions) + stubs +
+             'download_docker_image'])
+        return [line for line in output.decode('utf-8').splitlines()
+                if line.startswith('docker ')]
+
+    def test_image_download(self):
+        regional = 'us.gcr.io/cloud-datalab/datalab:latest'
+        global_ = 'gcr.io/cloud-datalab/datalab:latest'
+        args = self.parse_args()
+        args.image_name = create.regional_image_name(args)
+        script = create.startup_script(args)
+        self.assertEqual(
+            ['docker pull ' + regional],
+            self.run_image_download(script, [regional, global_]))
+
+        # Images that the regional registry does not have are pulled,
+        # and compared, from the global one.
+        self.assertEqual(
+            ['docker pull ' + global_,
+             'docker tag {} {}'.format(global_, regional)],
+            self.run_image_download(script, [global_]))
+        self.assertEqual(
+            [], self.run_image_download(script, [global_], 'sha256:1234'))
+
+    def test_bake_script(self):
+        args = self.parse_args()
+        self.check_bash_syntax(create.bake_startup_script(args))
+        driver_env, driver_script = creategpu.gpu_driver_files(
+            '396.26', '/mnt/disks/datalab-pd/nvidia')
+        self.assertIn('NVIDIA_DRIVER_VERSION=396.26', driver_env)
+        self.assertIn('cache_root="/mnt/disks/datalab-pd/nvidia"',
+                      driver_script)
+        self.assertIn('${NVIDIA_DRIVER_VERSION}', driver_script)
+        self.check_bash_syntax(driver_script)
+        script = create.bake_startup_script(
+            args, gpu_driver_files=(driver_env, driver_script))
+        self.assertIn('NVIDIA_DRIVER_VERSION=396.26', script)
+        self.check_bash_syntax(script)
+
+    def test_cloud_config_templates(self):
+        # Every placeholder is filled in, and every other brace escaped.
+        create._DATALAB_CLOUD_CONFIG.format(*(['value'] * 9))
+        creategpu._DATALAB_CLOUD_CONFIG.format(*(['value'] * 12))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `delete` command against a local fake of the
+# Compute Engine API.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import delete, utils  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+_ZONES = fake_compute.ZONES
+
+
+class TestDelete(fake_compute.ComputeApiTestCase):
+    def test_delete_matching_instances(self):
+        for i in range(5):
+            self.api.add_instance(_ZONES[i % 2], 'team-{}'.format(i))
+        self.api.add_instance('us-central1-a', 'other')
+        self.api.add_instance('us-central1-a', 'team-x', tags=['web'])
+        self.args.instances = ['team-*']
+        self.args.filter = None
+        self.args.delete_disk = False
+        self.args.keep_disk = False
+        delete.run(self.args, self.compute)
+        self.assertEqual(
+            ['other', 'team-x'],
+            sorted(name for _, name in self.api.instances))
+        self.assertEqual([], self.fallback_calls)
+
+        self.args.instances = ['missing']
+        with self.assertRaises(utils.NoSuchInstanceException):
+            delete.run(self.args, self.compute)
+
+
+if __name__ == '__main__':
+    unittest.main()
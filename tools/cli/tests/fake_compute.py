@@ -0,0 +1,383 @@
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shared fixtures for the tests that run against a local fake of the
+# Compute Engine API, so that they need neither gcloud nor a GCP
+# project.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import computeapi, utils  # noqa: E402
+
+
+PROJECT = 'test-project'
+ZONES = ['us-central1-a', 'europe-west1-b']
+
+
+class FakeComputeApi(object):
+    """In-memory model of the parts of the Compute Engine API we use."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.operations = {}
+        self.instances = {}
+        self.disks = {}
+        self.accelerator_types = {}
+        self.networks = {}
+        self.firewalls = {}
+        self.snapshots = {}
+        self.failures = []
+
+    def url(self, path):
+        return 'https://fake/compute/v1/projects/{}/{}'.format(PROJECT, path)
+
+    def add_instance(self, zone, name, status='RUNNING', tags=None,
+                     metadata=None):
+        self.instances[(zone, name)] = {
+            'name': name,
+            'id': str(1000 + len(self.instances)),
+            'zone': self.url('zones/' + zone),
+            'networkInterfaces': [{
+                'networkIP': '10.0.0.{}'.format(2 + len(self.instances)),
+                'accessConfigs': [{'natIP': '203.0.113.{}'.format(
+                    2 + len(self.instances))}],
+            }],
+            'status': status,
+            'machineType': self.url(
+                'zones/{}/machineTypes/n1-standard-1'.format(zone)),
+            'tags': {'items': tags or ['datalab']},
+            'metadata': {'items': [
+                {'key': k, 'value': v}
+                for k, v in sorted((metadata or {}).items())]},
+            'disks': [
+                {'deviceName': 'boot', 'boot': True, 'autoDelete': True},
+                {'deviceName': 'datalab-pd', 'boot': False,
+                 'autoDelete': False,
+                 'source': self.url('zones/{}/disks/{}-pd'.format(
+                     zone, name))},
+            ],
+        }
+
+    def fail_next(self, method, path_suffix, status, message):
+        """Make the next matching request fail with the given error."""
+        self.failures.append((method, path_suffix, status, message))
+
+    def operation(self, target, zone=None):
+        name = 'operation-{}'.format(len(self.operations))
+        op = {'name': name, 'status': 'RUNNING', 'targetLink': target}
+        if zone:
+            op['zone'] = self.url('zones/' + zone)
+        self.operations[name] = op
+        return op
+
+    def handle(self, method, path, query, body):
+        parts = path.split('/')
+        # /compute/v1/projects/<project>/...
+        if parts[:4] != ['', 'compute', 'v1', 'projects'] or (
+                parts[4] != PROJECT):
+            return 404, {'error': {'message': 'bad path ' + path}}
+        for failure in self.failures:
+            if failure[0] == method and path.endswith(failure[1]):
+                self.failures.remove(failure)
+                return failure[2], {'error': {'message': failure[3]}}
+        rest = parts[5:]
+        if rest[-2:-1] == ['operations']:
+            op = self.operations.get(rest[-1])
+            if not op:
+                return 404, {'error': {'message': (
+                    "The resource '{}' was not found".format(
+                        path.split('/v1/', 1)[-1]))}}
+            result = dict(op)
+            op['status'] = 'DONE'
+            return 200, result
+        if rest == ['zones']:
+            return 200, {'items': [{'name': z} for z in ZONES]}
+        if rest == ['aggregated', 'disks']:
+            items = {}
+            for (zone, _), disk in sorted(self.disks.items()):
+                scoped = items.setdefault('zones/' + zone, {'disks': []})
+                scoped['disks'].append(dict(
+                    disk, zone=self.url('zones/' + zone)))
+            return 200, {'items': items}
+        if rest == ['aggregated', 'acceleratorTypes']:
+            items = {}
+            for (zone, name), maximum in sorted(
+                    self.accelerator_types.items()):
+                scoped = items.setdefault(
+                    'zones/' + zone, {'acceleratorTypes': []})
+                scoped['acceleratorTypes'].append({
+                    'name': name, 'zone': self.url('zones/' + zone),
+                    'maximumCardsPerInstance': maximum})
+            return 200, {'items': items}
+        if rest == ['aggregated', 'instances']:
+            items = {}
+            for (zone, _), instance in sorted(self.instances.items()):
+                scoped = items.setdefault('zones/' + zone, {'instances': []})
+                scoped['instances'].append(instance)
+            return 200, {'items': items}
+        if rest[0] == 'zones' and rest[2] == 'machineTypes':
+            return 200, {'name': rest[3], 'guestCpus': 4, 'memoryMb': 15360}
+        if rest[0] == 'zones' and rest[2] == 'instances':
+            zone = rest[1]
+            instance = self.instances.get((zone, rest[3]))
+            if not instance:
+                return 404, {'error': {'message': (
+                    "The resource 'projects/{}/zones/{}/instances/{}' was "
+                    "not found".format(PROJECT, zone, rest[3]))}}
+            target = self.url('zones/{}/instances/{}'.format(zone, rest[3]))
+            if method == 'GET' and rest[4:] == ['serialPort']:
+                start = int(query.get('start', ['0'])[0])
+                serial = instance.get('serial', '')
+                return 200, {'contents': serial[start:], 'next': len(serial)}
+            if method == 'GET':
+                return 200, instance
+            if method == 'DELETE':
+                del self.instances[(zone, rest[3])]
+                return 200, self.operation(target, zone)
+            action = rest[4]
+            if action == 'stop':
+                instance['status'] = 'TERMINATED'
+                instance['discardedLocalSsd'] = query.get(
+                    'discardLocalSsd', ['false'])[0] == 'true'
+            elif action == 'start':
+                instance['status'] = 'RUNNING'
+            elif action == 'setMachineType':
+                instance['machineType'] = self.url(body['machineType'])
+            elif action == 'setDiskAutoDelete':
+                for disk in instance['disks']:
+                    if disk['deviceName'] == query['deviceName'][0]:
+                        disk['autoDelete'] = (
+                            query['autoDelete'][0] == 'true')
+            return 200, self.operation(target, zone)
+        if rest[0] == 'zones' and rest[2] == 'disks':
+            zone = rest[1]
+            if method == 'POST' and rest[4:] == ['resize']:
+                self.disks[(zone, rest[3])]['sizeGb'] = body['sizeGb']
+                return 200, self.operation(self.url(
+                    'zones/{}/disks/{}'.format(zone, rest[3])), zone)
+            if method == 'POST' and rest[4:] == ['createSnapshot']:
+                disk = self.disks[(zone, rest[3])]
+                self.snapshots[body['name']] = dict(
+                    body, diskSizeGb=disk['sizeGb'])
+                return 200, self.operation(
+                    self.url('global/snapshots/' + body['name']))
+            if method == 'POST':
+                self.disks[(zone, body['name'])] = body
+                return 200, self.operation(self.url(
+                    'zones/{}/disks/{}'.format(zone, body['name'])), zone)
+            disk = self.disks.get((zone, rest[3]))
+            if not disk:
+                return 404, {'error': {'message': 'disk not found'}}
+            return 200, disk
+        if rest[:2] == ['global', 'snapshots']:
+            if rest[2] not in self.snapshots:
+                return 404, {'error': {'message': 'snapshot not found'}}
+            return 200, self.snapshots[rest[2]]
+        if rest[:2] == ['global', 'networks']:
+            if method == 'POST':
+                self.networks[body['name']] = body
+                return 200, self.operation(
+                    self.url('global/networks/' + body['name']))
+            if len(rest) == 2:
+                return 200, {'items': list(self.networks.values())}
+            if rest[2] not in self.networks:
+                return 404, {'error': {'message': 'network not found'}}
+            return 200, self.networks[rest[2]]
+        if rest[:2] == ['global', 'firewalls']:
+            if method == 'POST':
+                body['network'] = self.url(body['network'].split(
+                    '/', 2)[-1])
+                self.firewalls[body['name']] = body
+                return 200, self.operation(
+                    self.url('global/firewalls/' + body['name']))
+            if len(rest) == 2:
+                return 200, {'items': list(self.firewalls.values())}
+            if rest[2] not in self.firewalls:
+                return 404, {'error': {'message': 'firewall not found'}}
+            return 200, self.firewalls[rest[2]]
+        return 404, {'error': {'message': 'unknown path ' + path}}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Keep-alive connections are held open by the client under test,
+    # so each one needs its own thread.
+    daemon_threads = True
+
+
+def start_fake_server(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            BaseHTTPRequestHandler.setup(self)
+            with api.lock:
+                api.connections += 1
+
+        def log_message(self, *unused_args):
+            pass
+
+        def _handle(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length).decode('utf-8')) \
+                if length else None
+            url = urlsplit(self.path)
+            with api.lock:
+                api.requests.append((self.command, url.path))
+                status, result = api.handle(
+                    self.command, url.path, parse_qs(url.query), body)
+            data = json.dumps(result).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _handle
+        do_POST = _handle
+        do_DELETE = _handle
+
+    server = ThreadingHTTPServer(('localhost', 0), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class ComputeApiTestCase(unittest.TestCase):
+    """Runs each test against a fresh fake Compute Engine API."""
+
+    def setUp(self):
+        self.api = FakeComputeApi()
+        self.server = start_fake_server(self.api)
+        endpoint = 'http://localhost:{}/compute/v1/'.format(
+            self.server.server_address[1])
+        token_file = tempfile.NamedTemporaryFile(mode='w', delete=False)
+        token_file.write('fake-token')
+        token_file.close()
+        self.token_file = token_file.name
+        os.environ[computeapi._ACCESS_TOKEN_FILE_ENV_VAR] = self.token_file
+        self.fallback_calls = []
+        self.gcloud_ssh = False
+
+        def fallback(args, cmd, stdin=None, stdout=None, stderr=None):
+            self.fallback_calls.append(cmd)
+            if self.gcloud_ssh and cmd[0] == 'ssh':
+                # Stand in for `gcloud compute ssh`, which runs ssh with
+                # the given flags once it has set up the user's keys.
+                flag = '--ssh-flag='
+                subprocess.check_call(
+                    ['ssh'] + [c[len(flag):] for c in cmd
+                               if c.startswith(flag)] + [cmd[-1]])
+            return 0
+
+        computeapi._OPERATION_POLL_INITIAL_SECONDS = 0
+        self.compute = computeapi.ComputeBackend(
+            fallback, 'gcloud', endpoint=endpoint)
+        self.args = argparse.Namespace(
+            project=PROJECT, zone=None, quiet=True, verbosity='error')
+        utils._instance_records.clear()
+        self.config_dir = tempfile.mkdtemp()
+        os.environ['DATALAB_CONFIG_DIR'] = self.config_dir
+
+    def tearDown(self):
+        self.compute.close()
+        self.server.shutdown()
+        self.server.server_close()
+        del os.environ[computeapi._ACCESS_TOKEN_FILE_ENV_VAR]
+        os.remove(self.token_file)
+        del os.environ['DATALAB_CONFIG_DIR']
+        shutil.rmtree(self.config_dir)
+
+    @property
+    def stderr(self):
+        stderr = tempfile.TemporaryFile()
+        self.addCleanup(stderr.close)
+        return stderr
+
+    def run_compute(self, cmd):
+        with tempfile.TemporaryFile() as stdout:
+            self.compute(self.args, cmd, stdout=stdout)
+            stdout.seek(0)
+            return stdout.read().decode('utf-8')
+
+    def fake_ssh(self):
+        """Put a stand-in for ssh, that tracks masters, on the PATH.
+
+        Remote commands are run locally. They, and requests to add or
+        cancel a forward of a master, fail if they contain the value of
+        the FAKE_SSH_FAIL_MATCH environment variable. Fallback
+        `gcloud compute ssh` commands run the stand-in too.
+
+        Returns:
+          The path of the file to which the stand-in logs its arguments.
+        """
+        bin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bin_dir)
+        ssh_log = os.path.join(bin_dir, 'ssh.log')
+        with open(os.path.join(bin_dir, 'ssh'), 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'echo "$@" >> {0}\n'
+                    'cmd=; host=\n'
+                    'for arg in "$@"; do\n'
+                    '  if [ -n "$host" ]; then cmd="$cmd $arg"; fi\n'
+                    '  case "$arg" in datalab@*) host=1;; esac\n'
+                    'done\n'
+                    'if [ -n "$cmd" ]; then\n'
+                    '  case "$cmd" in\n'
+                    '    *"${{FAKE_SSH_FAIL_MATCH:-NONE}}"*) exit 1;;\n'
+                    '  esac\n'
+                    '  exec sh -c "$cmd"\n'
+                    'fi\n'
+                    'master={1}/master-$(echo "$@" | cksum | cut -c1-4)\n'
+                    'for arg in "$@"; do case "$arg" in\n'
+                    '  ControlPath=*) master={1}/$(basename "$arg");;\n'
+                    'esac; done\n'
+                    'case "$1 $2" in\n'
+                    '  "-O exit") rm -f $master;;\n'
+                    '  "-O forward"|"-O cancel")\n'
+                    '    case "$*" in\n'
+                    '      *"${{FAKE_SSH_FAIL_MATCH:-NONE}}"*) exit 1;;\n'
+                    '    esac\n'
+                    '    test -f $master;;\n'
+                    '  "-O "*) test -f $master;;\n'
+                    '  *) touch $master;;\n'
+                    'esac\n'.format(ssh_log, bin_dir))
+        os.chmod(os.path.join(bin_dir, 'ssh'), 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+        self.gcloud_ssh = True
+        return ssh_log
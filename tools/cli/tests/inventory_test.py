@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests resolving the zones of instances from the local
+# inventory, against a local fake of the Compute Engine API.
+
+import os
+import subprocess
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import inventory, utils  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+_PROJECT = fake_compute.PROJECT
+
+
+class TestInventory(fake_compute.ComputeApiTestCase):
+    def test_zone_from_inventory(self):
+        self.api.add_instance('europe-west1-b', 'inst')
+        inventory.record_instance(
+            self.args, 'inst', 'europe-west1-b', 'RUNNING')
+        utils.describe_instance(self.args, self.compute, 'inst')
+        self.assertEqual('europe-west1-b', self.args.zone)
+        self.assertEqual(
+            [('GET', '/compute/v1/projects/{}/zones/europe-west1-b/'
+              'instances/inst'.format(_PROJECT))],
+            self.api.requests)
+
+    def test_stale_inventory_entry(self):
+        self.api.add_instance('europe-west1-b', 'inst')
+        inventory.record_instance(
+            self.args, 'inst', 'us-central1-a', 'RUNNING')
+        utils.describe_instance(self.args, self.compute, 'inst')
+        self.assertEqual('europe-west1-b', self.args.zone)
+        self.assertEqual(
+            'europe-west1-b', inventory.lookup_zone(self.args, 'inst'))
+
+    def test_inventory_lookup_error(self):
+        self.api.add_instance('europe-west1-b', 'inst')
+        inventory.record_instance(
+            self.args, 'inst', 'europe-west1-b', 'RUNNING')
+        self.api.fail_next(
+            'GET', '/zones/europe-west1-b/instances/inst', 503,
+            'Backend error')
+        with self.assertRaises(subprocess.CalledProcessError):
+            utils.describe_instance(self.args, self.compute, 'inst')
+        self.assertIsNone(self.args.zone)
+        self.assertEqual(
+            'europe-west1-b', inventory.lookup_zone(self.args, 'inst'))
+        self.assertEqual(1, len(self.api.requests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `port-forward` command, using a stand-in for ssh
+# and a local fake of the Compute Engine API.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import portforward, tunnel  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestPortForward(fake_compute.ComputeApiTestCase):
+    @unittest.skipUnless(tunnel.multiplexing_supported(),
+                         'requires OpenSSH')
+    def test_port_forward(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        self.fake_ssh()
+        self.addCleanup(os.environ.pop, 'FAKE_SSH_FAIL_MATCH', None)
+        self.args.zone = 'us-central1-a'
+        self.args.ssh_log_level = 'error'
+        self.args.tunnel_profile = 'wan'
+        self.args.instance = 'inst'
+        self.args.forwards = [(6006, 6006)]
+        self.args.remove = False
+        with self.assertRaises(portforward.NoConnectionException):
+            portforward.run(self.args, self.compute)
+
+        ssh_tunnel = tunnel.Tunnel(
+            self.args, self.compute, 'inst', [(8081, tunnel.DATALAB_PORT)])
+        ssh_tunnel.open()
+        self.addCleanup(ssh_tunnel.close)
+        portforward.run(self.args, self.compute)
+        self.assertEqual([(8081, 8080), (6006, 6006)], ssh_tunnel.forwards)
+        self.args.remove = True
+        portforward.run(self.args, self.compute)
+        self.assertEqual([(8081, 8080)], ssh_tunnel.forwards)
+
+        os.environ['FAKE_SSH_FAIL_MATCH'] = 'localhost:6006'
+        with self.assertRaises(portforward.RemoveForwardFailedException):
+            portforward.run(self.args, self.compute)
+        self.args.remove = False
+        with self.assertRaises(tunnel.ForwardFailedException):
+            portforward.run(self.args, self.compute)
+        self.assertTrue(ssh_tunnel.master_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
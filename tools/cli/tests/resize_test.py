@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `resize` command against a local fake of the
+# Compute Engine API.
+
+import argparse
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import resize  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+_PROJECT = fake_compute.PROJECT
+
+
+class TestResize(fake_compute.ComputeApiTestCase):
+    def test_resize(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        self.api.disks[('us-central1-a', 'inst-pd')] = {
+            'name': 'inst-pd', 'sizeGb': '200'}
+        parser = argparse.ArgumentParser()
+        resize.flags(parser)
+        args = parser.parse_args([
+            'inst', '--machine-type', 'n1-highmem-8', '--disk-size-gb', '500',
+            '--no-connect'])
+        args.project = _PROJECT
+        args.zone = 'us-central1-a'
+        args.quiet = True
+        args.verbosity = 'none'
+        resize.run(args, self.compute)
+        instance = self.api.instances[('us-central1-a', 'inst')]
+        self.assertEqual('RUNNING', instance['status'])
+        self.assertTrue(instance['machineType'].endswith(
+            '/machineTypes/n1-highmem-8'))
+        self.assertEqual(
+            '500', self.api.disks[('us-central1-a', 'inst-pd')]['sizeGb'])
+        self.assertIn(
+            ('POST', '/compute/v1/projects/{}/zones/us-central1-a/instances/'
+             'inst/stop'.format(_PROJECT)), self.api.requests)
+
+        args.disk_size_gb = 100
+        with self.assertRaises(resize.DiskShrinkException):
+            resize.run(args, self.compute)
+        self.assertEqual([], self.fallback_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `snapshot` command, and creating instances from
+# snapshots, against a local fake of the Compute Engine API.
+
+import argparse
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import create, snapshot  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+_PROJECT = fake_compute.PROJECT
+
+
+class TestSnapshot(fake_compute.ComputeApiTestCase):
+    def test_snapshot_and_restore(self):
+        for name in ['alice', 'bob']:
+            self.api.add_instance('us-central1-a', name)
+            self.api.disks[('us-central1-a', name + '-pd')] = {
+                'name': name + '-pd', 'sizeGb': '300'}
+        self.args.instances = ['alice', 'bob']
+        self.args.filter = None
+        self.args.snapshot_name = 'copy'
+        with self.assertRaises(snapshot.SnapshotNameException):
+            snapshot.run(self.args, self.compute)
+        self.args.snapshot_name = None
+        snapshot.run(self.args, self.compute)
+        self.assertEqual(2, len(self.api.snapshots))
+        name = snapshot.default_snapshot_name('alice', 0)
+        self.assertEqual('alice-19700101-000000', name)
+        alice_snapshot = [s for s in self.api.snapshots
+                          if s.startswith('alice-')][0]
+        self.assertEqual(
+            {'datalab-instance': 'alice'},
+            self.api.snapshots[alice_snapshot]['labels'])
+
+        parser = argparse.ArgumentParser()
+        create.flags(parser)
+        args = parser.parse_args([
+            'copy', '--from-snapshot', alice_snapshot,
+            '--no-create-repository'])
+        args.zone = 'europe-west1-b'
+        args.quiet = True
+        args.project = _PROJECT
+        args.verbosity = 'none'
+        create.prepare(args, self.compute, None)
+        disk = self.api.disks[('europe-west1-b', 'copy-pd')]
+        self.assertEqual('300', disk['sizeGb'])
+        self.assertEqual(
+            'projects/{}/global/snapshots/{}'.format(
+                _PROJECT, alice_snapshot),
+            disk['sourceSnapshot'])
+        with self.assertRaises(create.DiskExistsException):
+            create.prepare(args, self.compute, None)
+        self.assertEqual([], self.fallback_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `stop` command against a local fake of the
+# Compute Engine API.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import inventory, stop  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestStop(fake_compute.ComputeApiTestCase):
+    def test_stop_named_instances(self):
+        self.api.add_instance('us-central1-a', 'team-a')
+        self.api.add_instance('europe-west1-b', 'team-b')
+        self.args.instances = ['team-a', 'team-b']
+        self.args.filter = None
+        stop.run(self.args, self.compute)
+        self.assertEqual(
+            ['TERMINATED', 'TERMINATED'],
+            [i['status'] for i in self.api.instances.values()])
+        self.assertIsNone(self.args.zone)
+        self.assertEqual(
+            'europe-west1-b', inventory.lookup_zone(self.args, 'team-b'))
+
+    def test_stop_instance_with_local_ssd(self):
+        self.api.add_instance('us-central1-a', 'plain')
+        self.api.add_instance('us-central1-a', 'scratch')
+        scratch = self.api.instances[('us-central1-a', 'scratch')]
+        scratch['disks'].append(
+            {'deviceName': 'local-ssd-0', 'type': 'SCRATCH',
+             'autoDelete': True})
+        self.args.instances = ['plain', 'scratch']
+        self.args.filter = None
+        stop.run(self.args, self.compute)
+        plain = self.api.instances[('us-central1-a', 'plain')]
+        self.assertEqual('TERMINATED', plain['status'])
+        self.assertFalse(plain['discardedLocalSsd'])
+        self.assertEqual('TERMINATED', scratch['status'])
+        self.assertTrue(scratch['discardedLocalSsd'])
+        self.assertEqual([], self.fallback_calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the multiplexed SSH tunnels, using a stand-in for
+# ssh and a local fake of the Compute Engine API.
+
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import tunnel  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestTunnel(fake_compute.ComputeApiTestCase):
+    @unittest.skipUnless(tunnel.multiplexing_supported(),
+                         'requires OpenSSH')
+    def test_tunnel_reconnect(self):
+        self.api.add_instance('us-central1-a', 'inst')
+        ssh_log = self.fake_ssh()
+        self.args.zone = 'us-central1-a'
+        self.args.ssh_log_level = 'error'
+        self.args.tunnel_profile = 'wan'
+        self.addCleanup(os.environ.pop, 'FAKE_SSH_FAIL_MATCH', None)
+
+        # Nothing is tried without gcloud until gcloud has set up keys.
+        ssh_tunnel = tunnel.Tunnel(
+            self.args, self.compute, 'inst', [(8081, tunnel.DATALAB_PORT)])
+        self.assertIsNone(ssh_tunnel.open(use_gcloud=False))
+        self.assertEqual(tunnel.VIA_GCLOUD, ssh_tunnel.open())
+        self.assertEqual(tunnel.VIA_MASTER, ssh_tunnel.open())
+        ssh_tunnel.close()
+        with self.assertRaises(tunnel.TunnelClosedException):
+            ssh_tunnel.wait()
+        self.assertEqual(tunnel.VIA_DIRECT, ssh_tunnel.open())
+
+        # Forwards added by another invocation survive reconnecting.
+        other = tunnel.Tunnel(self.args, self.compute, 'inst', [])
+        self.assertTrue(other.add_forward(6006, 6006))
+        self.assertEqual([(8081, 8080), (6006, 6006)], ssh_tunnel.forwards)
+        ssh_tunnel._control('exit')
+        self.assertEqual(tunnel.VIA_DIRECT, ssh_tunnel.open())
+
+        # A forward that cannot be added to a shared master is reported,
+        # and the master is left running.
+        os.environ['FAKE_SSH_FAIL_MATCH'] = 'localhost:4040'
+        busy = tunnel.Tunnel(self.args, self.compute, 'inst', [(4040, 4040)])
+        with self.assertRaises(tunnel.ForwardFailedException):
+            busy.open()
+        self.assertTrue(ssh_tunnel.master_alive())
+        ssh_tunnel.close()
+        self.assertEqual([(8081, 8080)], ssh_tunnel.forwards)
+
+        with open(ssh_log) as f:
+            direct = [line for line in f if 'datalab@203.0.113.2' in line]
+        self.assertEqual(2, len(direct))
+        self.assertIn('HostKeyAlias=compute.1000', direct[0])
+        self.assertIn('-L localhost:8081:localhost:8080', direct[0])
+        self.assertNotIn('6006', direct[0])
+        self.assertIn('-L localhost:6006:localhost:6006', direct[1])
+        self.assertEqual(['ssh'], [cmd[0] for cmd in self.fallback_calls])
+        self.assertEqual((6006, 6006), tunnel.parse_forward('6006'))
+        self.assertEqual((16006, 6006), tunnel.parse_forward('16006:6006'))
+        for spec in ['', 'x', '1:2:3', '0', '70000:1']:
+            with self.assertRaises(tunnel.InvalidForwardException):
+                tunnel.parse_forward(spec)
+
+    def test_counting_proxy(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('localhost', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def echo():
+            conn, _ = server.accept()
+            conn.sendall(conn.recv(1024) * 2)
+            conn.close()
+
+        echo_thread = threading.Thread(target=echo)
+        echo_thread.start()
+        proxy = tunnel.CountingProxy(
+            tunnel.free_local_port(), server.getsockname()[1])
+        self.addCleanup(proxy.close)
+        client = socket.create_connection(
+            ('localhost', proxy._listener.getsockname()[1]))
+        client.sendall(b'hello')
+        received = b''
+        while len(received) < 10:
+            received += client.recv(1024)
+        client.close()
+        echo_thread.join()
+        self.assertEqual(b'hellohello', received)
+        for _ in range(100):
+            if proxy.bytes_transferred == (5, 10):
+                break
+            threading.Event().wait(0.05)
+        self.assertEqual((5, 10), proxy.bytes_transferred)
+
+    def test_counting_proxy_half_close(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('localhost', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def respond_after_request():
+            conn, _ = server.accept()
+            request = b''
+            while True:
+                data = conn.recv(1024)
+                if not data:
+                    break
+                request += data
+            conn.sendall(request * 2)
+            conn.close()
+
+        server_thread = threading.Thread(target=respond_after_request)
+        server_thread.start()
+        proxy = tunnel.CountingProxy(
+            tunnel.free_local_port(), server.getsockname()[1])
+        self.addCleanup(proxy.close)
+        client = socket.create_connection(
+            ('localhost', proxy._listener.getsockname()[1]))
+        client.sendall(b'hello')
+        client.shutdown(socket.SHUT_WR)
+        received = b''
+        while True:
+            data = client.recv(1024)
+            if not data:
+                break
+            received += data
+        client.close()
+        server_thread.join()
+        self.assertEqual(b'hellohello', received)
+
+
+if __name__ == '__main__':
+    unittest.main()
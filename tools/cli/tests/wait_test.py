@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file tests the `wait` command against a local fake of the
+# Compute Engine API.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from commands import inventory, wait  # noqa: E402
+import fake_compute  # noqa: E402
+
+
+class TestWait(fake_compute.ComputeApiTestCase):
+    def test_wait_for_operations(self):
+        wait._POLL_INITIAL_SECONDS = 0
+        for zone, name in [('us-central1-a', 'first'),
+                           ('europe-west1-b', 'second'),
+                           ('europe-west1-b', 'broken')]:
+            wait.record_operation(self.args, name, self.api.operation(
+                self.api.url('zones/{}/instances/{}'.format(zone, name)),
+                zone))
+        self.api.operations['operation-2']['error'] = {
+            'errors': [{'message': 'quota exceeded'}]}
+        self.args.instances = []
+        self.args.timeout = None
+        with self.assertRaises(wait.OperationsFailedException):
+            wait.run(self.args, self.compute)
+        self.assertEqual({}, wait.pending_operations(self.args))
+        self.assertEqual(
+            'europe-west1-b', inventory.lookup_zone(self.args, 'second'))
+        self.assertEqual(6, len(self.api.requests))
+        self.assertEqual([], self.fallback_calls)
+
+    def test_wait_through_errors(self):
+        self.addCleanup(setattr, wait, '_POLL_INITIAL_SECONDS',
+                        wait._POLL_INITIAL_SECONDS)
+        wait._POLL_INITIAL_SECONDS = 0
+        wait.record_operation(self.args, 'flaky', self.api.operation(
+            self.api.url('zones/us-central1-a/instances/flaky'),
+            'us-central1-a'))
+        wait.record_operation(self.args, 'expired', {
+            'name': 'operation-expired',
+            'zone': self.api.url('zones/us-central1-a')})
+        self.api.fail_next(
+            'GET', '/operations/operation-0', 503, 'Backend error')
+        self.args.instances = []
+        self.args.timeout = None
+        wait.run(self.args, self.compute)
+        self.assertEqual({}, wait.pending_operations(self.args))
+        self.assertEqual(
+            'us-central1-a', inventory.lookup_zone(self.args, 'flaky'))
+
+        # Operations that cannot be checked stay pending until they can.
+        wait.record_operation(self.args, 'later', self.api.operation(
+            self.api.url('zones/us-central1-a/instances/later'),
+            'us-central1-a'))
+        self.api.fail_next(
+            'GET', '/operations/operation-1', 401, 'Invalid credentials')
+        self.api.fail_next(
+            'GET', '/operations/operation-1', 401, 'Invalid credentials')
+        self.args.timeout = 0
+        wait.run(self.args, self.compute)
+        self.assertEqual(['later'], list(wait.pending_operations(self.args)))
+        self.args.timeout = None
+        wait.run(self.args, self.compute)
+        self.assertEqual({}, wait.pending_operations(self.args))
+
+
+if __name__ == '__main__':
+    unittest.main()